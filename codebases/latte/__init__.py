@@ -1,7 +1,5 @@
 import lib
-import dsl
-import compiler
 import ast_matcher
 import templates
 
-__all__ = [ "lib", "dsl", "compiler", "ast_matcher", "templates" ]
+__all__ = [ "lib", "ast_matcher", "templates" ]
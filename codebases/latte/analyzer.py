@@ -2,12 +2,20 @@
     Latte Semantic Analyzer
 '''
 import ast
+import hashlib
+import multiprocessing
+import os
+import sys
+import profiler
 from ast_matcher import *
 from templates import *
 from copy import deepcopy
 from translator import *
 from lib import *
 from term import *
+import connection
+import compile_cache
+import numpy as np
 
 neuron_analyzers = { }
 
@@ -21,19 +29,26 @@ field_blacklist = set([\
 class NeuronAnalyzer(object):
     """class for neuron specific code generation
     Each neuron type has its own analyzer"""
-    def __init__(self, neuron_ast, options):
+    def __init__(self, neuron_ast, options, fields=None):
         super(NeuronAnalyzer, self).__init__()
-        self.MKL_FLAG = options.MKL_FLAG
-        self.DP_FLAG = options.DP_FLAG
+        self.set_options(options)
         # field variables
         self.name = neuron_ast.name
         self.neuron_ast = neuron_ast
         self.fields = { }
         self.name2enm = None
+        if fields is not None:
+            # fields analyzed before, see LibraryAnalysis
+            self.fields = dict(fields)
+            return
         # AST processing
         for function_ast in self.extract_functions():
             self.process_init(function_ast)
 
+    def set_options(self, options):
+        self.MKL_FLAG = getattr(options, "MKL_FLAG", False)
+        self.DP_FLAG = getattr(options, "DP_FLAG", False)
+
     def init_fields(self):
         """ pass in enm_name to generate SoA code"""
         # find base class and incorporates its fields
@@ -198,15 +213,12 @@ class NeuronAnalyzer(object):
             return self.fields[field]
         return None
 
-def extract_neuron_classes(filename):
+def extract_neuron_classes(AST):
     """
-    read in a file and find out all
-    classes that is either Neuron,
+    find out all classes of a parsed
+    file that is either Neuron,
     or its subtype
     """
-    source = open(filename, "r")
-    AST = ast.parse(source.read())
-    source.close()
     for node in ast.walk(AST):
         if isinstance(node, ast.ClassDef):
             # if the class is Neuron itself
@@ -218,20 +230,20 @@ def extract_neuron_classes(filename):
                     yield node
     return
 
-def extract_functions(filename):
+def extract_functions(AST):
     """
-    read in a file and find out all
-    layer function definitions
+    find out all layer function
+    definitions of a parsed file
     """
-    source = open(filename, "r")
-    AST = ast.parse(source.read())
-    source.close()
     for node in ast.walk(AST):
         if isinstance(node, ast.FunctionDef):
             yield node 
     return
 
 def process_add_connection_helper(all_functions, function_ast):
+    # data layers have no incoming connection
+    if "DataLayer" in function_ast.name:
+        return None, None, None
     if function_ast.name.endswith("Layer"):
         args = list(map(lambda x: x.id, function_ast.args.args))
         layer_name = function_ast.name
@@ -264,7 +276,9 @@ def process_add_connection_helper(all_functions, function_ast):
             term.dump("NO MATCH FOR ADD_CONNECTION: %s" % layer_name, term.FAIL)
     return None, None, None
 
-def ast2lambda(mapping, args, ensemble, name2enm):
+def substitute_mapping(mapping, args, ensemble, name2enm):
+    """module assigning the mapping lambda to func, with the dimensions
+    and the layer arguments of the ensemble substituted by numbers"""
     # generate module wrapper
     mapping = ast.Module(\
         body = [\
@@ -286,6 +300,13 @@ def ast2lambda(mapping, args, ensemble, name2enm):
     for arg in args:
         if arg in ensemble:
             mapping = SubstituteNameToNum(arg, ensemble[arg]).visit(mapping)
+    return mapping
+
+def ast2lambda(mapping, args, ensemble, name2enm):
+    mapping = substitute_mapping(mapping, args, ensemble, name2enm)
+    return compile_mapping(mapping)
+
+def compile_mapping(mapping):
     # compile the ast
     mapping = ast.fix_missing_locations(mapping)
     # print ast.dump(mapping)
@@ -293,36 +314,105 @@ def ast2lambda(mapping, args, ensemble, name2enm):
     exec(codeobj)
     return func
 
-def check_uniform_dependency(args, mapping, ensemble_info, name2enm):
+def describe_connection(args, mapping, ensemble_info, name2enm):
+    """
+    connection descriptor of an ensemble, the same one that
+    lib.add_connection builds at runtime from the mapping lambda
+    """
     dim_x, dim_y = ensemble_info['dim_x'], ensemble_info['dim_y']
-    mapping = ast2lambda(mapping, args, ensemble_info, name2enm)
-    # number of dimension
-    dim = 2
- 
-    mapped_indices = sorted(mapping(*tuple([ 0 for i in range(dim) ])))
-    # print mapped_indices
-    for d in range(dim):
-        for i in range(dim_x):
-            for j in range(dim_y):
-                # double dimension
-                if sorted(mapping(i, j)) != mapped_indices:
-                    return False
-    return True
+    prev_dim_x, prev_dim_y = name2enm[ensemble_info['prev']][3:5]
+    mapping = substitute_mapping(mapping, args, ensemble_info, name2enm)
+    window = affine_window(mapping.body[0].value, dim_x, dim_y)
+    if window is not None:
+        return connection.window_connection(dim_x, dim_y, prev_dim_x, prev_dim_y, *window)
+    # not affine: evaluate the mapping of every neuron
+    mapping = compile_mapping(mapping)
+    return connection.describe_mapping(mapping, dim_x, dim_y, prev_dim_x, prev_dim_y)
+
+def affine_form(node, variables):
+    """
+    coefficients of an integer expression affine in variables, as a dict
+    { None: constant, var: coefficient, .. }, None if it is not affine
+    """
+    if isinstance(node, ast.Num):
+        if isinstance(node.n, (int, long)):
+            return { None: node.n }
+        return None
+    if isinstance(node, ast.Name):
+        if node.id in variables:
+            return { node.id: 1 }
+        return None
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        form = affine_form(node.operand, variables)
+        if form is None: return None
+        return dict((var, -coef) for var, coef in form.iteritems())
+    if isinstance(node, ast.BinOp):
+        left = affine_form(node.left, variables)
+        right = affine_form(node.right, variables)
+        if left is None or right is None: return None
+        if isinstance(node.op, ast.Add) or isinstance(node.op, ast.Sub):
+            sign = 1 if isinstance(node.op, ast.Add) else -1
+            form = dict(left)
+            for var, coef in right.iteritems():
+                form[var] = form.get(var, 0) + sign * coef
+            return form
+        if isinstance(node.op, ast.Mult):
+            # one side has to be a constant
+            if set(right.keys()) <= set([ None ]):
+                left, right = right, left
+            if not set(left.keys()) <= set([ None ]): return None
+            scale = left.get(None, 0)
+            return dict((var, scale * coef) for var, coef in right.iteritems())
+    return None
+
+def affine_window(mapping, dim_x, dim_y):
+    """
+    bounds (lo_i, hi_i, lo_j, hi_j) of every neuron, arrays of shape
+    (dim_x, dim_y), of a mapping lambda x, y: [ (i, j) for i in range(..)
+    for j in range(..) ] whose bounds are affine in x and y; None for
+    any other mapping
+    """
+    if not isinstance(mapping, ast.Lambda) or len(mapping.args.args) != 2:
+        return None
+    if not all(isinstance(arg, ast.Name) for arg in mapping.args.args):
+        return None
+    variables = [ arg.id for arg in mapping.args.args ]
+    body = mapping.body
+    if not isinstance(body, ast.ListComp) or len(body.generators) != 2:
+        return None
+    if not isinstance(body.elt, ast.Tuple) or len(body.elt.elts) != 2:
+        return None
+    bounds = []
+    for gen, elt in zip(body.generators, body.elt.elts):
+        if not isinstance(gen.target, ast.Name) or len(gen.ifs) > 0:
+            return None
+        if not isinstance(elt, ast.Name) or elt.id != gen.target.id:
+            return None
+        call = gen.iter
+        if not isinstance(call, ast.Call) or not isinstance(call.func, ast.Name) or \
+           call.func.id not in ("range", "xrange") or len(call.keywords) > 0 or \
+           call.starargs is not None or call.kwargs is not None or \
+           not 1 <= len(call.args) <= 3:
+            return None
+        # the inner range cannot depend on the outer variable
+        forms = [ affine_form(arg, variables) for arg in call.args ]
+        if None in forms:
+            return None
+        if len(forms) == 1:
+            forms = [ { None: 0 } ] + forms
+        if len(forms) == 3:
+            if forms[2] != { None: 1 }: return None
+            forms = forms[:2]
+        bounds += forms
+    x, y = np.meshgrid(range(dim_x), range(dim_y), indexing="ij")
+    return [ form.get(None, 0) + form.get(variables[0], 0) * x + \
+             form.get(variables[1], 0) * y for form in bounds ]
+
+def check_uniform_dependency(args, mapping, ensemble_info, name2enm):
+    return describe_connection(args, mapping, ensemble_info, name2enm).is_uniform()
 
 def check_one_to_one(args, mapping, ensemble_info, name2enm):
-    dim_x, dim_y = ensemble_info['dim_x'], ensemble_info['dim_y']
-    mapping = ast2lambda(mapping, args, ensemble_info, name2enm)
-    # number of dimension
-    dim = 2
- 
-    mapped_indices = sorted(mapping(*tuple([ 0 for i in range(dim) ])))
-    # print mapped_indices
-    for i in range(dim_x):
-        for j in range(dim_y):
-            # double dimension
-            if len(mapping(i, j)) != 1:
-                return False
-    return True
+    return describe_connection(args, mapping, ensemble_info, name2enm).is_one_to_one()
 
 def process_ensemble_share_weight(all_functions, function_ast):
     # find directly in the function
@@ -345,7 +435,94 @@ def process_ensemble_share_weight(all_functions, function_ast):
     return False
 
 
-def process_add_connection(filename, name2enm):
+class LibraryAnalysis(object):
+    """
+    program independent analysis of a library file: the neuron analyzers
+    with the fields of each neuron type, and the connection (args, mapping,
+    share_weights) of each layer type. It is done once per process for all
+    the programs compiled against the same library; the fields are also
+    persisted in the compilation cache, keyed by the hash of the library
+    and of the compiler sources (ast_matcher.py, templates.py, ...) the
+    analysis runs
+    """
+    def __init__(self, filename, source, options=None):
+        super(LibraryAnalysis, self).__init__()
+        self.filename = filename
+        self.AST = ast.parse(source)
+        sha = hashlib.sha1(source)
+        for file_name in compile_cache.compiler_sources():
+            fread = open(file_name, "rb")
+            sha.update("\0" + os.path.basename(file_name) + "\0" + fread.read())
+            fread.close()
+        self.key = sha.hexdigest()
+
+        # fields of the neuron types
+        cache_dir = None
+        if options is not None and not getattr(options, "NO_CACHE", False):
+            cache_dir = getattr(options, "CACHE_DIR", None) or compile_cache.CACHE_DIR
+        entry = "lib-%s.json" % self.key
+        fields = None
+        if cache_dir is not None:
+            fields = compile_cache.load_entry(cache_dir, entry)
+        self.neuron_analyzers = { }
+        for neuron_ast in extract_neuron_classes(self.AST):
+            neuron_fields = None if fields is None else fields[neuron_ast.name]
+            self.neuron_analyzers[neuron_ast.name] = \
+                    NeuronAnalyzer(neuron_ast, options, neuron_fields)
+        if fields is None:
+            self.analyze_fields()
+            if cache_dir is not None:
+                compile_cache.store_entry(cache_dir, entry, \
+                        dict((name, analyzer.fields) for name, analyzer \
+                             in self.neuron_analyzers.iteritems()))
+
+        # connections of the layer types
+        self.conn_types = { }
+        all_functions = dict(map(lambda x: (x.name, x), extract_functions(self.AST)))
+        for function_ast in all_functions.itervalues():
+            layer_name, args, mapping = \
+                    process_add_connection_helper(all_functions, function_ast)
+            if layer_name is not None:
+                share_weights = process_ensemble_share_weight(all_functions, function_ast)
+                self.conn_types[layer_name] = (args, mapping, share_weights)
+
+    def activate(self):
+        """make the neuron analyzers of this library the current ones"""
+        neuron_analyzers.clear()
+        neuron_analyzers.update(self.neuron_analyzers)
+
+    def analyze_fields(self):
+        self.activate()
+        # process the fields of the neuron base types
+        neuron_analyzers['Neuron'].delete_unused_fields()
+        for name, neuron_analyzer in neuron_analyzers.iteritems():
+           neuron_analyzer.init_fields()
+
+        # delete unused variables
+        print "+++++++++++++++++++++++++++++++++++++++++++"
+        for name, neuron_analyzer in neuron_analyzers.iteritems():
+           neuron_analyzer.delete_unused_fields()
+        print "+++++++++++++++++++++++++++++++++++++++++++"
+
+        # DOING SECOND TIME TO GET THE BASE's VARIABLES
+        # process the fields of the neuron base types
+        for name, neuron_analyzer in neuron_analyzers.iteritems():
+           neuron_analyzer.init_fields()
+           # print "-------------->", neuron_analyzer.name, neuron_analyzer.fields
+
+''' analyses of the library files, keyed by (path, hash of the content) '''
+libraries = { }
+
+def load_library(filename, options=None):
+    source = open(filename, "r")
+    content = source.read()
+    source.close()
+    key = (os.path.abspath(filename), hashlib.sha1(content).hexdigest())
+    if key not in libraries:
+        libraries[key] = LibraryAnalysis(filename, content, options)
+    return libraries[key]
+
+def process_add_connection(filename, name2enm, options=None):
     """TODO: Docstring for process_add_connection.
     :returns: TODO
 
@@ -353,13 +530,10 @@ def process_add_connection(filename, name2enm):
     conn_types = { }
 
     print "ADD CONNECTION ----------------------------"
-    all_functions = dict(map(lambda x: (x.name, x), extract_functions(filename)))
-    for function_ast in all_functions.itervalues():
-        layer_name, args, mapping = \
-                process_add_connection_helper(all_functions, function_ast)
-        if layer_name is not None:
-            share_weights = process_ensemble_share_weight(all_functions, function_ast)
-            conn_types[layer_name] = (args, mapping, share_weights)
+    library = load_library(filename, options)
+    for layer_name, (args, mapping, share_weights) in library.conn_types.iteritems():
+        # the mapping is substituted in place for the ensembles of the program
+        conn_types[layer_name] = (args, deepcopy(mapping), share_weights)
 
     # review the mapping functions for layer connections
     for layer, (args, mappings, share_weights) in conn_types.iteritems():
@@ -368,50 +542,73 @@ def process_add_connection(filename, name2enm):
         print "args: ", args
         print "share weights: ", share_weights
         print "conn: ", ast_dump(mappings)
+
+    # describe the connections of every ensemble
+    for enm in name2enm.itervalues():
+        ensemble = enm[-1]
+        if ensemble['type'] in conn_types:
+            args, mapping, _ = conn_types[ensemble['type']]
+            ensemble['connection'] = \
+                    describe_connection(args, mapping, ensemble, name2enm)
+            print "ensemble %s: %s" % (ensemble['name'], ensemble['connection'])
     print "------------------------------------------"
     return conn_types
 
+''' (ensemble_info, name2enm, conn_types) of the running process_lib '''
+lib_state = None
+
+def analyze_ensemble(index):
+    """forward and backward code trees of the index-th ensemble"""
+    ensemble_info, name2enm, conn_types = lib_state
+    ensemble = ensemble_info[index]
+    _name, _type, _prev, _dim_x, _dim_y, _neuron_type = ensemble[:6]
+    analyzer = neuron_analyzers[_neuron_type]
+    conn_type = None
+    share_weights = False
+    if _type in conn_types:
+        _, conn_type, share_weights = conn_types[_type]
+    return analyzer.analyze(ensemble, name2enm, conn_type, share_weights)
+
+def analyze_worker(index):
+    result = profiler.measure_worker(analyze_ensemble, index)
+    # the log of a worker is not lost when the pool is torn down
+    sys.stdout.flush()
+    return result
+
 def process_lib(filename, ensemble_info, name2enm, conn_types, options):
     """
     read in a library file parse all neuron types,
     and their associated forward/backward functions
     """
-    # create neuron analyzer for each neuron subtype
-    for neuron_ast in extract_neuron_classes(filename):
-        neuron_analyzers[neuron_ast.name] = NeuronAnalyzer(neuron_ast, options)
-    
-    # process the fields of the neuron base types
-    neuron_analyzers['Neuron'].delete_unused_fields()
-    for name, neuron_analyzer in neuron_analyzers.iteritems():
-       neuron_analyzer.init_fields()
-
-    # delete unused variables
-    print "+++++++++++++++++++++++++++++++++++++++++++"
-    for name, neuron_analyzer in neuron_analyzers.iteritems():
-       neuron_analyzer.delete_unused_fields()
-    print "+++++++++++++++++++++++++++++++++++++++++++"
-
-    # DOING SECOND TIME TO GET THE BASE's VARIABLES
-    # process the fields of the neuron base types
-    for name, neuron_analyzer in neuron_analyzers.iteritems():
-       neuron_analyzer.init_fields()
-       # print "-------------->", neuron_analyzer.name, neuron_analyzer.fields
-    
+    # neuron analyzer of each neuron subtype, with its fields analyzed
+    library = load_library(filename, options)
+    library.activate()
+    for neuron_analyzer in neuron_analyzers.itervalues():
+        neuron_analyzer.set_options(options)
+
     print "###########################################"
     forward_codes = { }
     backward_codes = { }
     fp_codes = [ ]
     bp_codes = [ ]
 
-    for ensemble in ensemble_info:
-        _name, _type, _prev, _dim_x, _dim_y, _neuron_type = ensemble[:6]
-        # print neuron_analyzers
-        analyzer = neuron_analyzers[_neuron_type]
-        conn_type = None
-        share_weights = False
-        if _type in conn_types:
-            _, conn_type, share_weights = conn_types[_type]
-        fp_code_node, bp_code_node = analyzer.analyze(ensemble, name2enm, conn_type, share_weights)
+    global lib_state
+    lib_state = (ensemble_info, name2enm, conn_types)
+    jobs = getattr(options, "JOBS", 1) or 1
+    if jobs > 1 and len(ensemble_info) > 1:
+        # the workers fork with lib_state, only the code trees come back
+        pool = multiprocessing.Pool(min(jobs, len(ensemble_info)))
+        results = pool.map(analyze_worker, range(len(ensemble_info)))
+        pool.close()
+        pool.join()
+        results = profiler.add_worker_peaks(results)
+    else:
+        results = map(analyze_ensemble, range(len(ensemble_info)))
+    lib_state = None
+
+    # merged in the order of the ensembles, whoever finished first
+    for ensemble, (fp_code_node, bp_code_node) in zip(ensemble_info, results):
+        _name = ensemble[0]
         forward_codes[_name] = fp_code_node
         backward_codes[_name] = bp_code_node
         fp_codes.append(fp_code_node)
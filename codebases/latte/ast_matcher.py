@@ -1,4 +1,3 @@
-from copy import deepcopy
 import ast, inspect
 
 ENABLE_AST_MATCH = True
@@ -7,32 +6,129 @@ def set_ast_match(ast_match_flag):
     global ENABLE_AST_MATCH
     ENABLE_AST_MATCH = ast_match_flag
 
-class BinOpCounter(ast.NodeVisitor):
+def is_commutative(node):
+    return isinstance(node, ast.BinOp) and \
+           (isinstance(node.op, ast.Add) or isinstance(node.op, ast.Mult))
+
+def flatten_chain(node):
+    """operands of an associative chain of the same add/mul, in source
+    order, e.g. a + (b * c + d) gives [ a, b * c, d ]"""
+    def flatten(kid):
+        if is_commutative(kid) and type(kid.op) == type(node.op):
+            return flatten(kid.left) + flatten(kid.right)
+        return [ kid ]
+    return flatten(node)
+
+def build_chain(op, operands):
+    """left-associative chain of operands joined by op"""
+    chain = operands[0]
+    for operand in operands[1:]:
+        chain = ast.BinOp(left = chain, op = op, right = operand)
+    return chain
+
+def operand_key(node):
+    """coarse sort key of a chain operand: its node type, and its operator
+    if it is itself a binary operation"""
+    if isinstance(node, ast.BinOp):
+        return type(node).__name__ + "." + type(node.op).__name__
+    return type(node).__name__
+
+def is_wildcard(node):
+    return isinstance(node, ast.Name) and node.id.startswith('_') and len(node.id) > 1
+
+def is_ground(node):
+    """if node only matches the nodes structurally equal to it: it holds
+    no wildcard and no add/mul chain"""
+    return not any(is_wildcard(x) or is_commutative(x) for x in ast.walk(node))
+
+class CommutativeChains(ast.NodeVisitor):
+    """normal form of the add/mul chains of a template: the ground operands
+    of each chain, its other concrete operands stably sorted by
+    operand_key, and its wildcards"""
     def __init__(self):
-        super(BinOpCounter, self).__init__()
-        self.count = 0
+        super(CommutativeChains, self).__init__()
+        self.chains = {}
 
     def visit_BinOp(self, node):
-        self.generic_visit(node)
-        if isinstance(node.op, ast.Add) or isinstance(node.op, ast.Mult):
-            self.count += 1
-
-class ReorderByList(ast.NodeTransformer):
-    def __init__(self, reorderList):
-        super(ReorderByList, self).__init__()
-        self.count = 0
-        self.reorderList = reorderList
-
-    def visit_BinOp(self, node):
-        self.generic_visit(node)
-        # change the order or add/mul since they are commutative
-        if isinstance(node.op, ast.Add) or isinstance(node.op, ast.Mult):
-            if self.reorderList[self.count]:
-                node.left, node.right = node.right, node.left
-            self.count += 1
-        return node
-
-class ReorderBinOp(ast.NodeTransformer):
+        if not is_commutative(node):
+            return self.generic_visit(node)
+        operands = flatten_chain(node)
+        concrete = [ x for x in operands if not is_wildcard(x) ]
+        ground = [ x for x in concrete if is_ground(x) ]
+        concrete = sorted([ x for x in concrete if not is_ground(x) ], key=operand_key)
+        wildcards = [ x for x in operands if is_wildcard(x) ]
+        self.chains[id(node)] = (ground, concrete, wildcards)
+        for operand in operands:
+            self.visit(operand)
+
+''' ids handed out to distinct structures, see structure_id; emptied by
+clear_structures, STRUCTURES_EPOCH counts how many times '''
+STRUCTURES = {}
+STRUCTURES_EPOCH = 0
+
+def clear_structures():
+    """forget the ids handed out so far, which also invalidates the ids
+    cached on the nodes (e.g. those of the memoized templates)"""
+    global STRUCTURES_EPOCH
+    STRUCTURES.clear()
+    STRUCTURES_EPOCH += 1
+
+def structure_id(value):
+    """
+    id shared by all the structurally equal values (ast nodes, lists of
+    them or constants), i.e. two values have the same id iff their ast_dump
+    are equal; the id of a node is cached on it until a Rewriter visits it
+    or clear_structures is called
+    """
+    if isinstance(value, ast.AST):
+        epoch, sid = getattr(value, "_structure_id", (None, None))
+        if epoch != STRUCTURES_EPOCH:
+            key = (type(value).__name__,) + \
+                  tuple(structure_id(x) for _, x in ast.iter_fields(value))
+            sid = STRUCTURES.setdefault(key, len(STRUCTURES))
+            value._structure_id = (STRUCTURES_EPOCH, sid)
+        return sid
+    if isinstance(value, list):
+        key = ("list",) + tuple(structure_id(x) for x in value)
+    else:
+        key = (type(value).__name__, value)
+    return STRUCTURES.setdefault(key, len(STRUCTURES))
+
+class Rewriter(ast.NodeTransformer):
+    """NodeTransformer rewriting nodes in place, which invalidates the
+    structure ids and the normal chains cached on the nodes it visits"""
+    def generic_visit(self, node):
+        node.__dict__.pop("_structure_id", None)
+        node.__dict__.pop("_normal_chain", None)
+        return super(Rewriter, self).generic_visit(node)
+
+class NormalChain(object):
+    """
+    normal form of an add/mul chain of a target: its operands in source
+    order, grouped by operand_key and by structure_id, so that an operand
+    of a template only meets the operands it can match
+    """
+    def __init__(self, node):
+        super(NormalChain, self).__init__()
+        self.epoch = STRUCTURES_EPOCH
+        self.operands = flatten_chain(node)
+        self.sids = [ structure_id(x) for x in self.operands ]
+        self.by_key = {}
+        self.by_sid = {}
+        for k, operand in enumerate(self.operands):
+            self.by_key.setdefault(operand_key(operand), []).append(k)
+            self.by_sid.setdefault(self.sids[k], []).append(k)
+
+def normal_chain(node):
+    """NormalChain of node, built once per node until a Rewriter visits it
+    or clear_structures is called"""
+    chain = getattr(node, "_normal_chain", None)
+    if chain is None or chain.epoch != STRUCTURES_EPOCH:
+        chain = NormalChain(node)
+        node._normal_chain = chain
+    return chain
+
+class ReorderBinOp(Rewriter):
     def visit_BinOp(self, node):
         self.generic_visit(node)
         # change the order or add/mul since they are commutative
@@ -42,7 +138,7 @@ class ReorderBinOp(ast.NodeTransformer):
                 node.left, node.right = node.right, node.left
         return node
 
-class ExpandAugAssign(ast.NodeTransformer):
+class ExpandAugAssign(Rewriter):
     def visit_AugAssign(self, node):
         self.generic_visit(node)
         assign_node = ast.Assign( \
@@ -55,7 +151,7 @@ class ExpandAugAssign(ast.NodeTransformer):
         )
         return assign_node
 
-class RewriteName(ast.NodeTransformer):
+class RewriteName(Rewriter):
     """change name of a node"""
     def __init__(self, old_name, new_name):
         super(RewriteName, self).__init__()
@@ -68,7 +164,7 @@ class RewriteName(ast.NodeTransformer):
             node.id = self.new_name
         return node
 
-class RewriteAttribute(ast.NodeTransformer):
+class RewriteAttribute(Rewriter):
     """change name of a node"""
     def __init__(self, old_name, new_name):
         super(RewriteAttribute, self).__init__()
@@ -81,7 +177,7 @@ class RewriteAttribute(ast.NodeTransformer):
             node.attr = self.new_name
         return node
 
-class SubstituteNameToNum(ast.NodeTransformer):
+class SubstituteNameToNum(Rewriter):
     """change name of a node"""
     def __init__(self, old_name, new_name):
         super(SubstituteNameToNum, self).__init__()
@@ -95,7 +191,7 @@ class SubstituteNameToNum(ast.NodeTransformer):
             return node
         return node
 
-class SubstituteAttributeToNum(ast.NodeTransformer):
+class SubstituteAttributeToNum(Rewriter):
     """change name of a node"""
     def __init__(self, owner, attr, value):
         super(SubstituteAttributeToNum, self).__init__()
@@ -112,6 +208,16 @@ class SubstituteAttributeToNum(ast.NodeTransformer):
             return node
         return node
 
+def normalize(node):
+    """node with its AugAssign expanded to Assign, the expansion is done
+    once and kept on the node"""
+    expanded = getattr(node, "_expanded", None)
+    if expanded is None:
+        expanded = ExpandAugAssign().visit(node)
+        node._expanded = expanded
+        expanded._expanded = expanded
+    return expanded
+
 def ast_parse_file(filename):
     f = open(filename, "r")
     AST = ast.parse(f.read())
@@ -145,11 +251,121 @@ def stmt_walk(node):
         for stmt in node.body:
             yield stmt
 
+''' template instances built so far, keyed by (template function, args) '''
+TEMPLATE_CACHE = {}
+
+def clear_template_cache():
+    TEMPLATE_CACHE.clear()
+
+def node_name(node):
+    """name of a called function or of an accessed attribute (without its
+    owner), None for wildcards and other nodes"""
+    if isinstance(node, ast.Call):
+        return node_name(node.func)
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    if isinstance(node, ast.Name) and not is_wildcard(node):
+        return node.id
+    return None
+
+def dispatch_names(stmt):
+    """
+    (root type, names) of a statement for the template dispatch, e.g.
+    ("Assign", [ "FullyConnectedLayer", "fc1" ]) for
+    fc1 = FullyConnectedLayer(..) and ("For", [ "backward_adj" ]) for
+    for prev in self.backward_adj; AugAssign is dispatched as the Assign
+    it is expanded to
+    """
+    if isinstance(stmt, ast.Assign):
+        names = [ node_name(stmt.targets[0]) ]
+        if isinstance(stmt.value, ast.Call):
+            names.insert(0, node_name(stmt.value))
+        return "Assign", names
+    if isinstance(stmt, ast.AugAssign):
+        return "Assign", [ node_name(stmt.target) ]
+    if isinstance(stmt, ast.Expr):
+        if is_wildcard(stmt.value):
+            return None, []
+        if isinstance(stmt.value, ast.Call):
+            return "Expr", [ node_name(stmt.value) ]
+        return "Expr", []
+    if isinstance(stmt, ast.For):
+        return "For", [ node_name(stmt.iter) ]
+    return type(stmt).__name__, []
+
+def first_stmt(tgt):
+    """statement a template has to match first when matched against tgt"""
+    if isinstance(tgt, ast.Module):
+        tgt = tgt.body
+    if isinstance(tgt, list):
+        return tgt[0] if len(tgt) > 0 else None
+    return tgt
+
+class TemplateIndex(object):
+    """
+    templates bucketed by the dispatch key of their first statement,
+    (root type, name of the called function or assigned/iterated attribute),
+    so that a statement is only checked against the templates that can
+    possibly match it; templates keep their registration order
+    """
+    def __init__(self, templates):
+        super(TemplateIndex, self).__init__()
+        self.templates = list(templates)
+        self.buckets = {}
+        for tmpl in self.templates:
+            self.buckets.setdefault(tmpl.dispatch_key, []).append(tmpl)
+
+    def candidates(self, stmt):
+        if stmt is None:
+            return []
+        kind, names = dispatch_names(stmt)
+        keys = [ (None, None), (kind, None) ] + \
+               [ (kind, name) for name in names if name is not None ]
+        found = set()
+        for key in keys:
+            found.update(self.buckets.get(key, []))
+        return [ tmpl for tmpl in self.templates if tmpl in found ]
+
+    def match(self, tgt):
+        """first template matching tgt, None if there is none"""
+        for tmpl in self.candidates(first_stmt(tgt)):
+            if tmpl.match(tgt):
+                return tmpl
+        return None
+
+    def prefix_of(self, tgt):
+        """first template matching a prefix of tgt, None if there is none"""
+        stmt = tgt
+        if not isinstance(tgt, list) and "body" in tgt._fields:
+            stmt = tgt.body
+        for tmpl in self.candidates(first_stmt(stmt)):
+            if tmpl.prefix_of(tgt):
+                return tmpl
+        return None
+
+    def matchall(self, tgt):
+        """ASTTemplate.matchall of every template in a single walk over the
+        statements of tgt, returns the templates that matched"""
+        for tmpl in self.templates:
+            tmpl.matches = []
+        for tmpl in self.candidates(first_stmt(tgt)):
+            if tmpl.match(tgt):
+                tmpl.matches.append(tmpl.wildcard)
+        for stmt in stmt_walk(tgt):
+            for tmpl in self.candidates(stmt):
+                if tmpl.match(stmt):
+                    tmpl.matches.append(tmpl.wildcard)
+        return [ tmpl for tmpl in self.templates if len(tmpl.matches) > 0 ]
+
 def template(tmpl_func):
-    """wrapper around templates"""
+    """wrapper around templates, each instance is built once per process
+    and shared by all the callers passing the same arguments"""
     def template_wrapper(*args):
-        source = inspect.getsource(tmpl_func)
-        return ASTTemplate(source, *args)
+        key = (tmpl_func, args)
+        if key not in TEMPLATE_CACHE:
+            source = inspect.getsource(tmpl_func)
+            TEMPLATE_CACHE[key] = ASTTemplate(source, *args)
+        return TEMPLATE_CACHE[key]
 
     return template_wrapper
 
@@ -161,6 +377,7 @@ class ASTTemplate(object):
         self.ast = ast_parse_source(source)
         self.ast = self.ast.body[0]                     # find wrapper function
         self.num_stmts = len(self.ast.body)
+        self.args = args
         
         # preprocessing: replace arguments
         assert len(args) == len(self.ast.args.args)
@@ -173,26 +390,15 @@ class ASTTemplate(object):
         
         self.fname = self.ast.name                       # find template name
 
-        self.asts = []
-        # get number of add/mul operations
-        # compute all the permutations
-        visitor = BinOpCounter()
+        # add/mul chains are matched up to the order of their operands
+        visitor = CommutativeChains()
         visitor.visit(self.ast)
-        self._gen_all_asts([], visitor.count)
-
-        # # try printing all permuted asts
-        # for tpl_ast in self.asts:
-        #     for tpl_stmt in tpl_ast:
-        #         print ast.dump(tpl_stmt)
-        #     print "------------"
+        self.chains = visitor.chains
 
-    def _gen_all_asts(self, reorderList, remain):
-        if remain == 0:
-            self.asts.append(ReorderByList(reorderList).visit(deepcopy(self.ast)).body)
-            return
-        # recursively generate all asts
-        self._gen_all_asts(reorderList + [ False ], remain - 1)
-        self._gen_all_asts(reorderList + [ True  ], remain - 1)
+        # key of the first statement for TemplateIndex
+        kind, names = dispatch_names(self.ast.body[0])
+        names = [ name for name in names if name is not None ]
+        self.dispatch_key = (kind, names[0] if len(names) > 0 else None)
 
     def __str__(self):
         return self.fname.strip("template_")
@@ -232,39 +438,52 @@ class ASTTemplate(object):
         # for semantic matching
         if isinstance(tgt, list):
             for i, t in enumerate(tgt):
-                tgt[i] = ExpandAugAssign().visit(t)
+                tgt[i] = normalize(t)
         else:
-            tgt = ExpandAugAssign().visit(tgt)
+            tgt = normalize(tgt)
 
         """ match ast with template """
-        for tpl_ast in self.asts:
-            # see if it matches with any of the possible combinations of
-            # asts
-            self.wildcard = dict()
-            if self._match(tpl_ast, tgt):
-                return True
-        return False
+        self.wildcard = dict()
+        return self._match(self.ast.body, tgt)
 
     def _match(self, tpl, tgt):
-        """ match helper function """
-        if self._set_wildcard(tpl, tgt):
+        """ match helper function, keeps the wildcards bound by the first
+        way tpl matches tgt """
+        for _ in self._matches(tpl, tgt):
             return True
+        return False
+
+    def _matches(self, tpl, tgt):
+        """
+        generator: yields once for each way tpl matches tgt, with
+        self.wildcard holding the bindings of that way, so that a later
+        mismatch can backtrack into an earlier add/mul chain
+        """
+        wildcard = dict(self.wildcard)
+        if self._set_wildcard(tpl, tgt):
+            yield
+            self.wildcard = wildcard
+            return
 
         if isinstance(tpl, str) and isinstance(tgt, str):
             # direct string comparison
-            return tpl == tgt
+            if tpl == tgt: yield
+            return
 
         if isinstance(tpl, bool) and isinstance(tgt, bool):
             # direct boolean comparison
-            return tpl == tgt
+            if tpl == tgt: yield
+            return
 
         if isinstance(tpl, int) and isinstance(tgt, int):
             # direct int comparison
-            return tpl == tgt
+            if tpl == tgt: yield
+            return
 
         if isinstance(tpl, float) and isinstance(tgt, float):
             # direct float comparison
-            return tpl == tgt
+            if tpl == tgt: yield
+            return
 
         # deal with wrappers
         if isinstance(tgt, ast.Module):
@@ -278,41 +497,104 @@ class ASTTemplate(object):
         
         # check number of stmts
         if len(tpl) != len(tgt):
-            # print "1"
-            return False
-        
-        for i in xrange(len(tpl)):
-            tpl_node = tpl[i]
-            tgt_node = tgt[i]
-            if self._set_wildcard(tpl_node, tgt_node):
-                continue
+            return
+
+        for _ in self._matches_each(self._matches_node, tpl, tgt, 0):
+            yield
+
+    def _matches_each(self, matches, tpl, tgt, i):
+        """ways tpl[k] matches tgt[k] for all k >= i, with matches"""
+        if i == len(tpl):
+            yield
+            return
+        for _ in matches(tpl[i], tgt[i]):
+            for _ in self._matches_each(matches, tpl, tgt, i + 1):
+                yield
+
+    def _matches_node(self, tpl_node, tgt_node):
+        wildcard = dict(self.wildcard)
+        if self._set_wildcard(tpl_node, tgt_node):
+            yield
+            self.wildcard = wildcard
+        elif id(tpl_node) in self.chains:
+            for _ in self._matches_chain(tpl_node, tgt_node):
+                yield
+        else:
+            # check node match types
+            if type(tpl_node) != type(tgt_node):
+                return
+
+            # avoid comparing None
+            if tpl_node is None:
+                yield
+                return
+
+            # compare fields
+            tpl_kids = [ x for _, x in ast.iter_fields(tpl_node) ]
+            tgt_kids = [ x for _, x in ast.iter_fields(tgt_node) ]
+            if len(tpl_kids) != len(tgt_kids):
+                return
+            for _ in self._matches_each(self._matches, tpl_kids, tgt_kids, 0):
+                yield
+
+    def _matches_chain(self, tpl, tgt):
+        """
+        ways an add/mul chain of the template matches any order of the
+        operands of tgt: each ground operand of the template takes the
+        first unused operand of tgt equal to it, without any search, then
+        see _matches_operands
+        """
+        if not is_commutative(tgt) or type(tgt.op) != type(tpl.op):
+            return
+        ground, concrete, wildcards = self.chains[id(tpl)]
+        chain = normal_chain(tgt)
+        if len(chain.operands) < len(ground) + len(concrete) + len(wildcards):
+            return
+        used = [ False ] * len(chain.operands)
+        for tpl_operand in ground:
+            for k in chain.by_sid.get(structure_id(tpl_operand), []):
+                if not used[k]: break
             else:
-                # check node match types
-                if type(tpl_node) != type(tgt_node):
-                    # print "2"
-                    # print tpl_node
-                    # print tgt_node
-                    return False
-
-                # avoid comparing None
-                if tpl_node is None:
-                    continue
-
-                # compare fields
-                tpl_kids = list(ast.iter_fields(tpl_node))
-                tgt_kids = list(ast.iter_fields(tgt_node))
-                if len(tpl_kids) != len(tgt_kids):
-                    # print "3"
-                    return False
-                for i in xrange(len(tpl_kids)):
-                    _, tpl_value = tpl_kids[i]
-                    _, tgt_value = tgt_kids[i]
-                    if not self._match(tpl_value, tgt_value):
-                        # print "4"
-                        # print ast_dump(tpl_value)
-                        # print ast_dump(tgt_value)
-                        return False
-        return True
+                return
+            used[k] = True
+        for _ in self._matches_operands(tpl.op, chain, concrete, wildcards, used):
+            yield
+
+    def _matches_operands(self, op, chain, concrete, wildcards, used):
+        """
+        each other concrete operand takes an unused operand of chain with
+        the same operand_key, then each wildcard but the last takes one of
+        the unused operands and the last wildcard absorbs all the others as
+        a chain. Only these take a search, which tries the operands in
+        source order and a single one of structurally equal operands
+        """
+        free = used.count(False)
+        if free < len(concrete) + len(wildcards):
+            return
+        if len(concrete) == 0 and len(wildcards) == 0:
+            if free == 0: yield
+            return
+        if len(concrete) == 0 and len(wildcards) == 1:
+            remain = [ x for k, x in enumerate(chain.operands) if not used[k] ]
+            for _ in self._matches(wildcards[0], build_chain(op, remain)):
+                yield
+            return
+        if len(concrete) > 0:
+            tpl_operand, concrete = concrete[0], concrete[1:]
+            candidates = chain.by_key.get(operand_key(tpl_operand), [])
+        else:
+            tpl_operand, wildcards = wildcards[0], wildcards[1:]
+            candidates = range(len(chain.operands))
+        tried = set()
+        for k in candidates:
+            if used[k] or chain.sids[k] in tried:
+                continue
+            tried.add(chain.sids[k])
+            used[k] = True
+            for _ in self._matches(tpl_operand, chain.operands[k]):
+                for _ in self._matches_operands(op, chain, concrete, wildcards, used):
+                    yield
+            used[k] = False
 
     def _set_wildcard(self, tpl, tgt):
         # using one wildcard to match a list of argument
@@ -350,7 +632,7 @@ class ASTTemplate(object):
                 #     print ast_dump(self.wildcard[tpl.id[1:]])
                 #     print ast_dump(value)
                 #     print "-------------------------------------->"
-                return ast_dump(self.wildcard[tpl.id[1:]]) == ast_dump(value)
+                return structure_id(self.wildcard[tpl.id[1:]]) == structure_id(value)
             else:
                 self.wildcard[tpl.id[1:]] = value
                 return True
@@ -358,3 +640,59 @@ class ASTTemplate(object):
             # return True
 
         return False
+
+if __name__ == "__main__":
+    # self-check: chain matching agrees with matching the template in each
+    # of the 2^k orders of its add/mul operands
+    from copy import deepcopy
+    import itertools
+
+    class SwapOperands(ast.NodeTransformer):
+        def __init__(self, swaps):
+            super(SwapOperands, self).__init__()
+            self.swaps = list(swaps)
+
+        def visit_BinOp(self, node):
+            self.generic_visit(node)
+            if is_commutative(node) and self.swaps.pop(0):
+                node.left, node.right = node.right, node.left
+            return node
+
+    def permutation_match(tmpl, tgt):
+        count = len([ x for x in ast.walk(tmpl.ast) if is_commutative(x) ])
+        chains, tmpl.chains = tmpl.chains, {}
+        try:
+            for swaps in itertools.product([ False, True ], repeat = count):
+                tmpl.wildcard = dict()
+                if tmpl._match(SwapOperands(swaps).visit(deepcopy(tmpl.ast)).body, tgt):
+                    return True
+            return False
+        finally:
+            tmpl.chains = chains
+
+    cases = [
+        ("_a * _b + _a", "x * y + y"),
+        ("_a * _b + _a", "y * x + y"),
+        ("_a * _b + _a", "y + x * y"),
+        ("_a * _b + _a", "x * y + z"),
+        ("_a + _a * _b", "x * y + y"),
+        ("_a * _b + _b * _c", "x * y + z * x"),
+        ("_a * _b + _b * _c", "x * y + z * w"),
+        ("_a * _a + _b", "x * y + x"),
+        ("_a * _a + _b", "y + x * x"),
+        ("a[_i] * _b + _b", "c + a[i] * c"),
+        ("a[_i] * _b + _b", "a[i] * c + d"),
+    ]
+    for tpl_src, tgt_src in cases:
+        tmpl = ASTTemplate("def template_check():\n    " + tpl_src + "\n")
+        tgt = ast_parse_source(tgt_src).body
+        expected = permutation_match(tmpl, tgt)
+        assert tmpl.match(tgt) == expected, (tpl_src, tgt_src, expected)
+
+    # ground operands are looked up without any search, whatever the
+    # length of the chain; the last wildcard takes the rest in source order
+    names = [ "v%d" % k for k in range(12) ]
+    tmpl = ASTTemplate("def template_check():\n    " + " + ".join(names[:10]) + " + _r\n")
+    assert tmpl.match(ast_parse_source(" + ".join(reversed(names))).body)
+    assert ast_dump(tmpl.wildcard["r"]) == ast_dump(ast_parse_source("v11 + v10").body[0].value)
+    print "ast_matcher self-check passed"
@@ -0,0 +1,295 @@
+#!/usr/bin/env python2
+'''
+    Empirical autotuner of the generator options
+'''
+import json
+import os, sys
+import pipes
+import random
+import shlex
+import subprocess
+import time
+from optparse import OptionParser
+from ast_matcher import *
+from templates import *
+from term import *
+
+''' root of codebases, where Latte.h and the Makefile are '''
+CODEBASES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+''' default file of the tuned configurations '''
+TUNING_FILE = os.path.join(CODEBASES_DIR, ".latte_tuning.json")
+
+''' generator options searched by the tuner, with their command line flags '''
+TUNED_OPTIONS = [
+    ("MKL_FLAG", "-m"),
+    ("DP_FLAG", "-b"),
+    ("TILING_FLAG", "-t"),
+    ("FUSION_FLAG", "-f"),
+    ("NWORKERS", "-w"),
+    ("TILE_SIZE", "--tile-size"),
+    ("OMP_SCHEDULE", "--omp-schedule"),
+    ("OMP_CHUNK", "--omp-chunk")
+]
+
+''' defaults of the tuned options; the generator parses them with a None
+default so that the options given on the command line are told apart '''
+TUNED_DEFAULTS = {
+    "MKL_FLAG": False,
+    "DP_FLAG": False,
+    "TILING_FLAG": False,
+    "FUSION_FLAG": False,
+    "NWORKERS": 1,
+    "TILE_SIZE": 5,
+    "OMP_SCHEDULE": "static",
+    "OMP_CHUNK": 2
+}
+
+def network_shape(program_file):
+    """
+    key of the shape of the network of a program: the type, dimensions and
+    neuron type of its layers, from the first one on
+    """
+    program_templates.matchall(ast_parse_file(program_file))
+    layers = { }
+    for patn_layer in layer_templates:
+        for layer in patn_layer.matches:
+            layers[layer['name']] = (layer.get('prev'), "%s(%dx%d%s)" % \
+                    (str(patn_layer).strip("template_"), layer['dim_x'], layer['dim_y'], \
+                     "," + layer['Neuron'] if 'Neuron' in layer else ""))
+    shape = [ ]
+    prev = None
+    while True:
+        next_layers = [ name for name, (p, _) in layers.iteritems() if p == prev ]
+        if len(next_layers) != 1: break
+        prev = next_layers[0]
+        shape.append(layers[prev][1])
+    assert len(shape) == len(layers), "layers of %s are not a chain" % program_file
+    return " ".join(shape)
+
+def load_configs(tuning_file=None):
+    """tuned configurations of every network shape"""
+    tuning_file = tuning_file or TUNING_FILE
+    if not os.path.exists(tuning_file):
+        return { }
+    fread = open(tuning_file, "r")
+    configs = json.load(fread)
+    fread.close()
+    return configs
+
+def save_config(shape, config, tuning_file=None):
+    """store the tuned configuration of shape"""
+    tuning_file = tuning_file or TUNING_FILE
+    configs = load_configs(tuning_file)
+    configs[shape] = config
+    fwrite = open(tuning_file + ".tmp", "w")
+    json.dump(configs, fwrite, indent=2, sort_keys=True)
+    fwrite.close()
+    os.rename(tuning_file + ".tmp", tuning_file)
+
+def apply_config(options, config):
+    """
+    set the tuned options of config that are not given on the command
+    line, i.e. still None; returns the names set
+    """
+    applied = [ ]
+    for key, _ in TUNED_OPTIONS:
+        if key in config['options'] and getattr(options, key) is None:
+            setattr(options, key, config['options'][key])
+            applied.append(key)
+    return applied
+
+def apply_defaults(options):
+    """set the tuned options neither given nor tuned to their defaults"""
+    for key, _ in TUNED_OPTIONS:
+        if getattr(options, key) is None:
+            setattr(options, key, TUNED_DEFAULTS[key])
+
+def candidate_flags(candidate):
+    """generator flags of a candidate"""
+    flags = [ ]
+    for key, flag in TUNED_OPTIONS:
+        value = candidate[key]
+        if isinstance(value, bool):
+            if value: flags.append(flag)
+        else:
+            flags += [ flag, str(value) ]
+    return flags
+
+def candidates(options):
+    """
+    every combination of -m/-b/-t/-f, with the worker counts when
+    something runs in parallel, the tile sizes when tiling and the omp
+    schedules when batch items run in parallel
+    """
+    workers = [ int(w) for w in options.workers.split(",") ]
+    tile_sizes = [ int(s) for s in options.tile_sizes.split(",") ]
+    schedules = [ (s.split(":")[0], int(s.split(":")[1]) if ":" in s else 0) \
+                  for s in options.schedules.split(",") ]
+    found = [ ]
+    for mkl in (False, True):
+        for dp in (False, True):
+            for tiling in (False, True):
+                for fusion in ((False, True) if tiling else (False, )):
+                    for nworkers in (workers if dp or tiling else [ 1 ]):
+                        for tile_size in (tile_sizes if tiling else [ 5 ]):
+                            for schedule, chunk in (schedules if dp else [ ("static", 2) ]):
+                                found.append({
+                                    "MKL_FLAG": mkl,
+                                    "DP_FLAG": dp,
+                                    "TILING_FLAG": tiling,
+                                    "FUSION_FLAG": fusion,
+                                    "NWORKERS": nworkers,
+                                    "TILE_SIZE": tile_size,
+                                    "OMP_SCHEDULE": schedule,
+                                    "OMP_CHUNK": chunk
+                                })
+    if options.max_candidates > 0 and len(found) > options.max_candidates:
+        # a sample of the space, in its order
+        picked = random.Random(options.seed).sample(range(len(found)), options.max_candidates)
+        found = [ found[i] for i in sorted(picked) ]
+    return found
+
+def generate(options, program_file, exes):
+    """generate the program of every candidate in one generator --batch"""
+    generator = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generator.py")
+    batch_file = os.path.join(options.work_dir, "candidates.batch")
+    fwrite = open(batch_file, "w")
+    for candidate, exe in exes:
+        flags = shlex.split(options.generator_flags) + candidate_flags(candidate) + \
+                [ "--no-tuning", "--max-samples", str(options.samples) ]
+        fwrite.write(" ".join(map(pipes.quote, flags + [ program_file, exe + ".cpp" ])) + "\n")
+    fwrite.close()
+    log = open(os.path.join(options.work_dir, "generator.log"), "w")
+    code = subprocess.call([ sys.executable, generator, "--batch", batch_file ], \
+                           stdout=log, stderr=subprocess.STDOUT, cwd=CODEBASES_DIR)
+    log.close()
+    assert code == 0, "generator failed, see %s" % log.name
+
+def run(command, timeout, cwd, log_file):
+    """run command with its output in log_file, killed after timeout
+    seconds; returns its exit code, None when it timed out"""
+    log = open(log_file, "w")
+    proc = subprocess.Popen(command, cwd=cwd, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + timeout
+    timed_out = False
+    while proc.poll() is None:
+        if time.time() > deadline:
+            proc.kill()
+            proc.wait()
+            timed_out = True
+            break
+        time.sleep(0.05)
+    log.close()
+    return None if timed_out else proc.returncode
+
+def training_seconds(output):
+    """training time printed by a generated program, None if there is none"""
+    seconds, nanoseconds = None, 0
+    for line in output.splitlines():
+        if line.startswith("time for iter(s):"):
+            seconds = int(line.split(":")[1])
+        elif line.startswith("time for iter(ns):"):
+            nanoseconds = int(line.split(":")[1])
+    if seconds is None:
+        return None
+    return seconds + nanoseconds * 1e-9
+
+def measure(options, exe):
+    """best training time of repeated runs of exe, None if it fails"""
+    compile_command = options.compile.format(cpp=exe + ".cpp", exe=exe)
+    if run(shlex.split(compile_command), options.timeout, CODEBASES_DIR, exe + ".build.log") != 0:
+        return None
+    best = None
+    for _ in range(options.repeats):
+        if run([ exe ], options.timeout, CODEBASES_DIR, exe + ".log") != 0:
+            return None
+        fread = open(exe + ".log", "r")
+        seconds = training_seconds(fread.read())
+        fread.close()
+        if seconds is None:
+            return None
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+def tune(options, program_file):
+    shape = network_shape(program_file)
+    term.dump("SHAPE: %s" % shape, term.OKBLUE)
+    found = candidates(options)
+    if not os.path.isdir(options.work_dir):
+        os.makedirs(options.work_dir)
+    exes = [ (candidate, os.path.join(options.work_dir, "candidate%d" % i)) \
+             for i, candidate in enumerate(found) ]
+    print "%d candidates" % len(exes)
+    if options.dry_run:
+        for candidate, exe in exes:
+            print os.path.basename(exe), " ".join(candidate_flags(candidate))
+        return None
+
+    generate(options, program_file, exes)
+    best = None
+    for candidate, exe in exes:
+        seconds = measure(options, exe)
+        flags = " ".join(candidate_flags(candidate))
+        if seconds is None:
+            term.dump("%-12s FAILED %s" % (os.path.basename(exe), flags), term.FAIL)
+            continue
+        print "%-12s %12.6f seconds %s" % (os.path.basename(exe), seconds, flags)
+        if best is None or seconds < best[1]:
+            best = (candidate, seconds)
+
+    if best is None:
+        term.dump("no candidate ran", term.FAIL)
+        return None
+    config = {
+        "options": best[0],
+        "seconds": best[1],
+        "samples": options.samples,
+        "program": os.path.abspath(program_file),
+        "candidates": len(exes)
+    }
+    save_config(shape, config, options.tuning_file)
+    term.dump("BEST: %s (%f seconds)" % (" ".join(candidate_flags(best[0])), best[1]), \
+              term.OKGREEN)
+    return config
+
+if __name__ == "__main__":
+    usage = "usage: python autotune.py [options] py_script"
+    parser = OptionParser(usage=usage)
+    parser.add_option("", "--samples", action="store", type="int", dest="samples", \
+                      default=1000, help="number of training samples of every timed run.")
+    parser.add_option("", "--repeats", action="store", type="int", dest="repeats", \
+                      default=3, help="timed runs of every candidate, the fastest counts.")
+    parser.add_option("", "--workers", action="store", type="string", dest="workers", \
+                      default="1,2,4", help="worker counts to try.")
+    parser.add_option("", "--tile-sizes", action="store", type="string", dest="tile_sizes", \
+                      default="5,10,25", help="tile sizes of the x/y loops to try.")
+    parser.add_option("", "--schedules", action="store", type="string", dest="schedules", \
+                      default="static:2,static:8,dynamic:2", help="omp schedules of the \
+                      batch parallel loop to try, as schedule[:chunk].")
+    parser.add_option("", "--max-candidates", action="store", type="int", \
+                      dest="max_candidates", default=0, help="time a random sample of \
+                      this many candidates (default: all).")
+    parser.add_option("", "--seed", action="store", type="int", dest="seed", \
+                      default=0, help="seed of the sample of candidates.")
+    parser.add_option("", "--compile", action="store", type="string", dest="compile", \
+                      default="make -s {exe}", help="command compiling {cpp} into {exe}, \
+                      run in codebases (default: %default).")
+    parser.add_option("", "--timeout", action="store", type="float", dest="timeout", \
+                      default=600, help="seconds before a build or a run is given up.")
+    parser.add_option("", "--generator-flags", action="store", type="string", \
+                      dest="generator_flags", default="", help="flags passed to every \
+                      generation, e.g. --mini.")
+    parser.add_option("", "--work-dir", action="store", type="string", dest="work_dir", \
+                      default=os.path.join(CODEBASES_DIR, "tuning"), \
+                      help="directory of the candidate programs.")
+    parser.add_option("", "--tuning-file", action="store", type="string", dest="tuning_file", \
+                      default=TUNING_FILE, help="file of the tuned configurations.")
+    parser.add_option("", "--dry-run", action="store_true", dest="dry_run", \
+                      default=False, help="only list the candidates.")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        parser.error("incorrect number of arguments")
+    options.work_dir = os.path.abspath(options.work_dir)
+    tune(options, os.path.abspath(args[0]))
@@ -0,0 +1,83 @@
+'''
+    On-disk cache of the compiler
+'''
+import hashlib
+import json
+import os
+import shutil
+
+''' default cache directory, next to the latte package '''
+CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), \
+                         ".latte_cache")
+
+''' options that do not change the generated code '''
+UNHASHED_OPTIONS = set([ "verbose", "NO_CACHE", "CACHE_DIR", "BATCH", "PROFILE",
+                         "JOBS", "NO_TUNING", "TUNING_FILE" ])
+
+''' options naming a file the generated code depends on '''
+FILE_OPTIONS = [ "TILE_CONFIG" ]
+
+def compiler_sources():
+    """source files of the compiler, lib.py and templates.py included"""
+    path = os.path.dirname(os.path.abspath(__file__))
+    return sorted(os.path.join(path, name) for name in os.listdir(path) \
+                  if name.endswith(".py"))
+
+def fingerprint(program_file, options, sources=None):
+    """sha1 of the program, the compiler sources, the options and the
+    files named by the options"""
+    if sources is None: sources = compiler_sources()
+    values = vars(options)
+    option_files = [ values[key] for key in FILE_OPTIONS if values.get(key) is not None ]
+    sha = hashlib.sha1()
+    for file_name in [ program_file ] + sources + option_files:
+        fread = open(file_name, "rb")
+        sha.update(os.path.basename(file_name) + "\0" + fread.read() + "\0")
+        fread.close()
+    for key in sorted(values):
+        if key not in UNHASHED_OPTIONS:
+            sha.update("%s=%r\n" % (key, values[key]))
+    return sha.hexdigest()
+
+def entry_name(cache_dir, key, suffix):
+    return os.path.join(cache_dir, key + suffix)
+
+def load_entry(cache_dir, name):
+    """json value stored under name, None if there is none"""
+    file_name = os.path.join(cache_dir, name)
+    if not os.path.exists(file_name):
+        return None
+    fread = open(file_name, "r")
+    value = json.load(fread)
+    fread.close()
+    return value
+
+def store_entry(cache_dir, name, value):
+    """store a json value under name"""
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    file_name = os.path.join(cache_dir, name)
+    fwrite = open(file_name + ".tmp", "w")
+    json.dump(value, fwrite, indent=2, sort_keys=True)
+    fwrite.close()
+    os.rename(file_name + ".tmp", file_name)
+
+def lookup(cache_dir, key, cpp_file):
+    """copy the cached program of key to cpp_file and return the analysis
+    stored with it, None on a cache miss"""
+    cached_cpp = entry_name(cache_dir, key, ".cpp")
+    analysis = load_entry(cache_dir, key + ".json")
+    if analysis is None or not os.path.exists(cached_cpp):
+        return None
+    shutil.copyfile(cached_cpp, cpp_file)
+    return analysis
+
+def store(cache_dir, key, cpp_file, analysis):
+    """cache the generated cpp_file and its analysis under key"""
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cached_cpp = entry_name(cache_dir, key, ".cpp")
+    # the analysis is written last: an entry is only valid once it exists
+    shutil.copyfile(cpp_file, cached_cpp + ".tmp")
+    os.rename(cached_cpp + ".tmp", cached_cpp)
+    store_entry(cache_dir, key + ".json", analysis)
@@ -0,0 +1,369 @@
+'''
+    Connection descriptors between two ensembles
+'''
+import types
+import numpy as np
+
+class Connection(object):
+    """
+    Connectivity from each neuron (x, y) of an ensemble to the neurons
+    (i, j) of its previous ensemble, stored compactly instead of as
+    adjacency lists. Positions in the previous ensemble are also
+    addressed by their flat index i * prev_dim_y + j.
+    """
+    kind = None
+
+    def __init__(self, dim_x, dim_y, prev_dim_x, prev_dim_y):
+        super(Connection, self).__init__()
+        self.dim_x = dim_x
+        self.dim_y = dim_y
+        self.prev_dim_x = prev_dim_x
+        self.prev_dim_y = prev_dim_y
+        self.size = dim_x * dim_y
+        self.prev_size = prev_dim_x * prev_dim_y
+        self._csr = None            # (indptr, indices), see csr
+        self._readers = None        # csr of the transposed connection
+        self._pairs = None
+
+    def flat_indices(self, x, y):
+        """flat indices of the inputs of neuron (x, y)"""
+        raise NotImplementedError
+
+    def count(self, x, y):
+        return len(self.flat_indices(x, y))
+
+    def indices(self, x, y):
+        """iterate (i, j) of the inputs of neuron (x, y)"""
+        for k in self.flat_indices(x, y):
+            yield divmod(int(k), self.prev_dim_y)
+
+    def gather(self, buf, x, y):
+        """values of the inputs of neuron (x, y) from a buffer whose last
+        two dimensions are (prev_dim_x, prev_dim_y)"""
+        flat = buf.reshape(buf.shape[:-2] + (self.prev_size,))
+        return flat[..., self.flat_indices(x, y)]
+
+    def csr(self):
+        """(indptr, indices): the inputs of the neuron with flat index n
+        are indices[indptr[n]:indptr[n+1]], built once"""
+        if self._csr is None:
+            indices = [ self.flat_indices(x, y) for x in range(self.dim_x) \
+                                                for y in range(self.dim_y) ]
+            indptr = np.zeros(self.size + 1, dtype=np.int64)
+            indptr[1:] = np.cumsum([ len(x) for x in indices ])
+            indices = np.concatenate(indices).astype(np.int64) if self.size > 0 \
+                      else np.zeros(0, dtype=np.int64)
+            self._csr = (indptr, indices)
+        return self._csr
+
+    def pairs(self):
+        """(neurons, inputs) flat indices of every connection, as arrays of
+        the same length, None when fully connected"""
+        if self._pairs is None:
+            indptr, indices = self.csr()
+            self._pairs = (np.repeat(np.arange(self.size), np.diff(indptr)), indices)
+        return self._pairs
+
+    def forward_flat_indices(self, i, j):
+        """flat indices of the neurons reading input (i, j), from the
+        transposed csr"""
+        if self._readers is None:
+            neurons, inputs = self.pairs()
+            order = np.argsort(inputs, kind="mergesort")
+            indptr = np.zeros(self.prev_size + 1, dtype=np.int64)
+            indptr[1:] = np.cumsum(np.bincount(inputs, minlength=self.prev_size))
+            self._readers = (indptr, neurons[order])
+        indptr, readers = self._readers
+        k = i * self.prev_dim_y + j
+        return np.unique(readers[indptr[k]:indptr[k+1]])
+
+    def sum_inputs(self, inputs):
+        """sum of the connected inputs of every neuron, for inputs of shape
+        (batch_size, prev_dim_x, prev_dim_y)"""
+        neurons, flat = self.pairs()
+        batch = inputs.reshape(inputs.shape[0], -1)
+        sums = np.zeros((inputs.shape[0], self.size))
+        np.add.at(sums, (slice(None), neurons), batch[:, flat])
+        return sums.reshape(inputs.shape[0], self.dim_x, self.dim_y)
+
+    def scatter_inputs(self, grad, grad_inputs):
+        """add the value of every neuron in grad to each of its inputs"""
+        neurons, flat = self.pairs()
+        batch = grad.reshape(grad.shape[0], -1)
+        flat_inputs = grad_inputs.reshape(grad_inputs.shape[0], -1)
+        np.add.at(flat_inputs, (slice(None), flat), batch[:, neurons])
+
+    def is_uniform(self):
+        """every neuron reads the same set of inputs"""
+        first = sorted(self.flat_indices(0, 0))
+        for x in range(self.dim_x):
+            for y in range(self.dim_y):
+                if sorted(self.flat_indices(x, y)) != first:
+                    return False
+        return True
+
+    def is_one_to_one(self):
+        """every neuron reads exactly one input"""
+        for x in range(self.dim_x):
+            for y in range(self.dim_y):
+                if self.count(x, y) != 1:
+                    return False
+        return True
+
+    def __str__(self):
+        return "%s(%dx%d <- %dx%d)" % (self.kind, self.dim_x, self.dim_y, \
+                self.prev_dim_x, self.prev_dim_y)
+    __repr__ = __str__
+
+class DenseConnection(Connection):
+    """every neuron reads every input"""
+    kind = "dense"
+
+    def flat_indices(self, x, y):
+        return np.arange(self.prev_size)
+
+    def count(self, x, y):
+        return self.prev_size
+
+    def indices(self, x, y):
+        for i in range(self.prev_dim_x):
+            for j in range(self.prev_dim_y):
+                yield i, j
+
+    def gather(self, buf, x, y):
+        return buf
+
+    def forward_flat_indices(self, i, j):
+        return np.arange(self.size)
+
+    def pairs(self):
+        return None
+
+    def sum_inputs(self, inputs):
+        sums = inputs.reshape(inputs.shape[0], -1).sum(axis=1)
+        return np.tile(sums[:, None, None], (1, self.dim_x, self.dim_y))
+
+    def scatter_inputs(self, grad, grad_inputs):
+        grad_inputs += grad.reshape(grad.shape[0], -1).sum(axis=1)[:, None, None]
+
+    def is_uniform(self):
+        return True
+
+    def is_one_to_one(self):
+        return self.prev_size == 1
+
+class WindowConnection(Connection):
+    """neuron (x, y) reads the rectangle [lo_i, hi_i) x [lo_j, hi_j)"""
+    kind = "window"
+
+    def __init__(self, dim_x, dim_y, prev_dim_x, prev_dim_y, lo_i, hi_i, lo_j, hi_j):
+        super(WindowConnection, self).__init__(dim_x, dim_y, prev_dim_x, prev_dim_y)
+        # bounds of the window of each neuron, arrays of shape (dim_x, dim_y)
+        self.lo_i, self.hi_i = lo_i, hi_i
+        self.lo_j, self.hi_j = lo_j, hi_j
+
+    def window(self, x, y):
+        return self.lo_i[x, y], self.hi_i[x, y], self.lo_j[x, y], self.hi_j[x, y]
+
+    def flat_indices(self, x, y):
+        lo_i, hi_i, lo_j, hi_j = self.window(x, y)
+        rows = np.arange(lo_i, hi_i)[:, None] * self.prev_dim_y
+        return (rows + np.arange(lo_j, hi_j)[None, :]).ravel()
+
+    def count(self, x, y):
+        lo_i, hi_i, lo_j, hi_j = self.window(x, y)
+        return max(hi_i - lo_i, 0) * max(hi_j - lo_j, 0)
+
+    def indices(self, x, y):
+        lo_i, hi_i, lo_j, hi_j = self.window(x, y)
+        for i in range(lo_i, hi_i):
+            for j in range(lo_j, hi_j):
+                yield i, j
+
+    def gather(self, buf, x, y):
+        lo_i, hi_i, lo_j, hi_j = self.window(x, y)
+        return buf[..., lo_i:hi_i, lo_j:hi_j]
+
+    def forward_flat_indices(self, i, j):
+        readers = (self.lo_i <= i) & (i < self.hi_i) & \
+                  (self.lo_j <= j) & (j < self.hi_j)
+        return np.flatnonzero(readers)
+
+    def sum_inputs(self, inputs):
+        sums = np.zeros((inputs.shape[0], self.dim_x, self.dim_y))
+        for x in range(self.dim_x):
+            for y in range(self.dim_y):
+                sums[:, x, y] = self.gather(inputs, x, y).sum(axis=(1, 2))
+        return sums
+
+    def scatter_inputs(self, grad, grad_inputs):
+        for x in range(self.dim_x):
+            for y in range(self.dim_y):
+                window = self.gather(grad_inputs, x, y)
+                window += grad[:, x, y][:, None, None]
+
+    def is_uniform(self):
+        return all(len(np.unique(bound)) == 1 for bound in \
+                   (self.lo_i, self.hi_i, self.lo_j, self.hi_j))
+
+    def is_one_to_one(self):
+        return bool(((self.hi_i - self.lo_i) == 1).all() and \
+                    ((self.hi_j - self.lo_j) == 1).all())
+
+class One2OneConnection(WindowConnection):
+    """neuron (x, y) reads the single input (lo_i, lo_j)"""
+    kind = "one2one"
+
+    def sum_inputs(self, inputs):
+        return inputs[:, self.lo_i, self.lo_j]
+
+    def scatter_inputs(self, grad, grad_inputs):
+        for b in range(grad.shape[0]):
+            np.add.at(grad_inputs[b], (self.lo_i, self.lo_j), grad[b])
+
+    def is_one_to_one(self):
+        return True
+
+class CSRConnection(Connection):
+    """irregular connections: the inputs of the neuron with flat index n
+    are indices[indptr[n]:indptr[n+1]]"""
+    kind = "csr"
+
+    def __init__(self, dim_x, dim_y, prev_dim_x, prev_dim_y, indptr, indices):
+        super(CSRConnection, self).__init__(dim_x, dim_y, prev_dim_x, prev_dim_y)
+        self.indptr = indptr
+        self.indices_ = indices
+
+    def flat_indices(self, x, y):
+        n = x * self.dim_y + y
+        return self.indices_[self.indptr[n]:self.indptr[n+1]]
+
+    def count(self, x, y):
+        n = x * self.dim_y + y
+        return self.indptr[n+1] - self.indptr[n]
+
+    def csr(self):
+        return self.indptr, self.indices_
+
+class RangeTracer(object):
+    """stand-in for range() that records the bounds it is called with"""
+    def __init__(self):
+        super(RangeTracer, self).__init__()
+        self.calls = []
+
+    def __call__(self, *args):
+        if len(args) == 1:
+            args = (0, args[0], 1)
+        elif len(args) == 2:
+            args = (args[0], args[1], 1)
+        self.calls.append(tuple(args))
+        return range(*args)
+
+def trace_window(func, x, y):
+    """bounds (lo_i, hi_i, lo_j, hi_j) of a mapping written as
+    [ (i,j) for i in range(..) for j in range(..) ], or None. The mapping
+    is run over the whole of its ranges, and the window is only kept when
+    it gives back every (i, j) of the mapping, so filtered comprehensions
+    and inner ranges depending on i are not taken for windows"""
+    tracer = RangeTracer()
+    func_globals = dict(func.func_globals, range=tracer, xrange=tracer)
+    traced = types.FunctionType(func.func_code, func_globals, func.func_name, \
+                                func.func_defaults, func.func_closure)
+    result = traced(x, y)
+    if len(tracer.calls) == 0:
+        return None
+    outer, inner = tracer.calls[0], tracer.calls[1:]
+    outer_values = range(*outer)
+    if len(inner) != len(outer_values) or len(set(inner)) > 1:
+        return None
+    if len(inner) == 0:
+        # empty outer range: the window is empty
+        inner = [ (0, 0, 1) ]
+    if outer[2] != 1 or inner[0][2] != 1:
+        return None
+    inner_values = range(*inner[0])
+    if list(result) != [ (i, j) for i in outer_values for j in inner_values ]:
+        return None
+    return outer[0], outer[1], inner[0][0], inner[0][1]
+
+def describe_mapping(func, dim_x, dim_y, prev_dim_x, prev_dim_y):
+    """
+    build the descriptor of a mapping function (x, y) -> [ (i, j), ... ]
+    over an ensemble of dim_x * dim_y neurons. Only the range() bounds
+    are kept for each neuron when the mapping is a rectangular
+    comprehension; other mappings are evaluated once into CSR arrays
+    """
+    shape = (dim_x, dim_y)
+    lo_i, hi_i = np.zeros(shape, dtype=int), np.zeros(shape, dtype=int)
+    lo_j, hi_j = np.zeros(shape, dtype=int), np.zeros(shape, dtype=int)
+    for x in range(dim_x):
+        for y in range(dim_y):
+            window = trace_window(func, x, y)
+            if window is None:
+                return csr_from_mapping(func, dim_x, dim_y, prev_dim_x, prev_dim_y)
+            lo_i[x, y], hi_i[x, y], lo_j[x, y], hi_j[x, y] = window
+    return window_connection(dim_x, dim_y, prev_dim_x, prev_dim_y, lo_i, hi_i, lo_j, hi_j)
+
+def window_connection(dim_x, dim_y, prev_dim_x, prev_dim_y, lo_i, hi_i, lo_j, hi_j):
+    """descriptor of the connection in which neuron (x, y) reads the
+    rectangle [lo_i, hi_i) x [lo_j, hi_j) of bounds of shape (dim_x, dim_y)"""
+    lo_i, hi_i = np.array(lo_i, dtype=int), np.array(hi_i, dtype=int)
+    lo_j, hi_j = np.array(lo_j, dtype=int), np.array(hi_j, dtype=int)
+    # empty windows are normalized so that bounds stay comparable
+    empty = (hi_i <= lo_i) | (hi_j <= lo_j)
+    lo_i[empty], hi_i[empty], lo_j[empty], hi_j[empty] = 0, 0, 0, 0
+    assert (lo_i[~empty] >= 0).all() and (hi_i[~empty] <= prev_dim_x).all()
+    assert (lo_j[~empty] >= 0).all() and (hi_j[~empty] <= prev_dim_y).all()
+
+    if not empty.any() and (lo_i == 0).all() and (hi_i == prev_dim_x).all() and \
+            (lo_j == 0).all() and (hi_j == prev_dim_y).all():
+        return DenseConnection(dim_x, dim_y, prev_dim_x, prev_dim_y)
+    if ((hi_i - lo_i) == 1).all() and ((hi_j - lo_j) == 1).all():
+        return One2OneConnection(dim_x, dim_y, prev_dim_x, prev_dim_y, lo_i, hi_i, lo_j, hi_j)
+    return WindowConnection(dim_x, dim_y, prev_dim_x, prev_dim_y, lo_i, hi_i, lo_j, hi_j)
+
+def csr_from_mapping(func, dim_x, dim_y, prev_dim_x, prev_dim_y):
+    indptr = [ 0 ]
+    indices = []
+    for x in range(dim_x):
+        for y in range(dim_y):
+            for i, j in func(x, y):
+                assert 0 <= i < prev_dim_x and 0 <= j < prev_dim_y
+                indices.append(i * prev_dim_y + j)
+            indptr.append(len(indices))
+    return CSRConnection(dim_x, dim_y, prev_dim_x, prev_dim_y, \
+            np.array(indptr, dtype=np.int64), np.array(indices, dtype=np.int64))
+
+if __name__ == "__main__":
+    # self-check: the descriptor of a mapping must read the same inputs as
+    # the mapping itself, for windows and for mappings that only look like
+    # them (an inner range depending on i, a filter)
+    mappings = [
+        ("window", lambda x,y: [(i,j) for i in range(x,x+2) for j in range(y,y+3)]),
+        ("dense", lambda x,y: [(i,j) for i in range(0,4) for j in range(0,4)]),
+        ("one2one", lambda x,y: [(i,j) for i in range(x,x+1) for j in range(y,y+1)]),
+        ("csr", lambda x,y: [(i,j) for i in range(0,4) for j in range(0,1+i//2)]),
+        ("csr", lambda x,y: [(i,j) for i in range(0,4) for j in range(0,4) if i < 2 or j < 3])
+    ]
+    for kind, func in mappings:
+        conn = describe_mapping(func, 2, 1, 4, 4)
+        assert conn.kind == kind, "%s instead of %s" % (conn, kind)
+        for x in range(2):
+            for y in range(1):
+                assert sorted(conn.indices(x, y)) == sorted(func(x, y)), conn
+        # inputs as read by the neurons and neurons as found by the inputs
+        inputs = np.arange(2 * 16, dtype=float).reshape(2, 4, 4)
+        sums = conn.sum_inputs(inputs)
+        grad_inputs = np.zeros((2, 4, 4))
+        conn.scatter_inputs(np.ones((2, 2, 1)), grad_inputs)
+        for x in range(2):
+            for y in range(1):
+                expected = [ inputs[:, i, j] for i, j in func(x, y) ]
+                assert np.allclose(sums[:, x, y], np.sum(expected, axis=0)), conn
+        for i in range(4):
+            for j in range(4):
+                readers = [ x for x in range(2) if (i, j) in func(x, 0) ]
+                assert list(conn.forward_flat_indices(i, j)) == readers, conn
+                assert grad_inputs[0, i, j] == \
+                       sum(func(x, 0).count((i, j)) for x in range(2)), conn
+    print "connection self-check passed"
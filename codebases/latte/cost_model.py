@@ -0,0 +1,252 @@
+'''
+    Analytical cache cost model of the loop trees
+'''
+import re
+from structures import *
+from optimizer import constant_value
+from dependence import affine, affine_forms, affine_add, is_constant, CONSTANT
+
+''' bytes of an element of the generated arrays (float) '''
+ELEMENT_BYTES = 4
+
+''' tile sizes of the x/y loops the cost model chooses from '''
+TILE_CANDIDATES = [ 2, 4, 5, 8, 10, 16, 20, 25, 32, 50, 64 ]
+
+''' operators and functions counted as one floating point operation '''
+FLOP_OPERATORS = set([ "+", "-", "*", "/", "pow" ])
+FLOP_FUNCTIONS = set([ "tanh", "exp", "log", "sqrt", "pow", "max", "fmax" ])
+
+''' fields of an ensemble holding one value per neuron of its previous ensemble '''
+WEIGHT_FIELDS = set([ "weights", "grad_weights" ])
+
+def detect_cache_bytes(level=2, default_kb=256):
+    """size of the data or unified cache of level of cpu0, read from sysfs"""
+    base = "/sys/devices/system/cpu/cpu0/cache"
+    for index in range(8):
+        try:
+            fread = open("%s/index%d/level" % (base, index), "r")
+            cache_level = int(fread.read())
+            fread.close()
+            fread = open("%s/index%d/type" % (base, index), "r")
+            cache_type = fread.read().strip()
+            fread.close()
+            fread = open("%s/index%d/size" % (base, index), "r")
+            size = fread.read().strip()
+            fread.close()
+        except (IOError, ValueError):
+            break
+        if cache_level == level and cache_type in ("Data", "Unified"):
+            if size.endswith("K"): return int(size[:-1]) * 1024
+            if size.endswith("M"): return int(size[:-1]) * 1024 * 1024
+            return int(size)
+    return default_kb * 1024
+
+def index_vars(index):
+    """loop variables an index expression depends on"""
+    if isinstance(index, ConstantNode):
+        index = index.get_constant()
+        if isinstance(index, Node): return index_vars(index)
+    if isinstance(index, str):
+        return re.findall(r"[A-Za-z_]\w*", index)
+    if isinstance(index, ExpressionNode):
+        return index_vars(index.left) + index_vars(index.right)
+    if isinstance(index, Node):
+        names = [ ]
+        for child in index.get_children():
+            names += index_vars(child)
+        return names
+    return [ ]
+
+def array_name(base):
+    """name and leading indices of the base address of an array access"""
+    if isinstance(base, ArrayNode):
+        name, indices = array_name(base.base_addr)
+        return name, indices + list(base.indices)
+    while isinstance(base, ConstantNode):
+        base = base.get_constant()
+    return str(base), [ ]
+
+class Access(object):
+    """an access to an array, or to a whole array by name (indices None),
+    under the loops (variable -> trip count) of its region"""
+    def __init__(self, name, indices, loops):
+        super(Access, self).__init__()
+        self.name = name
+        self.indices = indices
+        self.loops = loops
+
+class CacheModel(object):
+    """
+    estimates the flops, the working set and the reuse distances of the
+    loop trees of the ensembles from the dimensions of the ensembles in
+    name2enm, assuming unit strides and a fully associative cache of
+    cache_bytes
+    """
+    def __init__(self, name2enm, cache_bytes=None):
+        super(CacheModel, self).__init__()
+        self.name2enm = name2enm
+        self.cache_bytes = cache_bytes or detect_cache_bytes()
+        # ensemble names, longest first, to find the ensemble of an array
+        self.ensembles = sorted(name2enm.iterkeys(), key=len, reverse=True)
+
+    def array_elements(self, name):
+        """number of elements of the array name of an ensemble, 1 if unknown"""
+        for e_name in self.ensembles:
+            if not name.startswith(e_name + "_"): continue
+            enm = self.name2enm[e_name]
+            elements = enm[3] * enm[4]
+            if name[len(e_name) + 1:] in WEIGHT_FIELDS and enm[2] in self.name2enm:
+                prev = self.name2enm[enm[2]]
+                elements *= prev[3] * prev[4]
+            return elements
+        return 1
+
+    def trip_count(self, for_node, trips):
+        """iterations of for_node: trips overrides the loop variables it
+        holds; otherwise the smallest constant difference between a bound
+        and the initial value, e.g. 5 for x to std::min(x + 5, 28) or for a
+        window from i to (i + 5); unknown bounds count 1"""
+        var = for_node.get_initial_name()
+        if var in trips:
+            return trips[var]
+        increment = constant_value(for_node.get_increment()) or 1
+        initial = affine(for_node.get_initial())
+        bounds = affine_forms(for_node.get_loop_bound())
+        if initial is None or bounds is None:
+            return 1
+        extents = [ affine_add(bound, initial, -1) for bound in bounds ]
+        extents = [ extent.get(CONSTANT, 0) for extent in extents if is_constant(extent) ]
+        if len(extents) == 0:
+            return 1
+        return max(0, -(-min(extents) // increment))
+
+    def accesses(self, nodes, trips=None, loops=None):
+        """the array accesses of nodes, with the loops inside nodes"""
+        trips = trips or { }
+        loops = loops or { }
+        found = [ ]
+        for node in nodes:
+            if isinstance(node, ForNode):
+                inner = dict(loops)
+                inner[node.get_initial_name()] = self.trip_count(node, trips)
+                found += self.accesses(node.get_children(), trips, inner)
+            elif isinstance(node, IndexNode) or isinstance(node, ArrayNode):
+                name, indices = array_name(node.base_addr)
+                found.append(Access(name, indices + list(node.indices), loops))
+            elif isinstance(node, AssignmentNode) or isinstance(node, ExpressionNode):
+                found += self.accesses([ node.left, node.right ], trips, loops)
+            elif isinstance(node, ConstantNode):
+                # an array passed whole, e.g. to an mkl call
+                if node.is_var() and self.array_elements(node.get_constant()) > 1:
+                    found.append(Access(node.get_constant(), None, loops))
+            elif isinstance(node, Node):
+                found += self.accesses(node.get_children(), trips, loops)
+        return found
+
+    def access_elements(self, access):
+        """distinct elements touched by an access over its loops"""
+        if access.indices is None:
+            return self.array_elements(access.name)
+        elements = 1
+        for index in access.indices:
+            extent = 1
+            for var in set(index_vars(index)):
+                extent += access.loops.get(var, 1) - 1
+            elements *= extent
+        # an access does not touch more than its whole array
+        total = self.array_elements(access.name)
+        return min(elements, total) if total > 1 else elements
+
+    def working_set(self, nodes, trips=None):
+        """bytes touched by running nodes once: the largest access of every array"""
+        arrays = { }
+        for access in self.accesses(nodes, trips):
+            arrays[access.name] = max(arrays.get(access.name, 0), self.access_elements(access))
+        return sum(arrays.itervalues()) * ELEMENT_BYTES
+
+    def flops(self, nodes, trips=None, iterations=1):
+        """floating point operations of running nodes once"""
+        trips = trips or { }
+        count = 0
+        for node in nodes:
+            if isinstance(node, ForNode):
+                count += self.flops(node.get_children(), trips, \
+                                    iterations * self.trip_count(node, trips))
+                continue
+            if isinstance(node, ExpressionNode):
+                if node.operator in FLOP_OPERATORS: count += iterations
+                count += self.flops([ node.left, node.right ], trips, iterations)
+            elif isinstance(node, AssignmentNode):
+                count += self.flops([ node.left, node.right ], trips, iterations)
+            elif isinstance(node, CallNode):
+                if str(node.func) in FLOP_FUNCTIONS: count += iterations
+                count += self.flops(node.get_children(), trips, iterations)
+            elif isinstance(node, Node):
+                count += self.flops(node.get_children(), trips, iterations)
+        return count
+
+    def reuse_distances(self, for_node):
+        """
+        array -> bytes touched between two uses of the same element: an
+        array reused across the iterations of a loop whose variable its
+        indices do not depend on is touched again after one iteration of
+        that loop
+        """
+        distances = { }
+        def visit(node, enclosing):
+            if isinstance(node, ForNode):
+                for child in node.get_children():
+                    visit(child, enclosing + [ node ])
+                return
+            for access in self.accesses([ node ]):
+                if access.indices is None: continue
+                used = set()
+                for index in access.indices: used.update(index_vars(index))
+                # the inner most loop the access does not move with; x
+                # moves with _tile_x when its bounds depend on it
+                for loop in enclosing[::-1]:
+                    if loop.get_initial_name() in used:
+                        used.update(index_vars(str(loop.get_initial())))
+                        used.update(index_vars(str(loop.get_loop_bound())))
+                        continue
+                    distance = self.working_set(loop.get_children())
+                    distances[access.name] = min(distances.get(access.name, distance), distance)
+                    break
+        visit(for_node, [ ])
+        return distances
+
+    def choose_tile_size(self, trees, dims):
+        """
+        the largest tile size of the x/y loops whose tile fits the cache in
+        every tree of an ensemble (forward and backward), and the working
+        set of that tile; the smallest size when none fits
+        """
+        chosen = None
+        sizes = [ size for size in TILE_CANDIDATES if size < max(dims) ] + [ max(dims) ]
+        for size in sizes:
+            trips = { "x": min(size, dims[0]), "y": min(size, dims[1]) }
+            working_set = max(self.working_set([ tree ], trips) for tree in trees)
+            if chosen is None or working_set <= self.cache_bytes:
+                chosen = (size, working_set)
+            if working_set > self.cache_bytes:
+                break
+        return chosen
+
+    def fusion_fits(self, loop_body, other_body):
+        """working set of the two loop bodies fused in one loop, and if it
+        fits the cache"""
+        working_set = self.working_set(list(loop_body) + list(other_body))
+        return working_set <= self.cache_bytes, working_set
+
+    def report(self, e_name, direction, tree):
+        """lines of the estimates of the loop tree of an ensemble; the working
+        set of a tiled tree is the one of a tile"""
+        if tree is None: return "%-12s %-9s no loops" % (e_name, direction)
+        lines = [ "%-12s %-9s %12d flops %10.1f KB %s" % (e_name, direction, \
+                  self.flops([ tree ]), self.working_set([ tree ]) / 1024.0, \
+                  "tile working set" if isinstance(tree, ForNode) and tree.is_tile() \
+                  else "working set") ]
+        for name, distance in sorted(self.reuse_distances(tree).iteritems()):
+            lines.append("    %-28s reuse distance %10d bytes (%s)" % (name, distance, \
+                         "hit" if distance <= self.cache_bytes else "miss"))
+        return "\n".join(lines)
@@ -0,0 +1,174 @@
+'''
+    Dataset readers for the reference runtime
+'''
+import os
+import numpy as np
+
+class CSRChunk(object):
+    """
+    consecutive instances of a sparse dataset: the features of instance n
+    are values[indptr[n]:indptr[n+1]] at the (0-based) positions
+    indices[indptr[n]:indptr[n+1]] of a flattened feature vector
+    """
+    def __init__(self, indptr, indices, values, labels, num_features):
+        super(CSRChunk, self).__init__()
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+        self.labels = labels
+        self.num_features = num_features
+
+    def __len__(self): return len(self.labels)
+
+    def toarray(self, begin=0, end=None):
+        """dense (end - begin, num_features) features of instances [begin, end)"""
+        if end is None: end = len(self)
+        dense = np.zeros((end - begin, self.num_features))
+        lo, hi = self.indptr[begin], self.indptr[end]
+        rows = np.repeat(np.arange(end - begin), np.diff(self.indptr[begin:end+1]))
+        dense[rows, self.indices[lo:hi]] = self.values[lo:hi]
+        return dense
+
+def dense_rows(features, begin, end):
+    """dense (end - begin, num_features) array of instances [begin, end)
+    of a CSRChunk, an array or a list of instances"""
+    if isinstance(features, CSRChunk):
+        return features.toarray(begin, end)
+    return np.reshape(np.asarray(features[begin:end], dtype=float), (end - begin, -1))
+
+'''
+    libsvm format: label fea_id:f_val
+    Note that fea_id is 1-based
+'''
+def read_libsvm_chunks(file_name, num_features, chunk_size=4096):
+    """read a libsvm file as CSRChunks of at most chunk_size instances,
+    only one chunk is held in memory at a time"""
+    def make_chunk(indptr, indices, values, labels):
+        return CSRChunk(np.array(indptr, dtype=np.int64), \
+                        np.array(indices, dtype=np.int32), \
+                        np.array(values, dtype=np.float32), \
+                        np.array(labels, dtype=np.int32), num_features)
+
+    indptr, indices, values, labels = [ 0 ], [], [], []
+    fread = open(file_name, "r")
+    for line in fread:
+        fields = line.split()
+        if len(fields) == 0: continue
+        labels.append(int(float(fields[0])))
+        for field in fields[1:]:
+            fea_id, fea_val = field.split(":")
+            assert 0 < int(fea_id) <= num_features, "feature id out of range: %s" % fea_id
+            indices.append(int(fea_id) - 1)
+            values.append(float(fea_val))
+        indptr.append(len(indices))
+        if len(labels) == chunk_size:
+            yield make_chunk(indptr, indices, values, labels)
+            indptr, indices, values, labels = [ 0 ], [], [], []
+    fread.close()
+    if len(labels) > 0:
+        yield make_chunk(indptr, indices, values, labels)
+
+class LibsvmStream(object):
+    """libsvm dataset streamed from disk chunk by chunk on every pass"""
+    def __init__(self, file_name, fea_dim_x, fea_dim_y, chunk_size=4096):
+        super(LibsvmStream, self).__init__()
+        self.file_name = file_name
+        self.num_features = fea_dim_x * fea_dim_y
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        return read_libsvm_chunks(self.file_name, self.num_features, self.chunk_size)
+
+def read_mnist_chunks(file_name, num_features, chunk_size=4096):
+    """read a mnist csv file (a header line, then label,pixel0,pixel1,..)
+    as (features, labels) arrays of at most chunk_size instances"""
+    def make_chunk(lines):
+        values = np.array([ line.split(",") for line in lines ], dtype=np.float32)
+        assert values.shape[1] == num_features + 1, "wrong number of features"
+        return values[:, 1:], values[:, 0].astype(np.int32)
+
+    lines = []
+    fread = open(file_name, "r")
+    fread.readline()    # skip the header
+    for line in fread:
+        if len(line.strip()) == 0: continue
+        lines.append(line)
+        if len(lines) == chunk_size:
+            yield make_chunk(lines)
+            lines = []
+    fread.close()
+    if len(lines) > 0:
+        yield make_chunk(lines)
+
+def read_dense_chunks(file_name, data_format, num_features):
+    """(features, labels) chunks of a dataset, features densified"""
+    if data_format == "libsvm":
+        for chunk in read_libsvm_chunks(file_name, num_features):
+            yield chunk.toarray().astype(np.float32), chunk.labels
+    elif data_format == "mnist":
+        for chunk in read_mnist_chunks(file_name, num_features):
+            yield chunk
+    else:
+        assert False, "unknown data format: %s" % data_format
+
+'''
+    Binary cache of a dataset, written next to the text file:
+        header:   int32 [ magic, num_instances, dim_x, dim_y ]
+        features: float32 [ num_instances, dim_x, dim_y ]
+        labels:   int32 [ num_instances ]
+'''
+CACHE_MAGIC = 0x4c415454
+CACHE_SUFFIX = ".cache"
+HEADER_SIZE = 4
+
+def cache_name(file_name):
+    return file_name + CACHE_SUFFIX
+
+def is_cache_valid(file_name, dim_x, dim_y):
+    """the cache exists, is newer than the text file and has the same shape"""
+    cache_file = cache_name(file_name)
+    if not os.path.exists(cache_file): return False
+    if os.path.getmtime(cache_file) < os.path.getmtime(file_name): return False
+    if os.path.getsize(cache_file) < HEADER_SIZE * 4: return False
+    header = np.fromfile(cache_file, dtype=np.int32, count=HEADER_SIZE)
+    return header[0] == CACHE_MAGIC and header[2] == dim_x and header[3] == dim_y
+
+def write_cache(file_name, data_format, dim_x, dim_y):
+    """parse the text file chunk by chunk into its binary cache"""
+    cache_file = cache_name(file_name)
+    header = np.array([ CACHE_MAGIC, 0, dim_x, dim_y ], dtype=np.int32)
+    labels = []
+    fwrite = open(cache_file + ".tmp", "wb")
+    header.tofile(fwrite)
+    for features, chunk_labels in read_dense_chunks(file_name, data_format, dim_x * dim_y):
+        features.astype(np.float32).tofile(fwrite)
+        labels.append(np.asarray(chunk_labels, dtype=np.int32))
+    labels = np.concatenate(labels) if len(labels) > 0 else np.zeros(0, dtype=np.int32)
+    labels.tofile(fwrite)
+    # the number of instances is only known at the end
+    header[1] = len(labels)
+    fwrite.seek(0)
+    header.tofile(fwrite)
+    fwrite.close()
+    os.rename(cache_file + ".tmp", cache_file)
+
+def load_dataset(file_name, data_format, dim_x, dim_y):
+    """
+    features (num_instances, dim_x, dim_y) and labels of a dataset, memory
+    mapped from its binary cache; the text file is only parsed when the
+    cache is missing or older than it
+    """
+    if not is_cache_valid(file_name, dim_x, dim_y):
+        print "caching", file_name, "to", cache_name(file_name)
+        write_cache(file_name, data_format, dim_x, dim_y)
+    cache_file = cache_name(file_name)
+    num_instances = int(np.fromfile(cache_file, dtype=np.int32, count=HEADER_SIZE)[1])
+    offset = HEADER_SIZE * 4
+    if num_instances == 0:
+        return np.zeros((0, dim_x, dim_y), dtype=np.float32), np.zeros(0, dtype=np.int32)
+    features = np.memmap(cache_file, dtype=np.float32, mode="r", offset=offset, \
+                         shape=(num_instances, dim_x, dim_y))
+    offset += features.nbytes
+    labels = np.memmap(cache_file, dtype=np.int32, mode="r", offset=offset, \
+                       shape=(num_instances,))
+    return features, labels
@@ -0,0 +1,463 @@
+'''
+    Dependence analysis of the loop trees on affine index expressions
+'''
+import re
+from structures import *
+
+''' key of the constant term of an affine form '''
+CONSTANT = 1
+
+''' tokens of the C expressions held as strings, e.g. std::min(_tile_x + 5, 28) '''
+TOKEN = re.compile(r"\s*(std::min|[A-Za-z_]\w*|\d+|[-+*(),])")
+
+'''
+    An affine form is a dict of variable -> coefficient, with the constant
+    term under CONSTANT; terms of coefficient 0 are left out, so equal
+    forms are equal dicts
+'''
+def affine_add(form, other, scale=1):
+    """form + scale * other"""
+    result = dict(form)
+    for var, coef in other.iteritems():
+        result[var] = result.get(var, 0) + scale * coef
+        if result[var] == 0:
+            del result[var]
+    return result
+
+def affine_scale(form, scale):
+    return affine_add({ }, form, scale)
+
+def affine_multiply(form, other):
+    """form * other, None when neither of them is a constant"""
+    if form is None or other is None:
+        return None
+    if is_constant(form):
+        return affine_scale(other, form.get(CONSTANT, 0))
+    if is_constant(other):
+        return affine_scale(form, other.get(CONSTANT, 0))
+    return None
+
+def is_constant(form):
+    return all(var == CONSTANT for var in form)
+
+def substitute(form, var, value):
+    """form with var replaced by the form value"""
+    coef = form.get(var, 0)
+    if coef == 0:
+        return form
+    result = dict(form)
+    del result[var]
+    return affine_add(result, value, coef)
+
+class AffineParser(object):
+    """recursive descent parser of the tokens of an affine C expression"""
+    def __init__(self, tokens):
+        super(AffineParser, self).__init__()
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def bound(self):
+        """forms of an expression that may be a std::min of expressions"""
+        if self.peek() != "std::min":
+            form = self.expression()
+            return None if form is None else [ form ]
+        self.take()
+        if self.take() != "(": return None
+        forms = self.bound()
+        if forms is None or self.take() != ",": return None
+        others = self.bound()
+        if others is None or self.take() != ")": return None
+        return forms + others
+
+    def expression(self):
+        form = self.term()
+        while form is not None and self.peek() in ("+", "-"):
+            scale = 1 if self.take() == "+" else -1
+            other = self.term()
+            if other is None: return None
+            form = affine_add(form, other, scale)
+        return form
+
+    def term(self):
+        form = self.factor()
+        while form is not None and self.peek() == "*":
+            self.take()
+            form = affine_multiply(form, self.factor())
+        return form
+
+    def factor(self):
+        token = self.take()
+        if token is None or token in ("std::min", "+", "*", ")", ","):
+            return None
+        if token == "-":
+            form = self.factor()
+            return None if form is None else affine_scale(form, -1)
+        if token == "(":
+            form = self.expression()
+            return form if self.take() == ")" else None
+        if token.isdigit():
+            return affine_add({ }, { CONSTANT: int(token) })
+        return { token: 1 }
+
+def parse_affine(text):
+    """affine forms of the C expression text, None if it is not affine"""
+    tokens = [ ]
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = TOKEN.match(text, pos)
+        if match is None: return None
+        tokens.append(match.group(1))
+        pos = match.end()
+    parser = AffineParser(tokens)
+    forms = parser.bound()
+    if parser.pos != len(tokens): return None
+    return forms
+
+def affine_forms(expr):
+    """
+    affine forms of expr, an int, a string of C or a node; a std::min has a
+    form per argument, its value is the smallest of them. None when expr is
+    not affine
+    """
+    if isinstance(expr, bool):
+        return None
+    if isinstance(expr, (int, long)):
+        return [ affine_add({ }, { CONSTANT: expr }) ]
+    if isinstance(expr, str):
+        return parse_affine(expr)
+    if isinstance(expr, ConstantNode):
+        return affine_forms(expr.get_constant())
+    if isinstance(expr, ExpressionNode):
+        left, right = affine(expr.left), affine(expr.right)
+        if left is None or right is None: return None
+        if expr.operator == "+": return [ affine_add(left, right) ]
+        if expr.operator == "-": return [ affine_add(left, right, -1) ]
+        if expr.operator == "*":
+            product = affine_multiply(left, right)
+            return None if product is None else [ product ]
+    return None
+
+def affine(expr):
+    """the affine form of expr, None if it is not affine"""
+    forms = affine_forms(expr)
+    if forms is None or len(forms) != 1: return None
+    return forms[0]
+
+def same_expression(expr, other):
+    """if two loop parameters are the same expression"""
+    forms, other_forms = affine_forms(expr), affine_forms(other)
+    if forms is not None and other_forms is not None:
+        return forms == other_forms
+    return expr == other or str(expr) == str(other)
+
+def loop_step(for_node):
+    """the increment of for_node, None unless it is a positive constant"""
+    increment = affine(for_node.get_increment())
+    if increment is None or not is_constant(increment): return None
+    step = increment.get(CONSTANT, 0)
+    return step if step > 0 else None
+
+def loop_range(for_node):
+    """
+    first and last value of the variable of for_node, as forms of the
+    outer variables; None when they are not affine. The last value of a
+    loop of a constant trip count, such as a tile loop from _tile_x to
+    _tile_x + 5, is a multiple of the increment away from the first one
+    """
+    first = affine(for_node.get_initial())
+    bounds = affine_forms(for_node.get_loop_bound())
+    step = loop_step(for_node)
+    if first is None or bounds is None or step is None:
+        return None
+    # the variable stays below every bound of a std::min
+    for bound in bounds:
+        extent = affine_add(bound, first, -1)
+        if is_constant(extent):
+            trips = -(-extent.get(CONSTANT, 0) // step)
+            return first, affine_add(first, { CONSTANT: step * (trips - 1) })
+    return first, affine_add(bounds[0], { CONSTANT: -1 })
+
+def array_base(base):
+    """name and leading indices of the base address of an array access"""
+    while isinstance(base, ConstantNode):
+        base = base.get_constant()
+    if isinstance(base, ArrayNode):
+        name, indices = array_base(base.get_base_addr())
+        return name, indices + list(base.get_indices())
+    return str(base), [ ]
+
+def node_uses(node, write):
+    """
+    the nodes node writes (or reads): IndexNode, ArrayNode and variables
+    (ConstantNode), following get_writes (or get_reads) of the nodes
+    """
+    if isinstance(node, ConstantNode):
+        return [ node ] if node.is_var() else [ ]
+    if isinstance(node, IndexNode) or isinstance(node, ArrayNode):
+        return [ node ]
+    if isinstance(node, AssignmentNode):
+        return node_uses(node.left if write else node.right, write)
+    if isinstance(node, ExpressionNode):
+        operands = [ node.left, node.right ]
+        if write:
+            # only calls write their operands
+            operands = [ op for op in operands if isinstance(op, CallNode) ]
+        return sum([ node_uses(op, write) for op in operands ], [ ])
+    if isinstance(node, CallNode):
+        flag = 0x2 if write else 0x1
+        return sum([ node_uses(child, write) for child, rw in \
+                     zip(node.get_children(), node.args_rw) if rw & flag ], [ ])
+    return sum([ node_uses(child, write) for child in node.get_children() ], [ ])
+
+class Access(object):
+    """
+    a write or read of array name at indices (affine forms, None for an
+    index that is not affine), in layout (leading pointer indices, stride
+    of the flat indices); indices None for a use of the whole of name.
+    ranges are the first/last values of the loops around the access in
+    the fused body, outer most first
+    """
+    def __init__(self, name, indices, layout, ranges, write):
+        super(Access, self).__init__()
+        self.name = name
+        self.indices = indices
+        self.layout = layout
+        self.ranges = ranges
+        self.write = write
+
+    def bounds(self, k):
+        """smallest and largest value of the k-th index over the loops of
+        the body, as forms of the fused loop variables; None if unknown"""
+        index = self.indices[k]
+        if index is None: return None
+        low, high = index, index
+        # inner most loops first, their bounds may use the outer ones
+        for var, var_range in reversed(self.ranges):
+            if var not in low and var not in high: continue
+            if var_range is None: return None
+            first, last = var_range
+            low = substitute(low, var, first if low.get(var, 0) > 0 else last)
+            high = substitute(high, var, last if high.get(var, 0) > 0 else first)
+        return low, high
+
+def body_accesses(nodes, ranges=None):
+    """the accesses of the fused loop body nodes"""
+    ranges = ranges or [ ]
+    found = [ ]
+    for node in nodes:
+        if isinstance(node, ForNode):
+            inner = ranges + [ (node.get_initial_name(), loop_range(node)) ]
+            found += body_accesses(node.get_children(), inner)
+            continue
+        for write in (True, False):
+            for use in node_uses(node, write):
+                if isinstance(use, ConstantNode):
+                    found.append(Access(use.get_constant(), None, None, ranges, write))
+                    continue
+                name, leading = array_base(use.base_addr)
+                indices = leading + list(use.indices)
+                layout = (len(leading), use.stride if isinstance(use, IndexNode) else None)
+                found.append(Access(name, [ affine(index) for index in indices ], \
+                                    layout, ranges, write))
+    return found
+
+def split_form(form, fused_vars):
+    """the part of form on the fused loop variables, the symbols it holds
+    (invariant in the fused loops) and its constant"""
+    fused = dict((var, coef) for var, coef in form.iteritems() if var in fused_vars)
+    symbols = dict((var, coef) for var, coef in form.iteritems() \
+                   if var not in fused_vars and var != CONSTANT)
+    return fused, symbols, form.get(CONSTANT, 0)
+
+def ceil_div(a, b):
+    return -(-a // b)
+
+class FusionDependences(object):
+    """
+    dependence test of the fusion of two loop nests: the body of the
+    second nest is to run after the body of the first one in every
+    iteration of their common (fused) loops. Every pair of accesses to
+    the same array, one of them a write, gives the distance between the
+    iteration of the first body and the one of the second that touch the
+    same element, as an interval per fused loop. Fusion is legal when no
+    distance is lexicographically positive, i.e. the second body never
+    touches an element before the first body is done with it. Indices are
+    assumed to stay within the bounds of their dimension
+    """
+    def __init__(self, fused_loops):
+        super(FusionDependences, self).__init__()
+        self.fused_vars = [ loop.get_initial_name() for loop in fused_loops ]
+        self.fused_loops = fused_loops
+
+    def distance(self, access1, access2):
+        """
+        interval (low, high) of the distance per fused loop, None bounds
+        for unbounded, between the iterations of access1 and access2 that
+        touch the same element; None when they never do
+        """
+        box = [ [ None, None ] for _ in self.fused_vars ]
+        if access1.indices is not None and access2.indices is not None and \
+           len(access1.indices) == len(access2.indices) and \
+           (access1.layout == access2.layout or None in (access1.layout, access2.layout)):
+            for k in range(len(access1.indices)):
+                if not self.constrain(box, access1.bounds(k), access2.bounds(k)):
+                    return None
+        return self.round_box(box)
+
+    def constrain(self, box, bounds1, bounds2):
+        """narrow the box with an index of the two accesses; False when the
+        index ranges cannot overlap"""
+        if bounds1 is None or bounds2 is None:
+            return True
+        low1, high1 = [ split_form(form, self.fused_vars) for form in bounds1 ]
+        low2, high2 = [ split_form(form, self.fused_vars) for form in bounds2 ]
+        if not low1[1] == high1[1] == low2[1] == high2[1]:
+            # different symbols: nothing known
+            return True
+        fused = low1[0]
+        if not fused == high1[0] == low2[0] == high2[0]:
+            return True
+        # a * (v1 - v2) is in [low2 - high1, high2 - low1]
+        lower, upper = low2[2] - high1[2], high2[2] - low1[2]
+        if len(fused) == 0:
+            return lower <= 0 <= upper
+        if len(fused) != 1:
+            return True
+        var, coef = fused.items()[0]
+        if coef > 0:
+            lower, upper = ceil_div(lower, coef), upper // coef
+        else:
+            lower, upper = ceil_div(upper, coef), lower // coef
+        interval = box[self.fused_vars.index(var)]
+        interval[0] = lower if interval[0] is None else max(interval[0], lower)
+        interval[1] = upper if interval[1] is None else min(interval[1], upper)
+        return interval[0] <= interval[1]
+
+    def round_box(self, box):
+        """distances are multiples of the increments of the fused loops and
+        within their trip counts; None when a loop has no distance left"""
+        for loop, interval in zip(self.fused_loops, box):
+            step, first = loop_step(loop), affine(loop.get_initial())
+            if step is None or first is None or not is_constant(first):
+                continue
+            loop_span = loop_range(loop)
+            if loop_span is not None and is_constant(loop_span[1]):
+                span = loop_span[1].get(CONSTANT, 0) - first.get(CONSTANT, 0)
+                interval[0] = -span if interval[0] is None else max(interval[0], -span)
+                interval[1] = span if interval[1] is None else min(interval[1], span)
+            if interval[0] is not None:
+                interval[0] = ceil_div(interval[0], step) * step
+            if interval[1] is not None:
+                interval[1] = interval[1] // step * step
+            if interval[0] is not None and interval[1] is not None and \
+               interval[0] > interval[1]:
+                return None
+        return [ tuple(interval) for interval in box ]
+
+    def violated(self, box):
+        """if a distance of the box may be lexicographically positive"""
+        for low, high in box:
+            if high is None or high > 0:
+                return True
+            if high < 0:
+                # the first body ran in an earlier iteration of this loop
+                return False
+        return False
+
+    def format_box(self, box):
+        intervals = [ ]
+        for var, (low, high) in zip(self.fused_vars, box):
+            if low is not None and low == high:
+                intervals.append("%s %d" % (var, low))
+            else:
+                intervals.append("%s %s..%s" % (var, "*" if low is None else low, \
+                                                 "*" if high is None else high))
+        return "(%s)" % ", ".join(intervals)
+
+    def one2one_accesses(self, accesses, arrays):
+        """
+        accesses of a 1 to 1 layer, whose arrays used as a whole only
+        touch the location x, y
+        """
+        found = [ ]
+        for access in accesses:
+            if access.indices is None and access.name in arrays:
+                access = Access(access.name, [ { "x": 1 }, { "y": 1 } ], None, \
+                                access.ranges, access.write)
+            found.append(access)
+        return found
+
+    def check(self, body1, body2, one2one1=False, one2one2=False):
+        """
+        (legal, reason) of running the loop body nodes body2 after body1 in
+        every iteration of the fused loops; one2one1/2 if a body is the one
+        of a 1 to 1 layer
+        """
+        accesses1, accesses2 = body_accesses(body1), body_accesses(body2)
+        arrays = set(access.name for access in accesses1 + accesses2 \
+                     if access.indices is not None)
+        if one2one1: accesses1 = self.one2one_accesses(accesses1, arrays)
+        if one2one2: accesses2 = self.one2one_accesses(accesses2, arrays)
+
+        found = [ ]
+        for access1 in accesses1:
+            for access2 in accesses2:
+                if access1.name != access2.name: continue
+                if not access1.write and not access2.write: continue
+                box = self.distance(access1, access2)
+                if box is None: continue
+                kind = "output" if access1.write and access2.write else \
+                       "flow" if access1.write else "anti"
+                dependence = "%s dependence on %s at distance %s" % \
+                             (kind, access1.name, self.format_box(box))
+                if self.violated(box):
+                    return False, dependence
+                if dependence not in found:
+                    found.append(dependence)
+        if len(found) == 0:
+            return True, "independent"
+        return True, "; ".join(found)
+
+if __name__ == "__main__":
+    # self-check: the writes a[x, y] = 1 and the reads b[x, y] = a[...]
+    # run one after the other in every iteration of the fused x and y
+    # loops; an element touched by the second body before the first body
+    # is done with it, or one that cannot be located, prevents the fusion
+    def loop(var):
+        return ForNode(ConstantNode(var), ConstantNode(0), ConstantNode(10), \
+                       ConstantNode(1))
+    def produce(x, y):
+        return AssignmentNode(IndexNode(ConstantNode("a"), [ x, y ], 10), \
+                              ConstantNode(1.0))
+    def consume(x, y):
+        return AssignmentNode(IndexNode(ConstantNode("b"), [ "x", "y" ], 10), \
+                              IndexNode(ConstantNode("a"), [ x, y ], 10))
+    # written at, read at, legal if the writes run first, legal if the reads do
+    checks = [
+        ("x", "y", "x", "y", True, True),
+        ("x", "y", "x + 1", "y", False, True),      # produced at x, read at x + 1
+        ("x", "y", "x - 1", "y", True, False),
+        ("x", "y", "x", "y + 1", False, True),
+        ("x", "y", "x - 1", "y + 1", True, False),  # (-1, 1) is before (0, 0)
+        ("x", "y", "x + 1", "y - 1", False, True),
+        ("x", "y", "x + n", "y", False, False),     # mismatched symbols
+        ("x + n", "y", "x + m", "y", False, False),
+        ("x", "y + n", "x - 1", "y + m", True, False),
+        ("x", "y + n", "x", "y + m", False, False)
+    ]
+    for x1, y1, x2, y2, legal, reversed_legal in checks:
+        fused = FusionDependences([ loop("x"), loop("y") ])
+        result = fused.check([ produce(x1, y1) ], [ consume(x2, y2) ])
+        assert result[0] == legal, (x1, y1, x2, y2, result)
+        result = fused.check([ consume(x2, y2) ], [ produce(x1, y1) ])
+        assert result[0] == reversed_legal, (x2, y2, x1, y1, result)
+    print "dependence self-check passed"
@@ -5,7 +5,10 @@
 
 import os, sys
 import ast
+import copy
 import inspect
+import multiprocessing
+import shlex
 from ast_matcher import *
 from templates import *
 import py_compile
@@ -16,7 +19,13 @@ from analyzer import *
 NARGS = 3
 
 from optimizer import TilingOptimizer
+from optimizer import TileSizes
 from optimizer import FusionOptimizer
+from cost_model import CacheModel
+import compile_cache
+import autotune
+from profiler import CompileProfiler
+import profiler
 
 '''
 def usage():
@@ -247,7 +256,7 @@ def make_layers(network_info):
             block.append(stmt_str)
     return block
 
-def make_test_block(solver_info, ensembles_info, name2enm, fp_codes,
+def make_test_block(options, solver_info, ensembles_info, name2enm, fp_codes,
                     forwards_ensemble_order, backwards_ensemble_order):
     test_block = []
     test_block.append("// test block")
@@ -318,10 +327,16 @@ def make_solve_block(options, conn_types, neuron_analyzers, solver_info, ensembl
     if batch_parallel_flag: 
         omp_directive_str = "#pragma omp parallel for"
         #if tiling_flag: omp_directive_str += " collapse(2)"
-        omp_directive_str += " schedule(static, 2)"
+        if options.OMP_CHUNK > 0:
+            omp_directive_str += " schedule(%s, %d)" % (options.OMP_SCHEDULE, options.OMP_CHUNK)
+        else:
+            omp_directive_str += " schedule(%s)" % options.OMP_SCHEDULE
         #omp_directive_str += " private(tid, data_idx, cur_label, sumover)"
         solve_block.append(omp_directive_str)
-    solve_block.append(make_loop_header("si", 0, "train_features.size()", 1) + "{")
+    num_samples = "train_features.size()"
+    if options.MAX_SAMPLES is not None:
+        num_samples = "std::min((int) %s, %d)" % (num_samples, options.MAX_SAMPLES)
+    solve_block.append(make_loop_header("si", 0, num_samples, 1) + "{")
     if batch_parallel_flag:
         solve_block.append("int tid = omp_get_thread_num();")
     solve_block.append("")
@@ -426,18 +441,185 @@ def make_solve_block(options, conn_types, neuron_analyzers, solver_info, ensembl
     solve_block.append("} // end of iterative traversal") # end the iteration loop
     return solve_block
 
+''' (optimizer class, constructor args) of the running run_optimizers '''
+optimizer_tasks = None
+
+def run_optimizer(index):
+    """run the index-th optimizer, its trees and its new ensemble order"""
+    optimizer_class, args = optimizer_tasks[index]
+    opt = optimizer_class(*args)
+    order = opt.optimize()
+    return opt.dict_of_trees, order
+
+def optimizer_worker(index):
+    result = profiler.measure_worker(run_optimizer, index)
+    sys.stdout.flush()
+    return result
+
+def run_optimizers(options, tasks):
+    """
+    run the optimizers of tasks, in a process pool with --jobs above 1,
+    and return their new ensemble orders; the trees of every optimizer
+    are written back to the dictionary it was given
+    """
+    global optimizer_tasks
+    optimizer_tasks = tasks
+    if options.JOBS > 1:
+        # the workers fork with optimizer_tasks, only the trees come back
+        pool = multiprocessing.Pool(min(options.JOBS, len(tasks)))
+        results = pool.map(optimizer_worker, range(len(tasks)))
+        pool.close()
+        pool.join()
+        results = profiler.add_worker_peaks(results)
+    else:
+        results = map(run_optimizer, range(len(tasks)))
+    optimizer_tasks = None
+
+    orders = [ ]
+    for (_, args), (trees, order) in zip(tasks, results):
+        if trees is not args[0]:
+            args[0].clear()
+            args[0].update(trees)
+        orders.append(order)
+    return orders
+
+def make_tile_sizes(options):
+    """tile sizes of --tile-size, then --tile-config, then every --tile"""
+    tile_sizes = TileSizes(options.TILE_SIZE)
+    if options.TILE_CONFIG is not None:
+        tile_sizes.load(options.TILE_CONFIG)
+    for spec in options.TILE_SPECS or [ ]:
+        tile_sizes.parse(spec)
+    return tile_sizes
+
+def make_cost_model(options, name2enm):
+    """the cache cost model of --cost-model, None without it"""
+    if not options.COST_MODEL: return None
+    cache_bytes = options.CACHE_KB * 1024 if options.CACHE_KB else None
+    return CacheModel(name2enm, cache_bytes)
+
+def plan_tiles(cost_model, tile_sizes, ensembles_info, fp_codes, bp_codes):
+    """
+    tile the x/y loops of the ensembles without tile sizes of their own by
+    the sizes the cost model chooses; ensembles of the same dimensions get
+    the same size, so their loops can still be fused
+    """
+    term.dump("TILE PLAN (cache %.1f KB) ----------------" % \
+              (cost_model.cache_bytes / 1024.0), term.OKBLUE)
+    groups = { }
+    for x in ensembles_info:
+        e_name = x[0]
+        own = tile_sizes.sizes.get(e_name, { })
+        trees = [ tree for tree in (fp_codes.get(e_name), bp_codes.get(e_name)) \
+                  if tree is not None ]
+        if len(trees) == 0 or "x" in own or "y" in own: continue
+        if (x[3], x[4]) not in groups:
+            groups[(x[3], x[4])] = ([ ], [ ])
+        groups[(x[3], x[4])][0].append(e_name)
+        groups[(x[3], x[4])][1].extend(trees)
+    for dims, (e_names, trees) in sorted(groups.iteritems()):
+        size, working_set = cost_model.choose_tile_size(trees, dims)
+        for e_name in e_names:
+            tile_sizes.set(e_name, "x", [ size ])
+            tile_sizes.set(e_name, "y", [ size ])
+        print "%s: tile %dx%d, working set %.1f KB" % (", ".join(e_names), \
+                min(size, dims[0]), min(size, dims[1]), working_set / 1024.0)
+
+def report_cost_model(cost_model, fp_codes, bp_codes, forwards_ensemble_order, \
+                      backwards_ensemble_order):
+    """print the estimates of the cost model of the optimized loop trees"""
+    term.dump("COST MODEL (cache %.1f KB) ---------------" % \
+              (cost_model.cache_bytes / 1024.0), term.OKBLUE)
+    for e_name in forwards_ensemble_order:
+        print cost_model.report(e_name, "forward", fp_codes.get(e_name))
+    for e_name in backwards_ensemble_order:
+        print cost_model.report(e_name, "backward", bp_codes.get(e_name))
+
+def make_analysis(networks2enms, ensembles_info, forwards_ensemble_order, \
+                  backwards_ensemble_order):
+    """summary of the analysis of a program, cached with its cpp file"""
+    ensembles = []
+    for x in ensembles_info:
+        ensemble = dict((key, x[-1][key]) for key in \
+                ("name", "type", "prev", "dim_x", "dim_y", "Neuron", "uniform_dep", "one2one"))
+        ensemble['connection'] = str(x[-1].get('connection'))
+        ensembles.append(ensemble)
+    return {
+        "networks": dict((net_name, [ x['name'] for x in layers ]) \
+                         for net_name, layers in networks2enms.iteritems()),
+        "ensembles": ensembles,
+        "forward_order": forwards_ensemble_order,
+        "backward_order": backwards_ensemble_order
+    }
+
+def apply_tuning(options, program_file):
+    """set the options tuned for the shape of the network of program_file
+    that are not given on the command line"""
+    configs = autotune.load_configs(getattr(options, "TUNING_FILE", None))
+    if len(configs) == 0: return
+    shape = autotune.network_shape(program_file)
+    if shape not in configs: return
+    applied = autotune.apply_config(options, configs[shape])
+    term.dump("TUNED: %s" % ", ".join("%s=%s" % (key, getattr(options, key)) \
+                                      for key in applied), term.OKGREEN)
+
+def report_profile(options, prof):
+    """print the compile-time profile and dump it to the --profile file"""
+    prof.end()
+    profile_file = getattr(options, "PROFILE", None)
+    if profile_file is None: return
+    term.dump("COMPILE PROFILE ---------------------------", term.OKBLUE)
+    print prof
+    prof.dump(profile_file)
+
 def main(options, program_file, cpp_file):
+    prof = CompileProfiler()
+    # structure ids are only compared within a program, do not let them
+    # pile up over the lines of --batch
+    clear_structures()
     # Front-end: processing program_file here
+    prof.begin("compile_check")
     py_compile.compile(program_file)
+
+    # options tuned by autotune.py for the shape of the network, then the
+    # defaults of the options neither given nor tuned
+    if not getattr(options, "NO_TUNING", False):
+        prof.begin("tuning")
+        apply_tuning(options, program_file)
+    autotune.apply_defaults(options)
+
+    # reuse the program generated from the same inputs, except when
+    # profiling since a cache hit would skip all the phases to profile; the
+    # regenerated program is still stored
+    use_cache = not getattr(options, "NO_CACHE", False)
+    if use_cache:
+        prof.begin("cache_lookup")
+        cache_dir = getattr(options, "CACHE_DIR", None) or compile_cache.CACHE_DIR
+        cache_key = compile_cache.fingerprint(program_file, options)
+        analysis = None
+        if getattr(options, "PROFILE", None) is None:
+            analysis = compile_cache.lookup(cache_dir, cache_key, cpp_file)
+        if analysis is not None:
+            term.dump("CACHE HIT: %s" % cache_key, term.OKGREEN)
+            for net_name, layers in analysis['networks'].iteritems():
+                print "Network %s:" % net_name, layers
+            for ensemble in analysis['ensembles']:
+                print ensemble
+            return
+
+    prof.begin("parse")
     AST = ast_parse_file(program_file)  # get AST
 
     # managing info
     networks2enms = {}
 
-    # pattern matching
+    # pattern matching: a single pass over the statements of the program
+    prof.begin("match")
+    program_templates.matchall(AST)
+
     # (a) network
     patn_net = template_Network()
-    matched = patn_net.matchall(AST)
+    matched = len(patn_net.matches) > 0
 
     print "Network Matched: ", matched
 
@@ -449,7 +631,7 @@ def main(options, program_file, cpp_file):
     # (b) Layers
     # match all layers in AST
     for patn_layer in layer_templates:
-        matched = patn_layer.matchall(AST)
+        matched = len(patn_layer.matches) > 0
         print patn_layer, "Matched: ", matched
         if matched:
             for layer in patn_layer.matches:
@@ -472,6 +654,7 @@ def main(options, program_file, cpp_file):
                 networks2enms[net_name].append(layer)
     print "###########################################"
     # put the layers in correct order by looking for their previous layer
+    prof.begin("layer_order")
     for net_name in networks2enms.iterkeys():
         layer_names = map(lambda x: x['name'], networks2enms[net_name])
         layer_dict = dict(zip(layer_names, networks2enms[net_name]))
@@ -495,13 +678,13 @@ def main(options, program_file, cpp_file):
 
     # (c) Solvers
     solver = None
-    patn_solver = template_SGD()
-    matched = patn_solver.matchall(AST)
-    print "SGD Matched: ", matched
-    if matched:
-        for sgd in patn_solver.matches: 
-            print sgd
-            solver = sgd
+    for patn_solver in solver_templates:
+        matched = len(patn_solver.matches) > 0
+        print patn_solver, "Matched: ", matched
+        if matched:
+            for sgd in patn_solver.matches: 
+                print sgd
+                solver = sgd
     print "###########################################"
 
     #####################################################################
@@ -526,27 +709,28 @@ def main(options, program_file, cpp_file):
     path = os.path.dirname(os.path.abspath(__file__))
     # parse the add_connection calls in stdlib
     # and perform the shared variable analysis
-    conn_types = process_add_connection(path + "/lib.py", name2enm)
+    prof.begin("add_connection")
+    conn_types = process_add_connection(path + "/lib.py", name2enm, options)
+    prof.begin("connection_checks")
     for net, ensembles in networks2enms.iteritems():
         for ensemble in ensembles:
             layer_type = ensemble['type']
-            if layer_type in conn_types:
-                args, mapping, _ = conn_types[layer_type]
-                uniform_dep = check_uniform_dependency(args, mapping, ensemble, name2enm)
-                one2one = check_one_to_one(args, mapping, ensemble, name2enm)
+            if 'connection' in ensemble:
+                conn = ensemble['connection']
+                uniform_dep = conn.is_uniform()
+                one2one = conn.is_one_to_one()
                 term.dump("Layer %s uniform dependency? %s" % (layer_type, \
                         uniform_dep), \
                         term.OKBLUE)
                 term.dump("Layer %s One-to-One? %s" % (layer_type, \
                         one2one), \
                         term.OKBLUE)
-                layer_info[layer_type] = (uniform_dep, one2one)
+                layer_info[ensemble['name']] = (uniform_dep, one2one)
 
     # update ensemble layer info
     for x in ensembles_info:
-        layer_type = x[1]
-        if layer_type in layer_info:
-            uniform_dep, one2one = layer_info[layer_type]
+        if x[0] in layer_info:
+            uniform_dep, one2one = layer_info[x[0]]
             x[-1]['uniform_dep'] = uniform_dep
             x[-1]['one2one'] = one2one
         else:
@@ -558,6 +742,7 @@ def main(options, program_file, cpp_file):
 
     # create the neuron analyzers and also pass in ensemble info in order to create
     # forward and backward propogation code
+    prof.begin("process_lib")
     neuron_analyzers, fp_codes, bp_codes, fp_code_list, bp_code_list = \
             process_lib(path + "/lib.py", ensembles_info, name2enm, conn_types, options)
     # for x in neuron_analyzers: print x, neuron_analyzers[x].fields
@@ -582,33 +767,48 @@ def main(options, program_file, cpp_file):
 
     tiling_flag = options.TILING_FLAG
 
+    cost_model = make_cost_model(options, name2enm)
+
     # if tiling flag is set, then run the tiling
     tiling_flag = options.TILING_FLAG
     if tiling_flag:
-        # forward
-        opt1 = TilingOptimizer(fp_codes, forwards_ensemble_order)
-        forwards_ensemble_order = opt1.optimize()
-
-        # backward
-        opt2 = TilingOptimizer(bp_codes, backwards_ensemble_order)
-        backwards_ensemble_order = opt2.optimize()
+        prof.begin("tiling")
+        prof.add_ir_size("tiling", "forward", fp_codes, forwards_ensemble_order, "before")
+        prof.add_ir_size("tiling", "backward", bp_codes, backwards_ensemble_order, "before")
+        tile_sizes = make_tile_sizes(options)
+        if cost_model is not None:
+            plan_tiles(cost_model, tile_sizes, ensembles_info, fp_codes, bp_codes)
+        print "tile sizes:", tile_sizes.to_dict()
+        # forward and backward
+        forwards_ensemble_order, backwards_ensemble_order = run_optimizers(options, [
+            (TilingOptimizer, (fp_codes, forwards_ensemble_order, tile_sizes)),
+            (TilingOptimizer, (bp_codes, backwards_ensemble_order, tile_sizes)) ])
+        prof.add_ir_size("tiling", "forward", fp_codes, forwards_ensemble_order, "after")
+        prof.add_ir_size("tiling", "backward", bp_codes, backwards_ensemble_order, "after")
 
     fusion_flag = options.FUSION_FLAG
 
     #TODO check this later for correctness
     # if fusion set, do fusion
     if fusion_flag:
-        # forward
-        opt1 = FusionOptimizer(fp_codes, forwards_ensemble_order, 
-                               ensembles_info, name2enm, tiling_flag)
-        forwards_ensemble_order = opt1.optimize()
-
-        # backward
-        opt2 = FusionOptimizer(bp_codes, backwards_ensemble_order, 
-                               ensembles_info, name2enm, tiling_flag)
-        backwards_ensemble_order = opt2.optimize()
+        prof.begin("fusion")
+        prof.add_ir_size("fusion", "forward", fp_codes, forwards_ensemble_order, "before")
+        prof.add_ir_size("fusion", "backward", bp_codes, backwards_ensemble_order, "before")
+        # forward and backward
+        forwards_ensemble_order, backwards_ensemble_order = run_optimizers(options, [
+            (FusionOptimizer, (fp_codes, forwards_ensemble_order,
+                               ensembles_info, name2enm, tiling_flag, cost_model)),
+            (FusionOptimizer, (bp_codes, backwards_ensemble_order,
+                               ensembles_info, name2enm, tiling_flag, cost_model)) ])
+        prof.add_ir_size("fusion", "forward", fp_codes, forwards_ensemble_order, "after")
+        prof.add_ir_size("fusion", "backward", bp_codes, backwards_ensemble_order, "after")
+
+    if cost_model is not None:
+        report_cost_model(cost_model, fp_codes, bp_codes, forwards_ensemble_order, \
+                          backwards_ensemble_order)
 
     # CODE GENERATION:
+    prof.begin("emission")
     main_body_strs = []
 
     # OMP initialization block
@@ -634,7 +834,7 @@ def main(options, program_file, cpp_file):
                           backwards_ensemble_order))
 
     # run tester
-    main_body_strs.append(make_test_block(solver, ensembles_info, name2enm, fp_codes,
+    main_body_strs.append(make_test_block(options, solver, ensembles_info, name2enm, fp_codes,
                           forwards_ensemble_order, backwards_ensemble_order))
 
     # # deallocating block
@@ -655,25 +855,106 @@ def main(options, program_file, cpp_file):
         cpp_out.write(make_newlines(1))
     cpp_out.write("}") # ending bracket
     cpp_out.close()
+
+    if use_cache:
+        prof.begin("cache_store")
+        compile_cache.store(cache_dir, cache_key, cpp_file, \
+                make_analysis(networks2enms, ensembles_info, \
+                              forwards_ensemble_order, backwards_ensemble_order))
+    report_profile(options, prof)
     return
 
-if __name__ == "__main__":
-    usage = "usage: python generator.py [options] py_script cpp_out_file"
+def run_batch(parser, options, batch_file):
+    """
+    generate the programs of batch_file, one "[options] py_script
+    cpp_out_file" per line, in a single process so that the analysis of
+    lib.py is shared by all of them; options are the defaults of every line
+    """
+    fread = open(batch_file, "r")
+    lines = fread.readlines()
+    fread.close()
+    for line_no, line in enumerate(lines):
+        job = shlex.split(line, comments=True)
+        if len(job) == 0: continue
+        (job_options, job_args) = parser.parse_args(job, copy.deepcopy(options))
+        if len(job_args) != 2:
+            parser.error("%s:%d: incorrect number of arguments" % (batch_file, line_no + 1))
+        term.dump("BATCH %d: %s" % (line_no + 1, line.strip()), term.HEADER)
+        main(job_options, job_args[0], job_args[1])
+
+def make_option_parser():
+    usage = "usage: python generator.py [options] py_script cpp_out_file\n" + \
+            "       python generator.py [options] --batch batch_file"
     parser = OptionParser(usage=usage)
+    # the options tuned by autotune.py default to None when not given, see
+    # autotune.TUNED_DEFAULTS
     parser.add_option("-m", "--mkl", action="store_true", dest="MKL_FLAG", \
-                      default=False, help="option to turn on pattern match for MKL calls.")
+                      default=None, help="option to turn on pattern match for MKL calls.")
     parser.add_option("-b", "--batch-parallel", action="store_true", dest="DP_FLAG", \
-                      default=False, help="option to turn on batch parallelization.")
+                      default=None, help="option to turn on batch parallelization.")
     parser.add_option("-t", "--tiling-parallel", action="store_true", dest="TILING_FLAG", \
-                      default=False, help="option to turn on loop tiling.")
+                      default=None, help="option to turn on loop tiling.")
     parser.add_option("-w", "--numWorkers", action="store", type="int", dest="NWORKERS", \
-                      default=1, help="Specify the allocated number of threads \
+                      default=None, help="Specify the allocated number of threads \
                       for parallel computing (needed when -b or -t is on)")
     parser.add_option("-f", "--fusion", action="store_true", dest="FUSION_FLAG", \
-                      default=False, help="option to turn on fusion functionality.")
+                      default=None, help="option to turn on fusion functionality.")
+    parser.add_option("", "--tile-size", action="store", type="int", dest="TILE_SIZE", \
+                      default=None, help="tile size of the x/y loops of the ensembles \
+                      (needed when -t is on).")
+    parser.add_option("", "--tile", action="append", type="string", dest="TILE_SPECS", \
+                      default=None, help="tile sizes of a loop, outer level first, \
+                      as [ensemble.]loop_var=size[,size..], e.g. ip1_enm.j=256,32; \
+                      may be repeated.")
+    parser.add_option("", "--tile-config", action="store", type="string", dest="TILE_CONFIG", \
+                      default=None, help="json file of the tile sizes of every \
+                      ensemble and loop variable.")
+    parser.add_option("", "--cost-model", action="store_true", dest="COST_MODEL", \
+                      default=False, help="choose the tile sizes and decline the fusions \
+                      with a cache cost model, and report its estimates.")
+    parser.add_option("", "--cache-kb", action="store", type="int", dest="CACHE_KB", \
+                      default=None, help="cache size of the cost model in KB \
+                      (default: the L2 cache of this host).")
+    parser.add_option("", "--omp-schedule", action="store", type="choice", \
+                      choices=[ "static", "dynamic", "guided" ], dest="OMP_SCHEDULE", \
+                      default=None, help="omp schedule of the batch parallel loop.")
+    parser.add_option("", "--omp-chunk", action="store", type="int", dest="OMP_CHUNK", \
+                      default=None, help="omp chunk size of the batch parallel loop, \
+                      0 for the default of the schedule.")
+    parser.add_option("", "--max-samples", action="store", type="int", dest="MAX_SAMPLES", \
+                      default=None, help="train on at most this many samples.")
     parser.add_option("-v", "--verbose", action="store_true", dest="verbose", help="verbose")
     parser.add_option("", "--mini", action="store_true", dest="mini", help="mini")
+    parser.add_option("", "--no-cache", action="store_true", dest="NO_CACHE", \
+                      default=False, help="always regenerate, bypassing the compilation cache.")
+    parser.add_option("", "--cache-dir", action="store", type="string", dest="CACHE_DIR", \
+                      default=None, help="directory of the compilation cache \
+                      (default: %s)" % compile_cache.CACHE_DIR)
+    parser.add_option("", "--profile", action="store", type="string", dest="PROFILE", \
+                      default=None, help="report the wall time and peak memory of every \
+                      compiler phase and write them as JSON to a file; the program \
+                      is regenerated even if it is in the compilation cache.")
+    parser.add_option("-j", "--jobs", action="store", type="int", dest="JOBS", \
+                      default=1, help="number of processes analyzing the ensembles \
+                      and running the optimizers.")
+    parser.add_option("", "--no-tuning", action="store_true", dest="NO_TUNING", \
+                      default=False, help="ignore the configuration tuned by autotune.py.")
+    parser.add_option("", "--tuning-file", action="store", type="string", dest="TUNING_FILE", \
+                      default=None, help="file of the tuned configurations \
+                      (default: %s)" % autotune.TUNING_FILE)
+    parser.add_option("", "--batch", action="store", type="string", dest="BATCH", \
+                      default=None, help="generate every '[options] py_script cpp_out_file' \
+                      line of a file in one process.")
+    return parser
+
+if __name__ == "__main__":
+    parser = make_option_parser()
     (options, args) = parser.parse_args()
+    if options.BATCH is not None:
+        if len(args) != 0:
+            parser.error("no py_script or cpp_out_file expected with --batch")
+        run_batch(parser, options, options.BATCH)
+        sys.exit(0)
     if len(args) != 2: 
         parser.print_help()
         parser.error("incorrect number of arguments")
@@ -0,0 +1,128 @@
+'''
+    Vectorized ensemble kernels for the array engine of the reference runtime
+'''
+import numpy as np
+
+def as_matrix(buf):
+    """view a (dim_x, dim_y, prev_dim_x, prev_dim_y) buffer as a
+    (size, prev_size) matrix, one row per neuron"""
+    return buf.reshape(buf.shape[0] * buf.shape[1], -1)
+
+def as_batch(buf):
+    """view a (batch_size, dim_x, dim_y) buffer as a (batch_size, size) matrix"""
+    return buf.reshape(buf.shape[0], -1)
+
+class EnsembleKernel(object):
+    """
+    Runs forward/backward of a built-in neuron type over a whole
+    ensemble and all instances of its mini-batch at once, reading
+    and writing the ndarray buffers owned by the ensemble instead
+    of the neuron objects
+    """
+    # ensemble-level operations run in every engine, the neuron
+    # code of such types only specifies them for the compiler
+    ensemble_level = False
+
+    def forward(self, enm): pass
+
+    def backward(self, enm): pass
+
+    def annotate(self, enm): pass
+
+class WeightedKernel(EnsembleKernel):
+    """WeightedNeuron: inner product of inputs and weights"""
+    def weighted_sum(self, enm):
+        inputs = as_batch(enm.prev_adj_enm.output)
+        return np.dot(inputs, as_matrix(enm.weights).T).reshape(enm.output.shape)
+
+    def activate(self, enm, z):
+        enm.output[...] = z
+        enm.grad_activation.fill(1.0)
+
+    def forward(self, enm):
+        self.activate(enm, self.weighted_sum(enm))
+
+    def error(self, enm):
+        return enm.grad_output * enm.grad_activation
+
+    def backward(self, enm):
+        prev = enm.prev_adj_enm
+        enm.grad_output[...] = self.error(enm)
+        grad = as_batch(enm.grad_output)
+        # backpropagate error
+        prev.grad_output += np.dot(grad, as_matrix(enm.weights)).reshape(prev.grad_output.shape)
+        # weights to update, accumulated over the batch; only the
+        # connected ones are computed unless every input is connected
+        inputs = as_batch(prev.output)
+        grad_weights_mat = as_matrix(enm.grad_weights)
+        pairs = enm.connection.pairs()
+        if pairs is None:
+            grad_weights_mat += np.dot(grad.T, inputs)
+        else:
+            neurons, flat = pairs
+            grad_weights_mat[neurons, flat] += \
+                np.einsum("bk,bk->k", grad[:, neurons], inputs[:, flat])
+
+class FCKernel(WeightedKernel):
+    """FCNeuron: weighted sum with tanh activation"""
+    def activate(self, enm, z):
+        np.tanh(z, out=enm.output)
+        enm.grad_activation[...] = 1 - enm.output ** 2
+
+class ReLUKernel(WeightedKernel):
+    """ReLUNeuron: weighted sum with softplus activation"""
+    def activate(self, enm, z):
+        enm.grad_activation[...] = 1.0 / (1 + np.exp(-1.0 * z))  # logistic
+        enm.output[...] = np.log(np.exp(z) + 1)                 # softplus
+
+class SoftmaxKernel(WeightedKernel):
+    """
+    SoftmaxNeuron: forward leaves the weighted sums (logits) in output,
+    annotate turns them into probabilities and computes the cross-entropy
+    loss of every instance, subtracting the max logit so that exp never
+    overflows
+    """
+    ensemble_level = True
+
+    def activate(self, enm, z):
+        enm.output[...] = z
+
+    def annotate(self, enm):
+        logits = enm.output - enm.output.max(axis=(1, 2), keepdims=True)
+        np.exp(logits, out=enm.output)
+        sums = enm.output.sum(axis=(1, 2), keepdims=True)
+        enm.output /= sums
+        if enm.label is not None:
+            # -log(p[label]) = log(sum(exp(logits))) - logits[label]
+            enm.loss = np.log(sums.ravel()) - (logits * enm.label).sum(axis=(1, 2))
+
+    def error(self, enm):
+        return enm.output - enm.label
+
+class MeanPoolingKernel(EnsembleKernel):
+    """MeanPoolingNeuron: average over the connected window"""
+    def pool_size(self, enm):
+        neuron = enm.neurons[0][0]
+        return float(neuron.pool_dim_x * neuron.pool_dim_y)
+
+    def forward(self, enm):
+        pool_size = self.pool_size(enm)
+        enm.output[...] = enm.connection.sum_inputs(enm.prev_adj_enm.output) / pool_size
+        # preset the gradient for back propagation
+        enm.grad_activation.fill(1.0 / pool_size)
+
+    def backward(self, enm):
+        prev = enm.prev_adj_enm
+        enm.grad_output *= enm.grad_activation
+        # backpropagate error
+        grad = enm.grad_output / self.pool_size(enm)
+        enm.connection.scatter_inputs(grad, prev.grad_output)
+
+''' kernels of built-in neuron types, keyed by neuron class name '''
+ensemble_kernels = {
+    "WeightedNeuron": WeightedKernel(),
+    "FCNeuron": FCKernel(),
+    "ReLUNeuron": ReLUKernel(),
+    "SoftmaxNeuron": SoftmaxKernel(),
+    "MeanPoolingNeuron": MeanPoolingKernel()
+}
@@ -4,27 +4,57 @@
 import sys
 import numpy as np
 import math
-import random 
 import time
+import multiprocessing
+import kernels
+import connection
+import data
+import profiler
 
-def Xaiver_weights_init (dim_x, dim_y, cur_enm_size):
+'''
+    Execution engine of the reference runtime:
+        "neuron": run Neuron.forward()/backward() of every neuron
+        "array":  run whole-ensemble kernels on the ndarray buffers
+                  for built-in neuron types, and fall back to the
+                  neuron path for user-defined ones
+'''
+ENGINE = "neuron"
+
+def set_engine(engine):
+    global ENGINE
+    assert engine in ("neuron", "array"), "unknown engine: %s" % engine
+    ENGINE = engine
+
+'''
+    Profiler of the training stages, None when profiling is disabled
+'''
+PROFILER = None
+
+def set_profiler(prof):
+    global PROFILER
+    assert prof is None or isinstance(prof, profiler.Profiler)
+    PROFILER = prof
+
+def profile_call(stage, name, func, *args):
+    """call func(*args), timed when profiling is enabled"""
+    if PROFILER is None:
+        return func(*args)
+    return PROFILER.call(stage, name, func, *args)
+
+def Xaiver_weights_init (dim_x, dim_y, cur_enm_size, lead_dims=()):
     prev_enm_size = dim_x * dim_y;
     high = np.sqrt( 6.0 / (prev_enm_size + cur_enm_size) )
     low = -1.0 * high 
-    result = []
-    for i in range(dim_x):
-        result.append([ np.random.uniform(low, high) for j in range(dim_y) ])
-    #print result
-    return result
+    return np.random.uniform(low, high, tuple(lead_dims) + (dim_x, dim_y))
 
 def add_connection (net, prev_enm, cur_enm, mappings):
-    #TODO deprecated? will we end up using this?
+    cur_enm.set_backward_adj(prev_enm)
+    prev_enm.set_forward_adj(cur_enm)
 
-    # update adjacency lists
-    for i, indices in mappings.iteritems():
-        assert 0 <= i and i < prev_enm.get_size()
-        prev_enm[0][i].forward_adj = [ cur_enm[0][j] for j in indices ]
-        for j in indices: cur_enm[0][j].backward_adj.append(prev_enm[0][i])
+    # adjacency lists are not stored, neurons read them from the descriptor
+    cur_enm.set_connection(connection.describe_mapping(mappings, \
+            cur_enm.dim_x, cur_enm.dim_y, prev_enm.dim_x, prev_enm.dim_y))
+    cur_enm.set_inputs_dim(prev_enm.dim_x, prev_enm.dim_y)
     return
 
 ''' 
@@ -50,6 +80,24 @@ def read_libsvm (file_name, fea_dim_x, fea_dim_y):
     fread.close()
     return features, labels
 
+def LibsvmDataLayer(net, train_file, test_file, dim_x, dim_y, nLabels):
+    # datasets are memory mapped from their binary caches
+    train_features, train_labels = data.load_dataset(train_file, "libsvm", dim_x, dim_y)
+    test_features, test_labels = data.load_dataset(test_file, "libsvm", dim_x, dim_y)
+    data_enm = Ensemble(dim_x, dim_y, DataNeuron)
+    net.set_data_ensemble(data_enm)
+    net.set_datasets(train_features, train_labels, test_features, test_labels)
+    return data_enm
+
+def MnistDataLayer(net, train_file, test_file, dim_x, dim_y, nLabels):
+    train_features, train_labels = data.load_dataset(train_file, "mnist", dim_x, dim_y)
+    test_features, test_labels = data.load_dataset(test_file, "mnist", dim_x, dim_y)
+    data_enm = Ensemble(dim_x, dim_y, DataNeuron)
+    net.set_data_ensemble(data_enm)
+    # mnist digits start from 0, while labels start from 1 in the runtime
+    net.set_datasets(train_features, train_labels + 1, test_features, test_labels + 1)
+    return data_enm
+
 def FullyConnectedLayer(net, prev, dim_x, dim_y, TYPE):
     # construct a new ensemble
     cur_enm = Ensemble(dim_x, dim_y, TYPE)
@@ -72,6 +120,7 @@ def ConvolutionLayer(net, prev, dim_x, dim_y, TYPE, ker_dim_x, ker_dim_y):
          [ (i,j) for i in range(x, x+ker_dim_x) \
                  for j in range(y, y+ker_dim_y) ])
     net.add_ensemble (cur_enm)
+    return cur_enm
 
 def PoolingLayer(net, prev, dim_x, dim_y, TYPE, pool_dim_x, pool_dim_y):
     '''
@@ -80,14 +129,15 @@ def PoolingLayer(net, prev, dim_x, dim_y, TYPE, pool_dim_x, pool_dim_y):
         assert prev_dim_x / pool_dim_x == dim_x
         assert prev_dim_y / pool_dim_y == dim_y
     '''
-    cur_enm = Ensemble(dim_x, dim_y, TYPE)
+    cur_enm = Ensemble(dim_x, dim_y, TYPE, \
+                       pool_dim_x=pool_dim_x, pool_dim_y=pool_dim_y)
     add_connection(net, prev, cur_enm, lambda x, y: \
          [ (i,j) for i in range(x*pool_dim_x, (x+1)*pool_dim_x) \
                  for j in range(y*pool_dim_y, (y+1)*pool_dim_y) ])
     net.add_ensemble (cur_enm)
+    return cur_enm
 
 def SoftmaxLossLayer(net, prev, dim_x, dim_y):
-    label_enm = Ensemble(1, nLabels, SoftmaxNeuron)
     return FullyConnectedLayer(net, prev, dim_x, dim_y, SoftmaxNeuron)
 
 def One2OneLayer(net, prev, dim_x, dim_y, TYPE):
@@ -95,9 +145,89 @@ def One2OneLayer(net, prev, dim_x, dim_y, TYPE):
     add_connection(net, prev, cur_enm, lambda x, y: \
          [ (i,j) for i in range(x, x+1) \
                  for j in range(y, y+1) ])
+    net.add_ensemble (cur_enm)
     return cur_enm
 
-class Neuron:
+class Adjacency(object):
+    """adjacency list of a neuron, iterated from the connection
+    descriptor of its ensemble instead of being stored"""
+    def __init__(self, enm, flat_indices):
+        self.enm = enm
+        self.flat_indices = flat_indices
+
+    def __len__(self): return len(self.flat_indices)
+
+    def __iter__(self):
+        for k in self.flat_indices:
+            yield self.enm.neurons[k // self.enm.dim_y][k % self.enm.dim_y]
+
+class EnsembleField(object):
+    """
+    field of a neuron stored at (pos_x, pos_y) of the (batch_size, dim_x,
+    dim_y) buffer of its ensemble, for the instance being processed.
+    Assigning a field before its buffer exists declares it.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, neuron, owner):
+        if neuron is None: return self
+        enm = neuron.enm
+        buf = getattr(enm, self.name)
+        if buf is None: return None
+        return buf[enm.instance, neuron.pos_x, neuron.pos_y]
+
+    def __set__(self, neuron, value):
+        enm = neuron.enm
+        buf = getattr(enm, self.name)
+        if buf is None:
+            enm.neuron_fields.add(self.name)
+            return
+        buf[enm.instance, neuron.pos_x, neuron.pos_y] = value
+
+class WeightsField(EnsembleField):
+    """weights of a neuron, a (prev_dim_x, prev_dim_y) view into the
+    (dim_x, dim_y, prev_dim_x, prev_dim_y) buffer of its ensemble"""
+    def __get__(self, neuron, owner):
+        if neuron is None: return self
+        buf = getattr(neuron.enm, self.name)
+        if buf is None: return None
+        return buf[neuron.pos_x, neuron.pos_y]
+
+    def __set__(self, neuron, value):
+        buf = getattr(neuron.enm, self.name)
+        if buf is None:
+            neuron.enm.neuron_fields.add(self.name)
+            return
+        buf[neuron.pos_x, neuron.pos_y] = value
+
+class InputsField(EnsembleField):
+    """inputs of a neuron, a view into the buffer of the previous
+    ensemble for the instance being processed"""
+    def __get__(self, neuron, owner):
+        if neuron is None: return self
+        enm = neuron.enm
+        if enm.prev_adj_enm is None: return None
+        return getattr(enm.prev_adj_enm, self.name)[enm.instance]
+
+    def __set__(self, neuron, value):
+        # inputs always alias the buffers of the previous ensemble
+        pass
+
+class Neuron(object):
+    # neurons only keep their position, every other field lives
+    # in the buffers of the ensemble
+    __slots__ = ("pos_x", "pos_y", "prev_dim_x", "prev_dim_y", "enm")
+
+    inputs          = InputsField("output")
+    grad_inputs     = InputsField("grad_output")
+    output          = EnsembleField("output")
+    grad_output     = EnsembleField("grad_output")
+    grad_activation = EnsembleField("grad_activation")
+    label           = EnsembleField("label")
+    weights         = WeightsField("weights")
+    grad_weights    = WeightsField("grad_weights")
+
     def __init__(self, enm, pos_x, pos_y):
         # management info
         self.pos_x = pos_x
@@ -112,21 +242,32 @@ class Neuron:
         self.grad_output  = 0.0   # bp: restore error of self
 
         self.grad_activation = 0.0
-        # architecture info
-        self.forward_adj  = []  # forward adjacency list
-        self.backward_adj = []  # backward adjacency list
         return 
 
     def __eq__(self, other):
         return self.neuron_id == other.neuron_id
 
+    # architecture info
+    @property
+    def forward_adj(self):
+        """forward adjacency list"""
+        next_enm = self.enm.next_adj_enm
+        if next_enm is None or next_enm.connection is None:
+            return Adjacency(self.enm, [])
+        return Adjacency(next_enm, \
+                next_enm.connection.forward_flat_indices(self.pos_x, self.pos_y))
+
+    @property
+    def backward_adj(self):
+        """backward adjacency list"""
+        if self.enm.connection is None:
+            return Adjacency(self.enm, [])
+        return Adjacency(self.enm.prev_adj_enm, \
+                self.enm.connection.flat_indices(self.pos_x, self.pos_y))
+
     def init_inputs_dim (self, dim_x, dim_y):
         self.prev_dim_x = dim_x
         self.prev_dim_y = dim_y
-        self.inputs      = [ [0.0] * dim_y ] * dim_x
-        self.weights     = Xaiver_weights_init (dim_x, dim_y, self.enm.get_size())
-        self.grad_inputs = [ [0.0] * dim_y ] * dim_x
-        self.grad_weights= [ [0.0] * dim_y ] * dim_x
 
     def forward(self): pass
 
@@ -140,6 +281,8 @@ class Neuron:
         self.grad_output = 0.0
 
 class FCNeuron(Neuron):
+    __slots__ = ()
+
     def __init__(self, enm, pos_x, pos_y):
         Neuron.__init__(self, enm, pos_x, pos_y)
         self.weights      = [[]]
@@ -147,8 +290,9 @@ class FCNeuron(Neuron):
         return 
 
     def forward(self):
-        # innder product of inputs and weights
-        assert len(self.forward_adj) > 0, "No forward adjacency element. "
+        # innder product of inputs and weights; a neuron no next neuron
+        # reads (e.g. outside every window of a convolution) still runs,
+        # its grad_output just stays 0 so its weights are not updated
         self.output = 0.0 
         for prev in self.backward_adj:
             self.output += self.weights[prev.pos_x][prev.pos_y] * self.inputs[prev.pos_x][prev.pos_y]
@@ -168,6 +312,8 @@ class FCNeuron(Neuron):
 
 
 class WeightedNeuron(Neuron):
+    __slots__ = ()
+
     def __init__(self, enm, pos_x, pos_y):
         Neuron.__init__(self, enm, pos_x, pos_y)
         self.weights      = [[]]
@@ -191,14 +337,17 @@ class WeightedNeuron(Neuron):
             self.grad_weights[prev.pos_x][prev.pos_y] += self.grad_output * self.inputs[prev.pos_x][prev.pos_y]
 
 class ReLUNeuron(Neuron):
+    __slots__ = ()
+
     def __init__(self, enm, pos_x, pos_y):
         Neuron.__init__(self, enm, pos_x, pos_y)
         self.weights      = [[]]
         self.grad_weights = [[]]
 
     def forward(self):
-        # innder product of inputs and weights
-        assert len(self.forward_adj) > 0, "No forward adjacency element. "
+        # innder product of inputs and weights; a neuron no next neuron
+        # reads (e.g. outside every window of a convolution) still runs,
+        # its grad_output just stays 0 so its weights are not updated
         self.output = 0.0
         for prev in self.backward_adj:
             self.output += self.weights[prev.pos_x][prev.pos_y] * self.inputs[prev.pos_x][prev.pos_y]
@@ -215,8 +364,10 @@ class ReLUNeuron(Neuron):
             self.grad_weights[prev.pos_x][prev.pos_y] += self.grad_output * self.inputs[prev.pos_x][prev.pos_y]
 
 class MeanPoolingNeuron(Neuron):
-    def __init__(self, enm, pos_x, pos_y):
-        Neuron.__init__(self, enm, pos_x, pos_y, pool_dim_x, pool_dim_y)
+    __slots__ = ("pool_dim_x", "pool_dim_y")
+
+    def __init__(self, enm, pos_x, pos_y, pool_dim_x=1, pool_dim_y=1):
+        Neuron.__init__(self, enm, pos_x, pos_y)
         self.pool_dim_x = pool_dim_x
         self.pool_dim_y = pool_dim_y
 
@@ -235,6 +386,8 @@ class MeanPoolingNeuron(Neuron):
             prev.grad_output += self.grad_output / (self.pool_dim_x * self.pool_dim_y) 
         
 class DataNeuron(Neuron):
+    __slots__ = ()
+
     def __init__(self, enm, pos_x, pos_y):
         Neuron.__init__(self, enm, pos_x, pos_y)
     
@@ -248,6 +401,8 @@ class DataNeuron(Neuron):
         pass # no backward propagation for data neuron
 
 class SigmoidNeuron(Neuron):
+    __slots__ = ()
+
     def __init__(self, enm, pos_x, pos_y):
         Neuron.__init__(self, enm, pos_x, pos_y)
         self.weights      = [[]]
@@ -260,6 +415,8 @@ class SigmoidNeuron(Neuron):
         pass 
 
 class SoftmaxNeuron(Neuron):
+    __slots__ = ()
+
     def __init__(self, enm, pos_x, pos_y):
         Neuron.__init__(self, enm, pos_x, pos_y)
         self.label = None
@@ -272,11 +429,8 @@ class SoftmaxNeuron(Neuron):
             self.output += self.weights[prev.pos_x][prev.pos_y] * self.inputs[prev.pos_x][prev.pos_y]
         self.output = math.exp(self.output)
 
-    # NOTE: remember to invoke this annotate() and before backward
-    def annotate(self):
-        size = self.enm.get_size()
-        divisor = sum( [ self.enm.neurons[0][i].output for i in range(size) ] )
-        self.output = self.output / divisor
+    # NOTE: the runtime normalizes the whole ensemble at once before
+    # backward, with the max logit subtracted (kernels.SoftmaxKernel)
 
     def backward(self):
         self.grad_output = self.output - self.label 
@@ -289,12 +443,31 @@ class SoftmaxNeuron(Neuron):
 
 
 class Ensemble:
-    def __init__(self, N1, N2, TYPE, share_weights=False):
+    def __init__(self, N1, N2, TYPE, share_weights=False, **neuron_args):
         self.dim_x = N1
         self.dim_y = N2
         self.size = N1 * N2
+        self.TYPE = TYPE
+        self.name = TYPE.__name__     # set by the network, used in profiles
+        self.share_weights = share_weights
+        # ensemble-level buffers, the array engine computes on them directly
+        # (batch_size, N1, N2): one slice per instance of the mini-batch
+        self.batch_size      = 1
+        self.output          = np.zeros((1, N1, N2))
+        self.grad_output     = np.zeros((1, N1, N2))
+        self.grad_activation = np.zeros((1, N1, N2))
+        self.label           = None     # one-hot labels of the loss layer
+        self.loss            = None     # cross-entropy of each instance, set by annotate
+        self.weights         = None     # (N1, N2, prev_dim_x, prev_dim_y)
+        self.grad_weights    = None
+        self.connection      = None     # descriptor of the connections to prev_adj_enm
+        # the neuron path reads and writes instance `instance` of the buffers
+        self.instance        = 0
+        self.neuron_fields   = set()    # fields declared by the neuron type
+        self.shared_memory   = False    # weights visible to forked processes
+        self.shared_grads    = None     # (workers,) + weights.shape, see HogwildSGD
         # NOTE: currently only allow 1-d ensemble
-        self.neurons = [ [ TYPE(self, i, j) for j in range(N2) ] for i in range(N1) ]
+        self.neurons = [ [ TYPE(self, i, j, **neuron_args) for j in range(N2) ] for i in range(N1) ]
         self.prev_adj_enm = None
         self.next_adj_enm = None
         return  
@@ -309,19 +482,98 @@ class Ensemble:
     def get_size(self): return self.size
     def set_forward_adj(self, enm):  self.next_adj_enm = enm
     def set_backward_adj(self, enm): self.prev_adj_enm = enm
+    def set_connection(self, connection): self.connection = connection
     def set_inputs_dim(self, prev_dim_x, prev_dim_y):
+        # only neuron types declaring weights get weight buffers
+        if "weights" in self.neuron_fields:
+            self.weights = Xaiver_weights_init(prev_dim_x, prev_dim_y, \
+                    self.size, (self.dim_x, self.dim_y))
+            # unconnected weights are never read nor updated
+            pairs = self.connection.pairs()
+            if pairs is not None:
+                weights = kernels.as_matrix(self.weights)
+                connected = weights[pairs]
+                weights[...] = 0.0
+                weights[pairs] = connected
+            self.grad_weights = np.zeros_like(self.weights)
         for i in range(self.dim_x): 
             for j in range(self.dim_y): 
                 self.neurons[i][j].init_inputs_dim (prev_dim_x, prev_dim_y)
 
+    def share_memory(self):
+        """move the weights into shared memory, processes forked afterwards
+        read the updates made in place by this process"""
+        if self.weights is None or self.shared_memory:
+            return
+        shared = multiprocessing.RawArray('d', self.weights.size)
+        weights = np.frombuffer(shared, dtype=np.float64).reshape(self.weights.shape)
+        weights[...] = self.weights
+        self.weights = weights
+        self.shared_memory = True
+
+    def set_batch_size(self, batch_size):
+        """reallocate the per-instance buffers for a mini-batch"""
+        if batch_size == self.batch_size:
+            return
+        self.batch_size = batch_size
+        shape = (batch_size, self.dim_x, self.dim_y)
+        self.output          = np.zeros(shape)
+        self.grad_output     = np.zeros(shape)
+        self.grad_activation = np.zeros(shape)
+        if self.label is not None:
+            self.label       = np.zeros(shape)
+
+    def get_kernel(self):
+        """vectorized kernel of this ensemble, None for the neuron path"""
+        if self.prev_adj_enm is None:
+            return None
+        kernel = kernels.ensemble_kernels.get(self.TYPE.__name__)
+        if ENGINE != "array" and (kernel is None or not kernel.ensemble_level):
+            return None
+        return kernel
+
+    def bind_instance(self, b):
+        """point the fields of the neurons of this ensemble, and of the
+        previous one, to instance b of the batch"""
+        self.instance = b
+        if self.prev_adj_enm is not None:
+            self.prev_adj_enm.instance = b
+
     def run_forward_propagate(self):
-        for i in range(self.dim_x): 
-            for j in range(self.dim_y): 
-                self.neurons[i][j].forward()
+        kernel = self.get_kernel()
+        if kernel is not None:
+            kernel.forward(self)
+            return
+        for b in range(self.batch_size):
+            self.bind_instance(b)
+            for i in range(self.dim_x): 
+                for j in range(self.dim_y): 
+                    self.neurons[i][j].forward()
+
+    def run_annotate(self):
+        kernel = self.get_kernel()
+        if kernel is not None:
+            kernel.annotate(self)
+            return
+        if not hasattr(self.TYPE, "annotate"):
+            return
+        for b in range(self.batch_size):
+            self.bind_instance(b)
+            for i in range(self.dim_x): 
+                for j in range(self.dim_y): 
+                    self.neurons[i][j].annotate()
+
     def run_backward_propagate(self):
-        for i in range(self.dim_x): 
-            for j in range(self.dim_y): 
-                self.neurons[i][j].backward()
+        kernel = self.get_kernel()
+        if kernel is not None:
+            kernel.backward(self)
+            return
+        for b in range(self.batch_size):
+            self.bind_instance(b)
+            # grad_weights keep accumulating over the instances of the batch
+            for i in range(self.dim_x): 
+                for j in range(self.dim_y): 
+                    self.neurons[i][j].backward()
 
 class Network:
     def __init__(self):
@@ -330,6 +582,14 @@ class Network:
         self.train_labels = None
         self.test_features = None
         self.test_labels = None
+        # order in which training visits the instances, None for in order
+        self.train_order = None
+        # datasets read chunk by chunk instead of held in memory
+        self.train_stream = None
+        self.test_stream = None
+        # process pool of predict()
+        self.pool = None
+        self.pool_workers = 0
 
     def __eq__(self, other):
         return self.network_id == other.network_id
@@ -342,31 +602,55 @@ class Network:
 
     def add_ensemble(self, enm):
         assert isinstance(enm, Ensemble) and len(self.ensembles) >= 1
+        enm.name = "%d-%s" % (len(self.ensembles), enm.TYPE.__name__)
         self.ensembles.append(enm)
 
     def set_data_ensemble(self, data_enm):
         assert len(self.ensembles) == 0 # must be empty ensembles
+        data_enm.name = "0-%s" % data_enm.TYPE.__name__
         self.ensembles = [data_enm]
     
     def set_datasets (self, train_fea, train_labels, test_fea, test_labels, shuffle=True):
+        # the datasets are kept as given (memory mapped by the data layers):
+        # shuffling only permutes the order the instances are loaded in
+        self.train_features = train_fea
+        self.train_labels = train_labels
+        self.train_order = None
         if shuffle:
-            indexes = range(len(train_fea))
-            random.seed(1)
-            random.shuffle(indexes)
-            self.train_features, self.train_labels = [], []
-            for i in range(len(indexes)):
-                self.train_features.append(train_fea[indexes[i]])
-                self.train_labels.append(train_labels[indexes[i]])
-        else:
-            self.train_features = train_fea
-            self.train_labels = train_labels
+            self.train_order = np.random.RandomState(1).permutation(len(train_fea))
 
-        #for i in range(len(train_fea)):
-        #    print self.train_labels[i], self.train_features[i]
         self.test_features = test_fea
         self.test_labels = test_labels
 
+    def set_data_streams(self, train_stream, test_stream):
+        """use datasets yielding CSRChunks (e.g. data.LibsvmStream)"""
+        self.train_stream = train_stream
+        self.test_stream = test_stream
+
+    def has_datasets(self):
+        if self.train_stream is not None and self.test_stream is not None:
+            return True
+        return self.train_features is not None and self.train_labels is not None \
+           and self.test_features is not None and self.test_labels is not None
+
+    def set_batch_size(self, batch_size):
+        for enm in self.ensembles:
+            enm.set_batch_size(batch_size)
+
     def load_data_instance(self, idx, train=True):
+        self.load_data_batch([idx], train)
+
+    def instance_indices(self, indices, train=True):
+        """dataset indices of the instances at positions indices of an
+        epoch, the training set being visited in train_order"""
+        if train and self.train_order is not None:
+            return self.train_order[indices]
+        return indices
+
+    def load_data_batch(self, indices, train=True):
+        """load the instances (features and labels) at positions indices
+        of an epoch into the slices of the batch"""
+        indices = self.instance_indices(indices, train)
         if train: 
             features_mat = self.train_features
             labels_vec = self.train_labels
@@ -374,16 +658,104 @@ class Network:
             features_mat = self.test_features
             labels_vec = self.test_labels
 
-        dim_data = len(self.ensembles[0].neurons[0])
-        for i in range(dim_data):
-            self.ensembles[0].neurons[0][i].output = features_mat[idx][i]
-
-        dim_label = len(self.ensembles[-1].neurons[0])
-        for i in range(dim_label):
-            if i == labels_vec[idx] - 1:
-                self.ensembles[-1].neurons[0][i].label = 1
-            else: 
-                self.ensembles[-1].neurons[0][i].label = 0
+        features = np.array([ np.ravel(features_mat[idx]) for idx in indices ])
+        self.load_batch(features, [ labels_vec[idx] for idx in indices ])
+
+    def load_batch(self, features, labels=None):
+        """load a (batch_size, num_features) array of features and
+        their labels into the slices of the batch"""
+        self.set_batch_size(len(features))
+        data_enm = self.ensembles[0]
+        data_enm.output[...] = np.reshape(features, data_enm.output.shape)
+
+        label_enm = self.ensembles[-1]
+        if labels is None:
+            # no loss to compute
+            label_enm.label = None
+            return
+        if label_enm.label is None:
+            label_enm.label = np.zeros(label_enm.output.shape)
+        label_enm.label.fill(0)
+        dim_label = label_enm.dim_y
+        for b, label in enumerate(labels):
+            if 0 <= label - 1 < dim_label:
+                label_enm.label[b, 0, label - 1] = 1
+
+    def iter_datasets(self, train=True):
+        """(features, labels) of the dataset, chunk by chunk for streams"""
+        stream = self.train_stream if train else self.test_stream
+        if stream is not None:
+            for chunk in stream:
+                yield chunk, chunk.labels
+        elif train:
+            yield self.train_features, self.train_labels
+        else:
+            yield self.test_features, self.test_labels
+
+    def predict_batch(self, features):
+        """forward propagate a (batch_size, num_features) array, returning
+        the outputs of the last ensemble as (batch_size, size)"""
+        self.load_batch(features)
+        for enm in self.ensembles:
+            enm.run_forward_propagate()
+        self.ensembles[-1].run_annotate()
+        return self.ensembles[-1].output.reshape(len(features), -1).copy()
+
+    def get_pool(self, workers):
+        """process pool forked with this network, its weights in shared memory"""
+        global pool_net
+        if self.pool is not None and self.pool_workers == workers:
+            return self.pool
+        self.close_pool()
+        for enm in self.ensembles:
+            enm.share_memory()
+        pool_net = self
+        self.pool = multiprocessing.Pool(workers)
+        self.pool_workers = workers
+        return self.pool
+
+    def close_pool(self):
+        if self.pool is None: return
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        self.pool_workers = 0
+
+    def predict(self, features, batch_size=64, workers=1):
+        """
+        class probabilities (num_instances, size of the last ensemble) of
+        features, a sequence of instances or a data.CSRChunk, by forward
+        propagation only. With workers > 1 the batches are spread over a
+        process pool reading the weights of this network from shared memory
+        """
+        num_instances = len(features)
+        batches = [ data.dense_rows(features, begin, min(begin + batch_size, num_instances)) \
+                    for begin in range(0, num_instances, batch_size) ]
+        if len(batches) == 0:
+            return np.zeros((0, self.ensembles[-1].size))
+        if workers > 1:
+            probs = self.get_pool(workers).map(predict_worker, batches)
+        else:
+            probs = [ self.predict_batch(batch) for batch in batches ]
+        return np.concatenate(probs)
+
+    def iter_batches(self, batch_size, train=True):
+        """load the dataset batch by batch, yielding the labels of each
+        batch; streamed datasets are densified one batch at a time"""
+        stream = self.train_stream if train else self.test_stream
+        if stream is not None:
+            for chunk in stream:
+                for begin in range(0, len(chunk), batch_size):
+                    end = min(begin + batch_size, len(chunk))
+                    profile_call("load", "data", self.load_batch, \
+                            chunk.toarray(begin, end), chunk.labels[begin:end])
+                    yield chunk.labels[begin:end]
+            return
+        labels_vec = self.train_labels if train else self.test_labels
+        for begin in range(0, len(labels_vec), batch_size):
+            end = min(begin + batch_size, len(labels_vec))
+            profile_call("load", "data", self.load_data_batch, range(begin, end), train)
+            yield np.take(labels_vec, self.instance_indices(range(begin, end), train))
 
 class Solver:
     def __init__(self, iterations):
@@ -394,60 +766,190 @@ class Solver:
         pass
 
 class SGD(Solver):
-    def __init__(self, iterations, step_size):
+    def __init__(self, iterations, step_size, batch_size=1):
         Solver.__init__(self, iterations)
         self.alpha = step_size
+        # gradients are accumulated over a mini-batch and applied once
+        self.batch_size = batch_size
 
     def update_weights(self, net):
         for enm in net.ensembles: 
-            # print len(enm), len(enm[0])
-            for i in range(enm.dim_x):
-                for j in range(enm.dim_y):
-                    for prev in enm[i][j].backward_adj:
-                        # print i, j, prev.pos_x, prev.pos_y, len(enm[i][j].grad_weights), len(enm[i][j].grad_weights[0])
-                        enm[i][j].weights[prev.pos_x][prev.pos_y] -= enm[i][j].grad_weights[prev.pos_x][prev.pos_y]
-                        enm[i][j].clear_grad_weights()
+            profile_call("update", enm.name, self.update_ensemble_weights, enm)
+
+    def update_ensemble_weights(self, enm):
+        enm.grad_output.fill(0.0)
+        # data and pooling ensembles have no weights
+        if enm.weights is None: return
+        # weights -= alpha * grad_weights, then clear grad_weights,
+        # in place on the buffers of the whole ensemble
+        grad_weights = enm.grad_weights
+        grad_weights *= self.alpha
+        enm.weights -= grad_weights
+        grad_weights.fill(0.0)
+
+    def train_batch(self, net):
+        """forward and backward propagate the loaded batch, accumulating
+        grad_weights, and return the loss of the batch"""
+        for i in range(len(net.ensembles)): 
+            profile_call("forward", net[i].name, net[i].run_forward_propagate)
+        # softmax and loss of the whole batch
+        profile_call("annotate", net[-1].name, net[-1].run_annotate)
+        loss = 0.0
+        if net[-1].loss is not None:
+            loss = net[-1].loss.sum()
+        for i in reversed(range(len(net.ensembles))): 
+            profile_call("backward", net[i].name, net[i].run_backward_propagate)
+        return loss
+
+    def evaluate(self, net):
+        """accuracy of the network on the test dataset"""
+        nCorrect, test_size = 0, 0
+        for features, labels in net.iter_datasets(train=False):
+            preds = np.argmax(net.predict(features, self.batch_size), axis=1)
+            assert(len(preds) == len(labels)), "dimensionality of preds and test_size does not match"
+            nCorrect += np.sum(preds == np.asarray(labels) - 1)
+            test_size += len(labels)
+        return 1.0 * nCorrect / test_size
 
     def solve(self, net):
-        assert net.train_features is not None
-        assert net.train_labels is not None
-        assert net.test_features is not None
-        assert net.test_labels is not None
-        train_size = len(net.train_features)
-        test_size = len(net.test_features)
-        assert train_size == len(net.train_labels)
-        assert test_size == len(net.test_labels)
+        assert net.has_datasets()
+        if net.train_features is not None:
+            assert len(net.train_features) == len(net.train_labels)
+            assert len(net.test_features) == len(net.test_labels)
         
         begin = time.time()
         for iter_count in range(self.iterations):
-            for data_idx in range(train_size):
-                net.load_data_instance(data_idx)
-                for i in range(len(net.ensembles)): 
-                    net[i].run_forward_propagate()
-                for j in range(len(net[-1][0])):
-                    net[-1][0][j].annotate()
-                for i in range(len(net.ensembles)): 
-                    net[i].run_backward_propagate()
+            iter_begin = time.time()
+            loss = 0.0
+            train_size = 0
+            for labels in net.iter_batches(self.batch_size):
+                train_size += len(labels)
+                loss += self.train_batch(net)
                 self.update_weights(net)
+            if PROFILER is not None:
+                PROFILER.add_epoch(iter_count, train_size, time.time() - iter_begin)
             elapse = time.time() - begin
-            print "Iter: %d" % iter_count, "Time Elapse:", elapse, "seconds..."
+            print "Iter: %d" % iter_count, "Loss:", loss / train_size, \
+                  "Time Elapse:", elapse, "seconds..."
         end = time.time()
 
         # performance evaluation
-        preds = []
-        for data_idx in range(test_size):
-            net.load_data_instance(data_idx, train=False)
-            for i in range(len(net.ensembles)): 
-                net[i].run_forward_propagate()
-            pred = np.argmax ([ out_neuron.output for out_neuron in net[-1].neurons[0]] )
-            preds.append(pred)
-        assert(len(preds) == test_size), "dimensionality of preds and test_size does not match"
-        nCorrect = sum([preds[i] == net.test_labels[i]-1 for i in range(test_size)])
-        for i in range(len(preds)):
-            print "preds: ", preds[i]+1, ", target: ", net.test_labels[i]
-        print "Accuracy:", 1.0 * nCorrect / test_size
+        print "Accuracy:", self.evaluate(net)
         print "Total Time Cost:", end-begin, "seconds."
 
+class HogwildSGD(SGD):
+    """
+    SGD over a process pool sharing the weights of the network, each worker
+    training on its own shard of train_features. Without sync_steps the
+    workers update the shared weights lock-free after every batch (Hogwild);
+    otherwise their gradients are averaged and applied every sync_steps
+    batches
+    """
+    def __init__(self, iterations, step_size, batch_size=1, workers=2, sync_steps=0):
+        SGD.__init__(self, iterations, step_size, batch_size)
+        self.workers = workers
+        self.sync_steps = sync_steps
+
+    def shards(self, train_size):
+        """[begin, end) of the instances trained by each worker"""
+        bounds = np.linspace(0, train_size, self.workers + 1).astype(int)
+        return zip(bounds[:-1], bounds[1:])
+
+    def shard_batches(self, begin, end):
+        return [ range(b, min(b + self.batch_size, end)) \
+                 for b in range(begin, end, self.batch_size) ]
+
+    def share_memory(self, net):
+        """allocate the shared buffers before the pool is forked"""
+        net.close_pool()
+        for enm in net.ensembles:
+            enm.share_memory()
+            if self.sync_steps > 0 and enm.weights is not None:
+                shape = (self.workers,) + enm.weights.shape
+                shared = multiprocessing.RawArray('d', int(np.prod(shape)))
+                enm.shared_grads = np.frombuffer(shared, dtype=np.float64).reshape(shape)
+
+    def apply_shared_grads(self, net, active):
+        """average the gradients of the active workers into the weights"""
+        for enm in net.ensembles:
+            if enm.weights is None: continue
+            enm.weights -= self.alpha * enm.shared_grads[active].mean(axis=0)
+
+    def solve(self, net):
+        assert net.train_features is not None, "HogwildSGD shards in-memory datasets"
+        assert len(net.train_features) == len(net.train_labels)
+        self.share_memory(net)
+        # the workers are released when training is over, predict forks
+        # its own pool
+        try:
+            pool = net.get_pool(self.workers)
+            shards = self.shards(len(net.train_features))
+
+            begin = time.time()
+            for iter_count in range(self.iterations):
+                iter_begin = time.time()
+                if self.sync_steps > 0:
+                    rounds = max(len(self.shard_batches(b, e)) for b, e in shards)
+                    rounds = (rounds + self.sync_steps - 1) // self.sync_steps
+                    results = []
+                    for r in range(rounds):
+                        tasks = [ (self, w, b, e, r) for w, (b, e) in enumerate(shards) ]
+                        round_results = pool.map(sync_worker, tasks)
+                        active = [ w for w, (_, count) in enumerate(round_results) if count > 0 ]
+                        self.apply_shared_grads(net, active)
+                        results += round_results
+                else:
+                    results = pool.map(hogwild_worker, [ (self, b, e) for b, e in shards ])
+                loss = sum(loss for loss, _ in results)
+                train_size = sum(count for _, count in results)
+                if PROFILER is not None:
+                    PROFILER.add_epoch(iter_count, train_size, time.time() - iter_begin)
+                elapse = time.time() - begin
+                print "Iter: %d" % iter_count, "Loss:", loss / train_size, \
+                      "Time Elapse:", elapse, "seconds..."
+            end = time.time()
+
+            # performance evaluation
+            print "Accuracy:", self.evaluate(net)
+            print "Total Time Cost:", end-begin, "seconds."
+        finally:
+            net.close_pool()
+
+''' network forked into the workers of Network.get_pool() '''
+pool_net = None
+
+def predict_worker(features):
+    return pool_net.predict_batch(features)
+
+def hogwild_worker(args):
+    """train one epoch on a shard, updating the shared weights lock-free"""
+    solver, begin, end = args
+    loss, count = 0.0, 0
+    for indices in solver.shard_batches(begin, end):
+        pool_net.load_data_batch(indices)
+        loss += solver.train_batch(pool_net)
+        solver.update_weights(pool_net)
+        count += len(indices)
+    return loss, count
+
+def sync_worker(args):
+    """accumulate the gradients of round r of a shard into the shared
+    gradient slot of worker w"""
+    solver, w, begin, end, r = args
+    steps = solver.sync_steps
+    loss, count = 0.0, 0
+    for indices in solver.shard_batches(begin, end)[r * steps:(r + 1) * steps]:
+        pool_net.load_data_batch(indices)
+        loss += solver.train_batch(pool_net)
+        for enm in pool_net.ensembles:
+            enm.grad_output.fill(0.0)
+        count += len(indices)
+    for enm in pool_net.ensembles:
+        if enm.weights is None: continue
+        enm.shared_grads[w] = enm.grad_weights
+        enm.grad_weights.fill(0.0)
+    return loss, count
+
 def solve(solver, net):
     assert isinstance(solver, Solver), "solve: solver argument is not type Solver"
     assert isinstance(net, Network), "solve: net argument is not type Network"
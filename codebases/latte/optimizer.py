@@ -1,4 +1,6 @@
+import json
 from structures import *
+from dependence import FusionDependences, same_expression
 
 class Optimizer(object):
     def __init__(self, dict_of_trees, ensemble_order):
@@ -6,18 +8,94 @@ class Optimizer(object):
         self.ensemble_order = ensemble_order
 
 
+class TileSizes(object):
+    """
+    tile sizes of the loops of every ensemble: ensemble name -> loop
+    variable -> sizes of the tiling levels, outer most level first. The
+    entry "default" is used for the ensembles without one of their own;
+    a loop without sizes is not tiled
+    """
+    def __init__(self, default_size=5):
+        super(TileSizes, self).__init__()
+        self.sizes = { "default": { } }
+
+        # by default only the x/y loops of the ensembles are tiled
+        if default_size > 0:
+            self.sizes["default"] = { "x": [ default_size ], "y": [ default_size ] }
+
+    def set(self, ensemble, loop_var, sizes):
+        """sizes of loop_var of ensemble, [] to not tile it"""
+        sizes = [ int(size) for size in sizes if int(size) > 0 ]
+        for outer, inner in zip(sizes, sizes[1:]):
+            assert outer > inner, \
+                    "tile sizes of %s.%s must decrease inwards: %s" % \
+                    (ensemble, loop_var, sizes)
+        self.sizes.setdefault(ensemble, { })[loop_var] = sizes
+
+    def get(self, ensemble, loop_var):
+        if ensemble in self.sizes and loop_var in self.sizes[ensemble]:
+            return self.sizes[ensemble][loop_var]
+        return self.sizes["default"].get(loop_var, [])
+
+    def parse(self, spec):
+        """
+        add a "[ensemble.]loop_var=size[,size..]" specification, e.g.
+        "y=64,8" or "ip1_enm.j=32"
+        """
+        assert "=" in spec, "tile specification is not loop_var=sizes: %s" % spec
+        name, sizes = spec.split("=", 1)
+        ensemble, loop_var = "default", name.strip()
+        if "." in loop_var:
+            ensemble, loop_var = loop_var.rsplit(".", 1)
+        self.set(ensemble, loop_var, [ size for size in sizes.split(",") if size.strip() ])
+
+    def load(self, file_name):
+        """
+        add the sizes of a json file, e.g.
+            { "default": { "x": [5], "y": [5] }, "ip1_enm": { "j": [256, 32] } }
+        """
+        fread = open(file_name, "r")
+        config = json.load(fread)
+        fread.close()
+        for ensemble, loops in config.iteritems():
+            for loop_var, sizes in loops.iteritems():
+                if not isinstance(sizes, list): sizes = [ sizes ]
+                self.set(str(ensemble), str(loop_var), sizes)
+
+    def to_dict(self):
+        return dict((ensemble, dict(loops)) for ensemble, loops in self.sizes.iteritems())
+
+def constant_value(value):
+    """int value of a loop parameter, which the translator may leave
+    wrapped in ConstantNodes; None if it is not a known integer"""
+    while isinstance(value, ConstantNode):
+        value = value.get_constant()
+    if isinstance(value, (int, long)):
+        return value
+    return None
+
+def tile_var(loop_var_name, level):
+    """name of the loop over the tiles of level of loop_var_name"""
+    if level == 1:
+        return "_tile_" + loop_var_name
+    return "_tile%d_%s" % (level, loop_var_name)
+
+
 class TilingOptimizer(Optimizer):
-    def __init__(self, dict_of_trees, ensemble_order):
+    def __init__(self, dict_of_trees, ensemble_order, tile_sizes=None):
         super(TilingOptimizer, self).__init__(dict_of_trees, ensemble_order)
 
-        # change this to change tile size
-        self.tile_size = 5;
+        # change this to change tile sizes
+        if tile_sizes is None:
+            tile_sizes = TileSizes()
+        self.tile_sizes = tile_sizes
 
     def optimize(self):
         """Run tiling optimization. Look at each node's loop bounds, see how 
         much it can be tiled by, and do the tiling.
-        ONLY WORKS ON TOP LEVEL LOOPS AT THE MOMENT (since most processing
-        occurs there, it should be fine, Loc would think)"""
+        The nested x/y loops at the top level of an ensemble are tiled, as
+        well as the loop nests in their body (e.g. the i/j loops over the
+        adjacency lists) which have tile sizes for their loop variables."""
         new_ensemble_order = []
 
         # loop through every tree structure
@@ -33,50 +111,7 @@ class TilingOptimizer(Optimizer):
             if current_node == None:
                 continue
 
-            for_nodes = []
-
-            # grab for nodes that are children of the current for
-            # node: ONLY grab them if they are the FIRST child
-            current_loop_node = current_node
-
-            # get nested for loops under the first for loop if they
-            # do not have anything between them
-            while True:
-                children = current_loop_node.get_children()
-                
-                if len(children) >= 1:
-                    first_child = children[0]
-
-                    if isinstance(first_child, ForNode):
-                        for_nodes.insert(0, current_loop_node)
-                        current_loop_node = first_child
-                        continue
-                    else:
-                        for_nodes.insert(0, current_loop_node)
-                        break
-                else:
-                    for_nodes.insert(0, current_loop_node)
-                    break
-
-            # the current top level
-            current_top_level = [current_node]
-            new_es = None
-
-            # loop through every for node in order of DEEPEST
-            # for node to the outer most one
-            for for_node in for_nodes:
-                # run tiling on the loop
-                current_top_level, new_es = self.tile_loop(for_node, current_top_level)
-
-                # tile loop will add the tiled for loop to the correct spot as well
-                # as return the current top_level which may include a remainder node
-
-            if not new_es == []:
-                # at top level, but a remainder for loop was added: add name to
-                # new ensemble order
-                assert len(new_es) == 1
-                for i in new_es:
-                    new_ensemble_order.append(i)
+            self.tile_nest(e_name, current_node)
 
             # if the current for node now has a parent i.e. it was tiled,
             # move up the tree until we get to the root
@@ -92,119 +127,147 @@ class TilingOptimizer(Optimizer):
         # return the new order
         return new_ensemble_order
 
+    def loop_chain(self, for_node):
+        """for_node and the for loops nested under it as the FIRST child,
+        outer most first"""
+        for_nodes = [ for_node ]
 
-    def tile_loop(self, for_node, current_top_level):
-        ensembles_to_return = []
+        # get nested for loops under the first for loop if they
+        # do not have anything between them
+        while True:
+            children = for_nodes[-1].get_children()
 
-        loop_bound = for_node.get_loop_bound()
-        loop_var_name = for_node.get_initial_name()
-        used_tile_size = self.tile_size
+            if len(children) >= 1 and isinstance(children[0], ForNode):
+                for_nodes.append(children[0])
+            else:
+                break
 
-        # if loop bound is less than our tile size, use it as the "tile size"
-        if loop_bound < self.tile_size:
-            used_tile_size = loop_bound
+        return for_nodes
 
+    def tile_nest(self, e_name, for_node):
+        """Tile the loop nest of for_node level by level, inner most level
+        first, then the loop nests in its body. Returns the new top of the
+        nest."""
+        chain = self.loop_chain(for_node)
 
-        remainder = loop_bound % used_tile_size
+        # (loop variable, loop to tile) of the current level
+        loops = [ (loop.get_initial_name(), loop) for loop in chain ]
 
-        # the current implementation will NOT tile bounds that cause
-        # a remainder to appear; do nothing and return the current top level 
-        if not remainder == 0:
-            return current_top_level, ensembles_to_return
+        # the current top level
+        current_top_level = for_node
+        level = 1
 
+        while len(loops) > 0:
+            tile_loops = []
 
-        altered_loop_bound = int(loop_bound) - remainder
+            # loop through every for node in order of DEEPEST
+            # for node to the outer most one
+            for loop_var_name, loop in loops[::-1]:
+                sizes = self.tile_sizes.get(e_name, loop_var_name)
+                if len(sizes) < level:
+                    continue
 
-        tile_var_name = "_tile_" + loop_var_name
+                # run tiling on the loop; tile loop will add the tiled for
+                # loop to the correct spot as well as return the new top level
+                new_top_level = self.tile_loop(loop, loop_var_name, current_top_level, \
+                                               sizes[-level], level)
+                if new_top_level is not current_top_level:
+                    # the tile loop is the loop to tile at the next level
+                    tile_loops.insert(0, (loop_var_name, new_top_level))
+                current_top_level = new_top_level
+
+            loops = tile_loops
+            level += 1
+
+        # the loop nests inside the inner most loop are tiled on their own
+        self.tile_body(e_name, chain[-1])
+
+        return current_top_level
+
+    def tile_body(self, e_name, node):
+        """tile the loop nests under node"""
+        for child in list(node.get_children()):
+            if isinstance(child, ForNode):
+                self.tile_nest(e_name, child)
+            else:
+                self.tile_body(e_name, child)
+
+    def tile_loop(self, for_node, loop_var_name, current_top_level, tile_size, level=1):
+        """Tile for_node, a loop over loop_var_name or one of its tile loops
+        below level, by tile_size: a tile loop over the range of for_node is
+        put in place of current_top_level and for_node is changed to iterate
+        over one tile. The tile size is rounded up to a multiple of the step
+        of for_node. When it does not divide the range, the bound of
+        for_node is clamped to the original bound so the last tile is a
+        partial one. Returns the new top level."""
+        initial = constant_value(for_node.get_initial())
+        loop_bound = constant_value(for_node.get_loop_bound())
+        increment = constant_value(for_node.get_increment())
+
+        # only tile loops with a known number of steps
+        if initial is None or loop_bound is None or \
+           increment is None or increment <= 0:
+            return current_top_level
+
+        trip_count = loop_bound - initial
+        if trip_count <= 0:
+            return current_top_level
+
+        # a tile holds whole steps of for_node (whole tiles of the level below)
+        used_tile_size = -(-tile_size // increment) * increment
+
+        if level > 1:
+            # there is nothing to gain from a single tile of tiles
+            if used_tile_size >= trip_count:
+                return current_top_level
+        else:
+            # if trip count is less than our tile size, use it as the "tile size"
+            used_tile_size = min(used_tile_size, trip_count)
+
+        remainder = trip_count % used_tile_size
+
+        tile_var_name = tile_var(loop_var_name, level)
 
         # create outer for tile loop and change "this" for loop to deal
         # with the new tile
         tile_node = ForNode(ConstantNode(tile_var_name), 
-                            ConstantNode(for_node.get_initial()), 
-                            ConstantNode(altered_loop_bound), 
+                            ConstantNode(initial), 
+                            ConstantNode(loop_bound), 
                             ConstantNode(used_tile_size),
                             True)
 
-        top_level = current_top_level[0]
-
-        original_top_level = []
-
-        for i in current_top_level:
-            original_top_level.append(i.deep_copy())
-
         # replace the new node in whatever place the top level node is
-        tile_node.replace_node(top_level)
-
-        # if current top level has a remainder node in the second entry, add
-        # it as a child as well
-        if len(current_top_level) >= 2:
-            assert len(current_top_level) == 2
-            tile_node.add_child(current_top_level[1])
+        tile_node.replace_node(current_top_level)
 
         # change the for loop we are tiling to work with our new tiling of it
-        for_node.set_initial(tile_var_name)
-        for_node.set_loop_bound(tile_var_name + " + " + str(used_tile_size))
-
-        # prepare new top level array
-        new_top_level = [tile_node]
-
-        # if remainder, need to create remainder node
-        # CAUTION: THIS IS BROKEN DO NOT USE; plus if not remainder == 0 
-        # we would never even reach this place in the current implementation
-        # since I made it so we ignore loops with remainders when tiling
+        tile_end = tile_var_name + " + " + str(used_tile_size)
         if not remainder == 0:
-            leftover_loop_var = "_remain_" + for_node.get_initial_name()
-            new_start = int(loop_bound) - remainder
-
-            # create a new for node to handle the leftovers
-            # for r = prev upper bound, r < remainder, increment 1
-            leftover_for = ForNode(ConstantNode(leftover_loop_var), 
-                                   ConstantNode(new_start),
-                                   ConstantNode(int(loop_bound)), 
-                                   ConstantNode(1))
-
-            for i in original_top_level:
-                i.find_and_replace(i.get_initial_name(),
-                                   leftover_loop_var)
-                leftover_for.add_child(i)
-
-            ## clone children, add to our new for node
-            #original_children = original_top_level.get_children()
-
-            #for child in original_children:
-            #    clone_child = child.deep_copy()
-            #    leftover_for.add_child(clone_child)
-
-            # find and replace all occurances of the original for 
-            # variable with the leftover loop var
-            #leftover_children = leftover_for.get_children()
-
-            #for child in leftover_children:
-            #    child.find_and_replace(for_node.get_initial_name(),
-            #                           leftover_loop_var)
-
-            # create a new name for this
-            e_name = "_tile_left_" + str(self.num_left)
-            self.num_left = self.num_left + 1
-
-            self.dict_of_trees[e_name] = leftover_for
-
-            new_top_level.append(leftover_for)
-
-            ensembles_to_return.append(e_name)
+            # the last tile stops at the original loop bound
+            tile_end = "std::min(" + tile_end + ", " + str(loop_bound) + ")"
+        for_node.set_initial(tile_var_name)
+        for_node.set_loop_bound(tile_end)
 
-        # returns the new top level and any new "ensemble" names that should 
-        # be appended, specifically only the leftover tile node name
-        return new_top_level, ensembles_to_return
+        return tile_node
 
 
 class FusionOptimizer(Optimizer):
     def __init__(self, dict_of_trees, ensemble_order, ensembles_info, name2enm,
-                 tiled):
+                 tiled, cost_model=None):
         super(FusionOptimizer, self).__init__(dict_of_trees, ensemble_order)
         self.ensembles_info = ensembles_info
         self.name2enm = name2enm
         self.tiled = tiled
+        # declines the fusions whose working set does not fit the cache
+        self.cost_model = cost_model
+        # (ensemble, other ensemble, fused, reason) of every pair considered
+        self.decisions = []
+
+    def decide(self, current_ensemble, other_ensemble, fused, reason):
+        """record and print the decision on fusing other_ensemble into
+        current_ensemble"""
+        self.decisions.append((current_ensemble, other_ensemble, fused, reason))
+        print "fusion of %s %s: %s, %s" % (current_ensemble, other_ensemble,
+              "fused" if fused else "not fused", reason)
 
     def optimize(self):
         # copy the order: this copy will represent the nodes that haven't
@@ -235,6 +298,8 @@ class FusionOptimizer(Optimizer):
             layer_type = self.name2enm[current_ensemble]
             one2one = layer_type[-1]["one2one"]
 
+            # a later ensemble can only be fused if every ensemble between
+            # them was fused as well: every failure below breaks
             for other_ensemble in to_loop_over:
                 # shouldn't be ourselves in the new list we are looping over
                 assert not other_ensemble == current_ensemble
@@ -258,11 +323,16 @@ class FusionOptimizer(Optimizer):
                 if self.tiled:
                     # cannot tile; break
                     if not current1.is_tile() or not current2.is_tile():
+                        self.decide(current_ensemble, other_ensemble, False,
+                                    "not tiled")
                         break
 
                 inner_for = None
                 other_body = []
 
+                # the for loops of the first loop nest that will be shared
+                fused_loops = []
+
                 loops_good = True
 
                 while True:
@@ -284,21 +354,23 @@ class FusionOptimizer(Optimizer):
                         increment1 = current1.get_increment()
                         increment2 = current2.get_increment()
 
-                        # all things must match
-                        if not initial1 == initial2:
+                        # all things must match, as expressions: the
+                        # outer loop variables are renamed already
+                        if not same_expression(initial1, initial2):
                             loops_good = False
                             break
-                        if not loop_bound1 == loop_bound2:
+                        if not same_expression(loop_bound1, loop_bound2):
                             loops_good = False
                             break
-                        if not increment1 == increment2:
+                        if not same_expression(increment1, increment2):
                             loops_good = False
                             break
 
                         # everything matches: go ahead and begin replacing for loop
                         # names with our own stuff just in case...
-                        other_for_node.find_and_replace(other_for_node.get_initial_name(),
-                                                my_for_node.get_initial_name())
+                        other_for_node.find_and_replace(current2.get_initial_name(),
+                                                current1.get_initial_name())
+                        fused_loops.append(current1)
 
                         forchild1 = False
                         forchild2 = False
@@ -356,228 +428,45 @@ class FusionOptimizer(Optimizer):
                 # if loops_good is not true, we cannot fuse; continue to the
                 # next loop 
                 if not loops_good:
-                    print "loop bounds/structure for", current_ensemble, other_ensemble,\
-                           "do not match"
-                    #print "\n\nfail\n\n"
-                    #print current_ensemble, other_ensemble
-                    #print my_for_node, other_for_node
+                    self.decide(current_ensemble, other_ensemble, False,
+                                "loop bounds/structure do not match")
                     break
 
-                # otherwise we move onto the variable dependency checks,
-                # the non-trivial part of the fusion check
-
-                # do checks from current loop to the loop we want to fuse first
-
-                w_variable_names, w_array_accesses = my_for_node.get_writes()
-                r_variable_names, r_array_accesses = other_for_node.get_reads()
-
-                # if there is a write to a variable name in the first loop, it
-                # can't be the case that the second loop reads it as fusion may
-                # result in it reading a value that isn't good yet
-                fusion_good = True
-
-                #print "Starting analysis"
-                #print my_for_node
-                #print other_for_node
-
-                print "going to check", current_ensemble, other_ensemble,\
-                      "dependencies"
-
-                for var_name in w_variable_names:
-                    if var_name in r_variable_names:
-                        print var_name, "is written in for loop 1 but read in 2nd loop"
-                        fusion_good = False
-                        break
-
-                    # it's also possible that the var in question is actually
-                    # an array that is being completely overwritten by a 
-                    # function call or something of the sort: check to see
-                    # if there is a read of it in the r_array_accesses
-                    # as well
-
-                    #r_accesses = set()
-
-                    #for r in r_array_accesses:
-                    #    r_accesses.add(r[0])
-                    for indices in [x for (a, x) in r_array_accesses if a == var_name]:
-                        if one2one:
-                            # this var name is an array, and if the layer is 1 to 1, it
-                            # apparently means it only affects the area x, y: compare
-                            # again with this knowledge
-                            array_indices = ["x", "y"]
-                            if not array_indices == indices:
-                                print "accesses to", array_name, "in loop 1 and 2",\
-                                      "do not match", array_indices, indices,\
-                                      "(1 to 2)"
-                                   
-                                fusion_good = False
-                                break
-                        else:
-                            print var_name, "is written in for loop 1 but read in for loop 2"
-                            print my_for_node, other_for_node
-                            fusion_good = False
-                            break
-                       
-                if not fusion_good:
-                    # if fusion isn't good, continue to the next loop
-                    continue
-
-                for array_access in w_array_accesses:
-                    array_name = array_access[0]
-                    array_indices = array_access[1]
-
-                    good = True
-
-                    #print "sanity"
-                    #print r_array_accesses
-                    #print array_name
-                    #print "check"
-
-                    for indices in [x for (a, x) in r_array_accesses if a == array_name]:
-                        # right now, assume that indices can only be x, y type 
-                        # deals as in no x + 1 or y - 1 or that kind of stuff
-
-                        # if we are accessing something in the second, it must be that we are 
-                        # accessing the exact same things, i.e array_indices must match
-                        if not array_indices == indices:
-                            print "accesses to", array_name, "in loop 1 and 2",\
-                                  "do not match", array_indices, indices
-                                
-                            fusion_good = False
-                            good = False
-                            break
-
-                    if not good:
-                        break
-
-                    # also make sure that the array isn't being read as a whole
-                    # i.e as a var name
-                    if array_name in r_variable_names:
-                        if one2one2:
-                            # this var name is an array, and if the layer is 1 to 1, it
-                            # apparently means it only affects the area x, y: compare
-                            # again with this knowledge
-                            indices = ["x", "y"]
-                            if not array_indices == indices:
-                                print "the second loop is reading an array 1st loop",\
-                                      "writes to:", array_name
-                                fusion_good = False
-                                break
-                        else:
-                            print "the second loop is reading an array 1st loop",\
-                                  "writes to:", array_name
-                            fusion_good = False
-                            break
-
+                # otherwise we move onto the variable dependency checks, the
+                # non-trivial part of the fusion check: in every iteration
+                # of the fused loops the body of the second loop runs after
+                # the body of the first one, which is legal as long as no
+                # element is touched by the second body in an earlier
+                # iteration than by the first one, with a write on either
+                # side. The distances come from the affine index expressions
+                # and the bounds of the loops in the bodies, e.g.
+                # first writes array[x], second reads array[x+1]; 
+                # fusion is illegal
+                # first writes array[x], second reads array[i] for i from x
+                # to x + 1; fusion is legal
+                dependences = FusionDependences(fused_loops)
+                fusion_good, reason = dependences.check(inner_for.get_children(),
+                                                        other_body, one2one, one2one2)
                 if not fusion_good:
-                    # if fusion isn't good, end fusion 
+                    self.decide(current_ensemble, other_ensemble, False, reason)
                     break
-                
-                # now checks from loop we want to fuse to current loop
-                w_variable_names, w_array_accesses = other_for_node.get_writes()
-                r_variable_names, r_array_accesses = my_for_node.get_reads()
-
-                print "now analyzing loop 2 to loop 1 dependencies"
-                #print w_variable_names, w_array_accesses
-                #print r_variable_names, r_array_accesses
-
-                # the only problems that could exist are if the second for loop
-                # writes to an index that the first 1 is going to read in a later
-                # itereation or if the second for loop writes a variable that
-                # is used the by the first
-                # e.g.
-                # first reads array[x], second writes array[x+1]; 
-                # fusion is illegal
-                # first reads some var x, but second writes to it every 
-                # iteration; fusion is illegal
-
-                for var_name in w_variable_names:
-                    if var_name in r_variable_names:
-                        print var_name, "is written in for loop 2 but read in",\
-                              "for loop 1, which could be bad"
-                        fusion_good = False
-                        break
 
-                    # it's also possible that the var in question is actually
-                    # an array that is being completely overwritten by a 
-                    # function call or something of the sort: check to see
-                    # if there is a read of it in the r_array_accesses
-                    # as well
-                    for indices in [x for (a, x) in r_array_accesses if a == var_name]:
-                        if one2one2:
-                            # this var name is an array, and if the layer is 1 to 1, it
-                            # apparently means it only affects the area x, y: compare
-                            # again with this knowledge
-                            array_indices = ["x", "y"]
-                            if not array_indices == indices:
-                                print "accesses to", array_name, "in loop 1 and 2",\
-                                      "do not match", array_indices, indices,\
-                                      "(2 to 1)"
-                                   
-                                fusion_good = False
-                                break
-                        else:
-                            print var_name, "is written in for loop 2 but read in for loop 1"
-                            print my_for_node, other_for_node
-                            fusion_good = False
-                            break
-
-                for array_access in w_array_accesses:
-                    array_name = array_access[0]
-                    array_indices = array_access[1]
-
-                    good = True
-
-                    for indices in [x for (a, x) in r_array_accesses if a == array_name]:
-                        # right now, assume that indices can only be x, y type 
-                        # deals as in no x + 1 or y - 1 or that kind of stuff
-
-                        # since we are assuming that, we can't really check for
-                        # x+1 or things like that, meaning we'll just be conservative
-                        # and force the acccesses to be the same
-
-                        # if we are accessing something in the second, it must be that we are 
-                        # accessing the exact same things, i.e array_indices must match
-                        if not array_indices == indices:
-                            print "accesses to", array_name, "in loop 1 and 2",\
-                                  "do not match", array_indices, indices,\
-                                  "(2 to 1)"
-                                
-                            fusion_good = False
-                            good = False
-                            break
-
-                    if not good:
+                # legal, but it may not pay off if the fused loop body does
+                # not fit the cache any more
+                if self.cost_model is not None:
+                    fits, working_set = self.cost_model.fusion_fits(
+                            inner_for.get_children(), other_body)
+                    if not fits:
+                        self.decide(current_ensemble, other_ensemble, False,
+                                    "fused working set %.1f KB exceeds the %.1f KB cache" % \
+                                    (working_set / 1024.0, self.cost_model.cache_bytes / 1024.0))
                         break
-
-                    # also make sure that the array isn't being read as a whole
-                    # i.e as a var name
-                    if array_name in r_variable_names:
-                        if one2one:
-                            # this var name is an array, and if the layer is 1 to 1, it
-                            # apparently means it only affects the area x, y: compare
-                            # again with this knowledge
-                            indices = ["x", "y"]
-                            if not array_indices == indices:
-                                print "the first loop is reading an array 2nd loop",\
-                                      "writes to:", array_name
-                                fusion_good = False
-                                break
-
-                        else:
-                            print "the first loop is reading an array 2nd loop",\
-                                  "writes to:", array_name
-                            fusion_good = False
-                            break
-
-                if not fusion_good:
-                    # if fusion isn't good, continue to the next loop
-                    break
+                    reason += "; fused working set %.1f KB" % (working_set / 1024.0)
 
                 # if fusion is still good at this point, do the fusion
                 # get the entire other loop body and add it as a child to the
                 # inner most for loop
-                print "commencing fusion of", current_ensemble, other_ensemble
+                self.decide(current_ensemble, other_ensemble, True, reason)
 
                 for child in other_body:
                     inner_for.add_child(child)
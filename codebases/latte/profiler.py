@@ -0,0 +1,183 @@
+'''
+    Profiling of the reference runtime
+'''
+import json
+import resource
+import time
+
+class Profiler(object):
+    """
+    records wall time and number of calls of every stage (load, forward,
+    annotate, backward, update) of every ensemble, and the throughput
+    of every epoch; enabled with lib.set_profiler()
+    """
+    def __init__(self):
+        super(Profiler, self).__init__()
+        self.stages = { }   # stage -> ensemble name -> [calls, seconds]
+        self.epochs = [ ]
+
+    def record(self, stage, name, seconds):
+        timing = self.stages.setdefault(stage, { }).setdefault(name, [0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+
+    def call(self, stage, name, func, *args):
+        """call func(*args), recording its time under (stage, name)"""
+        begin = time.time()
+        result = func(*args)
+        self.record(stage, name, time.time() - begin)
+        return result
+
+    def add_epoch(self, epoch, samples, seconds):
+        self.epochs.append({
+            "epoch": epoch,
+            "samples": samples,
+            "seconds": seconds,
+            "samples_per_sec": samples / seconds if seconds > 0 else 0.0
+        })
+
+    def to_dict(self):
+        stages = { }
+        for stage, timings in self.stages.iteritems():
+            stages[stage] = { }
+            for name, (calls, seconds) in timings.iteritems():
+                stages[stage][name] = { "calls": calls, "seconds": seconds }
+        return { "stages": stages, "epochs": list(self.epochs) }
+
+    def dump(self, file_name):
+        fwrite = open(file_name, "w")
+        json.dump(self.to_dict(), fwrite, indent=2, sort_keys=True)
+        fwrite.close()
+
+    def __str__(self):
+        lines = [ ]
+        for stage in sorted(self.stages):
+            for name, (calls, seconds) in sorted(self.stages[stage].iteritems()):
+                lines.append("%-10s %-24s %8d calls %12.6f seconds" % \
+                        (stage, name, calls, seconds))
+        for epoch in self.epochs:
+            lines.append("epoch %d: %.1f samples/sec" % \
+                    (epoch["epoch"], epoch["samples_per_sec"]))
+        return "\n".join(lines)
+
+def reset_peak_memory():
+    """restart the peak resident memory of the process from its current
+    resident memory; False where the kernel cannot, the peak is then the
+    one of the whole process"""
+    try:
+        fwrite = open("/proc/self/clear_refs", "w")
+        fwrite.write("5")
+        fwrite.close()
+        return True
+    except IOError:
+        return False
+
+def peak_memory():
+    """peak resident memory of the process since the last
+    reset_peak_memory, in kilobytes on linux"""
+    try:
+        fread = open("/proc/self/status", "r")
+        lines = fread.readlines()
+        fread.close()
+    except IOError:
+        lines = [ ]
+    for line in lines:
+        if line.startswith("VmHWM:"):
+            return int(line.split()[1])
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+''' peak memory of every task the pool workers ran in the running phase '''
+worker_peaks = [ ]
+
+def measure_worker(func, arg):
+    """func(arg) in a pool worker, with the peak memory of the worker while
+    running it; add_worker_peaks records it in the parent"""
+    reset_peak_memory()
+    result = func(arg)
+    return result, peak_memory()
+
+def add_worker_peaks(results):
+    """the results of measure_worker, the peaks recorded for the phase"""
+    worker_peaks.extend(peak for _, peak in results)
+    return [ result for result, _ in results ]
+
+def ir_size(codes, ensemble_order):
+    """number of nodes of the loop trees of the ensembles in order"""
+    count = 0
+    for name in ensemble_order:
+        stack = [ codes.get(name) ]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node is None: continue
+            count += 1
+            stack.extend(node.children)
+    return count
+
+class CompileProfiler(object):
+    """
+    records the wall time and the peak memory of every phase of
+    generator.main, of the process and of its pool workers with -j, and
+    the size of the IR before and after every optimizer; enabled with
+    generator.py --profile
+    """
+    def __init__(self):
+        super(CompileProfiler, self).__init__()
+        self.phases = [ ]
+        self.ir_sizes = [ ]
+        self.current = None     # (name, start time) of the running phase
+
+    def begin(self, name):
+        """end the running phase, if any, and start phase name"""
+        self.end()
+        reset_peak_memory()
+        del worker_peaks[:]
+        self.current = (name, time.time())
+
+    def end(self):
+        if self.current is None: return
+        name, begin = self.current
+        self.phases.append({
+            "phase": name,
+            "seconds": time.time() - begin,
+            "peak_memory_kb": peak_memory(),
+            "workers_peak_memory_kb": max(worker_peaks) if worker_peaks else 0
+        })
+        del worker_peaks[:]
+        self.current = None
+
+    def add_ir_size(self, optimizer, direction, codes, ensemble_order, stage):
+        """size of the forward or backward IR, stage is "before" or "after"
+        the optimizer"""
+        self.ir_sizes.append({
+            "optimizer": optimizer,
+            "direction": direction,
+            "stage": stage,
+            "nodes": ir_size(codes, ensemble_order)
+        })
+
+    def to_dict(self):
+        return {
+            "phases": list(self.phases),
+            "ir_sizes": list(self.ir_sizes),
+            "total_seconds": sum(phase["seconds"] for phase in self.phases),
+            "peak_memory_kb": max([ phase["peak_memory_kb"] for phase in self.phases ] + \
+                                  [ peak_memory() ])
+        }
+
+    def dump(self, file_name):
+        fwrite = open(file_name, "w")
+        json.dump(self.to_dict(), fwrite, indent=2, sort_keys=True)
+        fwrite.close()
+
+    def __str__(self):
+        lines = [ ]
+        for phase in self.phases:
+            line = "%-24s %12.6f seconds %10d KB" % \
+                   (phase["phase"], phase["seconds"], phase["peak_memory_kb"])
+            if phase["workers_peak_memory_kb"] > 0:
+                line += " %10d KB in workers" % phase["workers_peak_memory_kb"]
+            lines.append(line)
+        for size in self.ir_sizes:
+            lines.append("%-10s %-13s %6s %8d nodes" % (size["optimizer"], \
+                    size["direction"], size["stage"], size["nodes"]))
+        return "\n".join(lines)
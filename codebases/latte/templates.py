@@ -1,4 +1,4 @@
-from ast_matcher import template
+from ast_matcher import template, TemplateIndex
 
 """
 Templates for input scripts
@@ -57,6 +57,15 @@ new_ensemble_templates = [
 def template_SGD():
     _name = SGD(_iter, _step)
 
+@template
+def template_BatchSGD():
+    _name = SGD(_iter, _step, batch_size=_batch_size)
+
+solver_templates = [
+    template_SGD(),
+    template_BatchSGD()
+]
+
 @template
 def template_add_connection():
     add_connection(_net, _prev_enm, _cur_enm, _mappings)
@@ -72,6 +81,10 @@ layer_templates = [
         template_SoftmaxLossLayer()
 ]
 
+''' templates matched against the statements of an input script '''
+program_templates = TemplateIndex(\
+        [ template_Network() ] + layer_templates + solver_templates)
+
 """
 Templates for computation programming paradigm
 """
@@ -93,6 +106,10 @@ def template_for_range(range):
 
 for_templates = [ template_for_range("range"), template_for_range("xrange") ]
 
+''' loops of neuron functions, see Translator.process_for '''
+loop_templates = TemplateIndex([ \
+        template_for_backward_adj(), template_for("range"), template_for("xrange") ])
+
 @template
 def template_dp(target, varname):
     for _prev in self.backward_adj:
@@ -123,4 +140,11 @@ def template_bp_scalar_prod():
 def template_asgn(field):
     self.field = _exp
 
+''' idioms replaced by blas calls when MKL is enabled, see Translator '''
+mkl_loop_templates = TemplateIndex([ \
+        template_fp_dp(), template_bp_axpy(), template_bp_scalar_prod() ])
+
+mkl_asgn_templates = TemplateIndex([ \
+        template_asgn("output"), template_asgn("grad_activation"), template_asgn("grad_output") ])
+
 
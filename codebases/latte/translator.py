@@ -24,10 +24,9 @@ def unwrap(node):
     return node
 
 def match_forloop(stmt):
-    tmpls = [ template_for("range"), template_for("xrange") ]
-    for tmpl in tmpls:
-        if tmpl.match(stmt):
-            return tmpl.wildcard
+    tmpl = loop_templates.match(stmt)
+    if tmpl is template_for("range") or tmpl is template_for("xrange"):
+        return tmpl.wildcard
     return None
 
 class Translator(object):
@@ -72,26 +71,14 @@ class Translator(object):
             # hard code the tid if DP_FLAG is enabled
             subscript = "[tid]" if self.DP_FLAG else ""
 
-            # try pattern match a bunch of different patterns
-            tmpl = template_asgn("output")
-            if tmpl.prefix_of(node):
+            # try pattern match the assignments to output, grad_activation
+            # and grad_output
+            tmpl = mkl_asgn_templates.prefix_of(node)
+            if tmpl is not None:
+                field = tmpl.args[0]
                 expr = self.process_node(tmpl.wildcard['exp'])
                 return AssignmentNode(IndexNode(\
-                        ConstantNode(self.curr_enm+"_output%s" % subscript), ['x', 'y'], dim_y), \
-                        expr)
-
-            tmpl = template_asgn("grad_activation")
-            if tmpl.prefix_of(node):
-                expr = self.process_node(tmpl.wildcard['exp'])
-                return AssignmentNode(IndexNode(\
-                        ConstantNode(self.curr_enm+"_grad_activation%s" % subscript), ['x', 'y'], dim_y), \
-                        expr)
-
-            tmpl = template_asgn("grad_output")
-            if tmpl.prefix_of(node):
-                expr = self.process_node(tmpl.wildcard['exp'])
-                return AssignmentNode(IndexNode(\
-                        ConstantNode(self.curr_enm+"_grad_output%s" % subscript), ['x', 'y'], dim_y), \
+                        ConstantNode(self.curr_enm+"_%s%s" % (field, subscript)), ['x', 'y'], dim_y), \
                         expr)
 
         # assign node
@@ -105,10 +92,10 @@ class Translator(object):
             # hard code the tid if DP_FLAG is enabled
             subscript = "[tid]" if self.DP_FLAG else ""
 
+            tmpl = mkl_loop_templates.match(node)
+
             #tmpl = template_dp("self", "output")
-            tmpl = template_fp_dp()
-            matched = tmpl.match(node) 
-            if matched:
+            if tmpl is template_fp_dp():
                 print ast.dump(tmpl.wildcard['B'])
                 A, C, B, i,  _, j = map(self.process_node, tmpl.wildcard.values())
                 call = CallNode(ConstantNode("sgemm_dp"))
@@ -118,12 +105,10 @@ class Translator(object):
                 call.add_arg(ConstantNode(self.prev_enm_dim[0] * self.prev_enm_dim[1]), 1, 0)
                 return call
 
-            tmpl = template_bp_axpy()
-            matched = tmpl.match(node)
             # print ast.dump(node)
             ''' self.grad_weights[prev.pos_x][prev.pos_y] += 
                             self.grad_output * self.inputs[prev.pos_x][prev.pos_y] '''
-            if matched:
+            if tmpl is template_bp_axpy():
                 #for x in map(self.process_node, tmpl.wildcard.values()): print x
                 C, B, _, _, scalar, _ = map(self.process_node, tmpl.wildcard.values())
                 call = CallNode(ConstantNode("sgemm_axpy"))
@@ -133,10 +118,8 @@ class Translator(object):
                 call.add_arg(ConstantNode(self.prev_enm_dim[0] * self.prev_enm_dim[1]), 1, 0)
                 return call
 
-            tmpl = template_bp_scalar_prod()
-            matched = tmpl.match(node) 
             ''' prev.grad_output += self.grad_output * self.weights[prev.pos_x][prev.pos_y] '''
-            if matched:
+            if tmpl is template_bp_scalar_prod():
                 #for x in map(self.process_node, tmpl.wildcard.values()): print x
                 C, B,  _, _, scalar, _ = map(self.process_node, tmpl.wildcard.values())
                 prev_type = self.neuron_analyzer.prev_enm_type()
@@ -153,8 +136,8 @@ class Translator(object):
         # ---------------------------------------------------------------------
 
         # match for-backward-adj loop
-        tmpl = template_for_backward_adj()
-        if tmpl.match(node):
+        tmpl = loop_templates.match(node)
+        if tmpl is template_for_backward_adj():
             result = tmpl.wildcard
             elt, indices = self.process_adjacency([])
             index = indices[elt[0].get_constant()]